@@ -7,21 +7,59 @@ from unittest import mock
 
 import pytest
 from pyiem.database import get_dbconnc
+from twisted.internet import reactor
 from twisted.python import log
+from twisted.web import resource, server
 
 from iembot.bot import JabberClient
+from iembot.media import MEDIA_CACHE, PREPARED_CACHE
+from iembot.sessions import SESSIONS
 
 log.startLogging(sys.stdout)
 
 
+@pytest.fixture(autouse=True)
+def media_cache():
+    """Do not share fetched media between tests."""
+    MEDIA_CACHE.clear()
+    PREPARED_CACHE.clear()
+    yield MEDIA_CACHE
+    MEDIA_CACHE.clear()
+    PREPARED_CACHE.clear()
+    SESSIONS.clear()
+
+
+class _Recorder(resource.Resource):
+    """Answer requests with ``status``, recording the bodies."""
+
+    isLeaf = True
+
+    def __init__(self):
+        super().__init__()
+        self.status = 200
+        self.bodies = []
+
+    def render_POST(self, request):
+        self.bodies.append(request.content.read())
+        request.setResponseCode(self.status)
+        return b"ok"
+
+
+@pytest.fixture
+def http_server():
+    """A local HTTP server, yielding its url and request recorder."""
+    recorder = _Recorder()
+    port = reactor.listenTCP(0, server.Site(recorder), interface="127.0.0.1")
+    yield f"http://127.0.0.1:{port.getHost().port}/", recorder
+    port.stopListening()
+
+
 @pytest.fixture
 def bot():
     """A bot."""
     iembot = JabberClient(f"iembot_{random.randint(0, 1000000)}", mock.Mock())
     # Slack
-    iembot.slack_routingtable = {
-        "XXX": [123],
-    }
+    iembot.fanout.update("slack", {"XXX": [123]})
     iembot.slack_teams = {
         123: {
             "access_token": "123",
@@ -29,9 +67,7 @@ def bot():
         }
     }
     # Mastodon Stuff
-    iembot.md_routingtable = {
-        "XXX": [123],
-    }
+    iembot.fanout.update("mastodon", {"XXX": [123]})
     iembot.md_users = {
         123: {
             "screen_name": "testuser",
@@ -50,14 +86,10 @@ def bot():
             "screen_name": "testuser",
         }
     }
-    iembot.tw_routingtable = {
-        "XXX": [
-            123,
-        ]
-    }
+    iembot.fanout.update("twitter", {"XXX": [123]})
 
     iembot.config = defaultdict(str)
-    iembot.xmlstream = mock.Mock()
+    iembot.xmlstream = mock.Mock(prefixes={}, namespace="jabber:client")
     return iembot
 
 
@@ -0,0 +1,61 @@
+-- NOTIFY the bot of changed subscriptions and accounts, so that it can
+-- apply just the changed account when run with `--listen-notify`.
+
+CREATE OR REPLACE FUNCTION iembot_notify_change() RETURNS trigger AS $$
+DECLARE
+    rec record;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        rec := OLD;
+    ELSE
+        rec := NEW;
+    END IF;
+    PERFORM pg_notify(
+        'iembot_changes',
+        json_build_object(
+            'table', TG_TABLE_NAME,
+            'op', TG_OP,
+            'iembot_account_id', to_jsonb(rec)->'iembot_account_id'
+        )::text
+    );
+    -- An account moving subscriptions, also notify about the old one
+    IF TG_OP = 'UPDATE' AND
+            to_jsonb(OLD)->'iembot_account_id' IS DISTINCT FROM
+            to_jsonb(NEW)->'iembot_account_id' THEN
+        PERFORM pg_notify(
+            'iembot_changes',
+            json_build_object(
+                'table', TG_TABLE_NAME,
+                'op', TG_OP,
+                'iembot_account_id', to_jsonb(OLD)->'iembot_account_id'
+            )::text
+        );
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DO $$
+DECLARE
+    tbl text;
+BEGIN
+    FOREACH tbl IN ARRAY ARRAY[
+        'iembot_subscriptions',
+        'iembot_rooms',
+        'iembot_twitter_oauth',
+        'iembot_mastodon_oauth',
+        'iembot_atmosphere_accounts',
+        'iembot_slack_teams',
+        'iembot_slack_team_channels',
+        'iembot_webhooks',
+        'iembot_channel_group_membership'
+    ] LOOP
+        EXECUTE format(
+            'DROP TRIGGER IF EXISTS iembot_notify_change ON %I', tbl);
+        EXECUTE format(
+            'CREATE TRIGGER iembot_notify_change AFTER INSERT OR UPDATE OR '
+            'DELETE ON %I FOR EACH ROW EXECUTE FUNCTION '
+            'iembot_notify_change()', tbl);
+    END LOOP;
+END;
+$$;
@@ -0,0 +1,51 @@
+-- Partition iembot_social_log by day, see the README.  The existing table is
+-- kept as the partition of the rows before tomorrow, the daily partitions
+-- are then created and dropped by trim_iembot_social_log.py, which should
+-- run daily.  The bot's COPY into iembot_social_log is routed to the
+-- partitions.
+
+-- Prove the legacy partition's bound first, so the ATTACH below does not
+-- scan the table while holding its ACCESS EXCLUSIVE lock.  VALIDATE only
+-- takes a SHARE UPDATE EXCLUSIVE lock, the bot keeps writing meanwhile.
+-- Do not run this close to midnight, as the bound is tomorrow.
+DO $$
+BEGIN
+    EXECUTE format(
+        'ALTER TABLE iembot_social_log ADD CONSTRAINT '
+        'iembot_social_log_legacy_bound CHECK '
+        '(valid IS NOT NULL AND valid < %L) NOT VALID',
+        current_date + 1);
+END
+$$;
+ALTER TABLE iembot_social_log
+    VALIDATE CONSTRAINT iembot_social_log_legacy_bound;
+
+BEGIN;
+
+ALTER TABLE iembot_social_log RENAME TO iembot_social_log_legacy;
+
+CREATE TABLE iembot_social_log
+    (LIKE iembot_social_log_legacy INCLUDING DEFAULTS)
+    PARTITION BY RANGE (valid);
+-- No index on valid, which would be built on the legacy partition while
+-- locked, the daily partitions are pruned by valid already.
+
+DO $$
+BEGIN
+    -- The rows of today are within the legacy partition
+    EXECUTE format(
+        'ALTER TABLE iembot_social_log ATTACH PARTITION '
+        'iembot_social_log_legacy FOR VALUES FROM (MINVALUE) TO (%L)',
+        current_date + 1);
+    EXECUTE format(
+        'CREATE TABLE %I PARTITION OF iembot_social_log '
+        'FOR VALUES FROM (%L) TO (%L)',
+        'iembot_social_log_' || to_char(current_date + 1, 'YYYYMMDD'),
+        current_date + 1, current_date + 2);
+END
+$$;
+
+ALTER TABLE iembot_social_log_legacy
+    DROP CONSTRAINT iembot_social_log_legacy_bound;
+
+COMMIT;
@@ -0,0 +1,6 @@
+-- Optional batched delivery of webhooks, see the README.  A webhook with
+-- batch_ms or batch_size set gets its messages POSTed as a JSON array once
+-- batch_ms milliseconds passed since the first or batch_size are waiting.
+
+ALTER TABLE iembot_webhooks ADD COLUMN IF NOT EXISTS batch_ms integer;
+ALTER TABLE iembot_webhooks ADD COLUMN IF NOT EXISTS batch_size integer;
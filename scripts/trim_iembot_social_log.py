@@ -1,20 +1,111 @@
-"""Remove old data from iembot_social_log"""
+"""Remove old data from iembot_social_log
 
+When the table is partitioned by day, see
+``iembot_social_log_partitioned.sql``, the partitions for the coming days
+are created and those wholly older than the retention dropped, rather than
+deleting the rows one by one.
+"""
+
+import re
+from datetime import date, timedelta
+
+import click
 from pyiem.database import sql_helper, with_sqlalchemy_conn
 from pyiem.util import logger
 from sqlalchemy.engine import Connection
 
 LOG = logger()
+# The upper bound of a partition, like TO ('2026-10-19 00:00:00+00')
+UPPER_BOUND = re.compile(r"TO \('(\d{4}-\d{2}-\d{2})")
+
+
+def partition_name(day: date) -> str:
+    """Return the name of a day's partition."""
+    return f"iembot_social_log_{day:%Y%m%d}"
+
+
+def is_partitioned(conn: Connection) -> bool:
+    """Is iembot_social_log a partitioned table."""
+    res = conn.execute(
+        sql_helper(
+            "select 1 from pg_partitioned_table p JOIN pg_class c "
+            "on (p.partrelid = c.oid) where c.relname = 'iembot_social_log'"
+        )
+    )
+    return res.first() is not None
 
 
+def partition_bounds(conn: Connection) -> list[tuple[str, date | None]]:
+    """Return the partitions with their upper bound, None for DEFAULT."""
+    res = conn.execute(
+        sql_helper(
+            "select c.relname, pg_get_expr(c.relpartbound, c.oid) as bound "
+            "from pg_inherits i JOIN pg_class c on (i.inhrelid = c.oid) "
+            "JOIN pg_class p on (i.inhparent = p.oid) "
+            "where p.relname = 'iembot_social_log'"
+        )
+    )
+    bounds = []
+    for relname, bound in res.fetchall():
+        match = UPPER_BOUND.search(bound)
+        upper = None if match is None else date.fromisoformat(match.group(1))
+        bounds.append((relname, upper))
+    return bounds
+
+
+def create_partitions(conn: Connection, today: date, ahead: int):
+    """Create the daily partitions of today and the days ahead.
+
+    The days already covered, like today by the legacy partition right
+    after the migration, are skipped.
+    """
+    uppers = [upper for _, upper in partition_bounds(conn) if upper]
+    start = max([today, *uppers])
+    for offset in range((today + timedelta(days=ahead) - start).days + 1):
+        day = start + timedelta(days=offset)
+        conn.execute(
+            sql_helper(
+                "create table if not exists {table} partition of "
+                "iembot_social_log for values from ({start}) to ({end})",
+                table=partition_name(day),
+                start=f"'{day:%Y-%m-%d}'",
+                end=f"'{day + timedelta(days=1):%Y-%m-%d}'",
+            )
+        )
+
+
+def drop_partitions(conn: Connection, cutoff: date) -> int:
+    """Drop the partitions wholly before the cutoff, returning how many."""
+    dropped = 0
+    for relname, upper in partition_bounds(conn):
+        # The DEFAULT partition has no bound
+        if upper is None or upper > cutoff:
+            continue
+        LOG.info("Dropping partition %s before %s", relname, upper)
+        conn.execute(sql_helper("drop table {table}", table=relname))
+        dropped += 1
+    return dropped
+
+
+@click.command()
+@click.option("--days", default=10, help="Days of logs to keep")
+@click.option("--ahead", default=7, help="Days of partitions to create")
 @with_sqlalchemy_conn("iembot")
-def main(conn: Connection | None = None):
-    """Run for a given username"""
+def main(days: int, ahead: int, conn: Connection | None = None):
+    """Trim the log and, when partitioned, maintain its partitions."""
+    if is_partitioned(conn):
+        today = date.today()
+        create_partitions(conn, today, ahead)
+        dropped = drop_partitions(conn, today - timedelta(days=days))
+        LOG.info("Dropped %s iembot_social_log partitions", dropped)
+        conn.commit()
+        return
     res = conn.execute(
         sql_helper(
             "delete from iembot_social_log "
-            "where valid < now() - '10 days'::interval"
-        )
+            "where valid < now() - make_interval(days => :days)"
+        ),
+        {"days": days},
     )
     LOG.info("Removed %s rows from iembot_social_log", res.rowcount)
     conn.commit()
@@ -0,0 +1,189 @@
+"""Asynchronous HTTP POSTs for the webhook and Slack deliveries.
+
+These deliveries are simple JSON POSTs, so rather than holding a pool
+thread for each round trip they are made with Twisted's ``Agent`` on the
+reactor.  Connections are kept alive within an ``HTTPConnectionPool``, each
+host has at most ``bot.http.concurrency`` requests in flight (the others
+wait their turn) and a request, body included, is cancelled after
+``bot.http.timeout`` seconds.
+"""
+
+from __future__ import annotations
+
+from io import BytesIO
+from urllib.parse import urlparse
+
+from twisted.internet import defer, error, reactor
+from twisted.python.failure import Failure
+from twisted.web.client import (
+    Agent,
+    FileBodyProducer,
+    HTTPConnectionPool,
+    ResponseFailed,
+    ResponseNeverReceived,
+    readBody,
+)
+from twisted.web.http_headers import Headers
+
+# Requests in flight per host
+HOST_CONCURRENCY = 8
+# Seconds for a request, including reading the response
+TIMEOUT = 10
+# Seconds to establish a connection
+CONNECT_TIMEOUT = 5
+# Seconds an unused connection is kept
+IDLE_TIMEOUT = 240
+
+
+class HTTPStatusError(Exception):
+    """Raised for a non-2xx response.
+
+    Attributes:
+        code (int): the HTTP status code.
+        body (bytes): the response body.
+    """
+
+    def __init__(self, url: str, code: int, body: bytes):
+        """Constructor."""
+        super().__init__(f"{url} returned HTTP {code}: {body[:100]!r}")
+        self.code = code
+        self.body = body
+
+
+# Failures worth trying again later
+TRANSIENT_ERRORS = (
+    HTTPStatusError,
+    defer.TimeoutError,
+    error.ConnectError,
+    error.ConnectionLost,
+    ResponseFailed,
+    ResponseNeverReceived,
+)
+
+
+def _timed_out(_result, timeout: float):
+    """Fail a cancelled request, whatever the cancellation raised."""
+    raise defer.TimeoutError(f"HTTP request took longer than {timeout}s")
+
+
+class AsyncHTTPClient:
+    """An ``Agent`` with per-host concurrency limits and timeouts.
+
+    Attributes:
+        concurrency (int): requests in flight per host.
+        timeout (float): seconds for a request.
+        requests (int): requests made.
+        failures (int): requests failed, timeouts included.
+        timeouts (int): requests cancelled as too slow.
+        inflight (int): requests in flight.
+        waiting (int): requests waiting for their host's limit.
+    """
+
+    def __init__(
+        self,
+        concurrency: int = HOST_CONCURRENCY,
+        timeout: float = TIMEOUT,
+        clock=None,
+    ):
+        """Constructor."""
+        self.clock = clock or reactor
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.pool = HTTPConnectionPool(self.clock, persistent=True)
+        self.pool.maxPersistentPerHost = concurrency
+        self.pool.cachedConnectionTimeout = IDLE_TIMEOUT
+        self.agent = Agent(
+            self.clock, connectTimeout=CONNECT_TIMEOUT, pool=self.pool
+        )
+        # host -> DeferredSemaphore, while it has requests
+        self._limits: dict[str, defer.DeferredSemaphore] = {}
+        self.requests = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.inflight = 0
+        self.waiting = 0
+
+    def post(
+        self, url: str, body: bytes, headers: dict[str, str] | None = None
+    ) -> defer.Deferred:
+        """POST the body to the url.
+
+        Returns:
+            Deferred: firing with the response body, or failing with one of
+              ``TRANSIENT_ERRORS``.
+        """
+        host = urlparse(url).netloc
+        limit = self._limits.get(host)
+        if limit is None:
+            limit = defer.DeferredSemaphore(self.concurrency)
+            self._limits[host] = limit
+        self.waiting += 1
+        df = limit.run(self._post, url, body, headers or {})
+        df.addBoth(self._done, host, limit)
+        return df
+
+    def _post(self, url: str, body: bytes, headers: dict[str, str]):
+        """Make the request, once allowed by the host's limit."""
+        self.waiting -= 1
+        self.inflight += 1
+        self.requests += 1
+        df = self.agent.request(
+            b"POST",
+            url.encode("utf-8"),
+            Headers({key: [value] for key, value in headers.items()}),
+            FileBodyProducer(BytesIO(body)),
+        )
+        df.addCallback(self._read, url)
+        df.addTimeout(self.timeout, self.clock, onTimeoutCancel=_timed_out)
+        return df
+
+    def _read(self, response, url: str) -> defer.Deferred:
+        """Read the response body, failing for a non-2xx status."""
+        df = readBody(response)
+
+        def _check(body: bytes) -> bytes:
+            if not 200 <= response.code < 300:
+                raise HTTPStatusError(url, response.code, body)
+            return body
+
+        df.addCallback(_check)
+        return df
+
+    def _done(self, res, host: str, limit: defer.DeferredSemaphore):
+        """Account for a finished request, passing its result on."""
+        self.inflight -= 1
+        if isinstance(res, Failure):
+            self.failures += 1
+            if res.check(defer.TimeoutError):
+                self.timeouts += 1
+        # Forget the limit of a host without requests
+        if limit.tokens == limit.limit and not limit.waiting:
+            self._limits.pop(host, None)
+        return res
+
+    def close(self) -> defer.Deferred:
+        """Close the kept alive connections."""
+        return self.pool.closeCachedConnections()
+
+    def stats(self) -> dict[str, int]:
+        """Return the bookkeeping for the status endpoint."""
+        return {
+            "http.requests": self.requests,
+            "http.failures": self.failures,
+            "http.timeouts": self.timeouts,
+            "http.inflight": self.inflight,
+            "http.waiting": self.waiting,
+            "http.hosts": len(self._limits),
+        }
+
+
+HTTP_CLIENT = AsyncHTTPClient()
+
+
+def configure_http(config: dict):
+    """Set the limits with the settings found within the config."""
+    HTTP_CLIENT.concurrency = int(
+        config.get("bot.http.concurrency", HOST_CONCURRENCY)
+    )
+    HTTP_CLIENT.pool.maxPersistentPerHost = HTTP_CLIENT.concurrency
+    HTTP_CLIENT.timeout = float(config.get("bot.http.timeout", TIMEOUT))
@@ -4,106 +4,188 @@ Need to do some hackery to workaround threadsafety issues with the
 atproto module and my general lack of understanding of how to do
 threadsafety in Python.  So this is on me.
 
+Each account's client is only used by one thread at a time, the
+:class:`ATManager` hands an account with messages waiting to one of a fixed
+number of workers, which keeps the messages of an account in order.
+
+The sessions of the accounts are kept within an :class:`ATSessionStore`
+file, so a restart resumes them rather than logging in with the app
+password again.
+
 """
 
+import json
+import os
 import threading
+from collections import deque
 from functools import partial
 from queue import Queue
-from time import sleep
 
-import requests
-from atproto import Client
+from atproto import Client, SessionEvent
 from atproto_client.exceptions import InvokeTimeoutError, RequestException
 from atproto_client.utils import TextBuilder
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
 from twisted.python import log
-from twisted.words.xish.domish import Element
 
+from iembot.media import prepare_media
+from iembot.message import IngestMessage
+from iembot.retry import RETRY_POLICIES, RetryableError, RetryPolicy
+from iembot.routing import RoutingSnapshot, RoutingTable
 from iembot.types import JabberClient
-from iembot.util import build_channel_subs, safe_twitter_text
+from iembot.util import account_filter, build_channel_subs
 
 
-def _at_helper(
-    func: callable,
-    *args,
-    retry_sleep_seconds: int = 30,
-    sleeper=sleep,
-    **kwargs,
-):
-    """Help with the client call."""
-    for attempt in range(2):
+def _at_helper(func: callable, *args, **kwargs):
+    """Help with the client call, server errors are to be retried."""
+    try:
+        return func(*args, **kwargs)
+    except RequestException as exp:
+        if exp.response is not None and exp.response.status_code >= 500:
+            raise RetryableError(
+                f"AT server error {exp.response.status_code}"
+            ) from exp
+        raise
+
+
+# Threads sending the messages of all accounts
+WORKERS = 8
+# The most messages an account may have waiting
+MAX_BACKLOG = 100
+
+
+def _schedule_retry(delay: float, func: callable, *args):
+    """Call ``func`` after a delay, called from a worker thread."""
+    reactor.callFromThread(reactor.callLater, delay, func, *args)
+
+
+class ATBacklogFull(Exception):
+    """Raised when an account's backlog bound is reached."""
+
+
+class ATSessionStore:
+    """A JSON file of the exported session strings, keyed by handle.
+
+    The session strings are credentials, so the file is only readable by
+    its owner.  Changes are written at once, as they are rare.
+    """
+
+    def __init__(self, path: str):
+        """Constructor."""
+        self.path = path
+        self.lock = threading.Lock()
+        self.sessions: dict[str, str] = {}
+
+    def load(self):
+        """Read the file, blocking at startup."""
         try:
-            return func(*args, **kwargs)
-        except RequestException as exp:
-            if (
-                exp.response is not None
-                and exp.response.status_code >= 500
-                and attempt == 0
-            ):
-                sleeper(retry_sleep_seconds)
-                continue
-            raise
+            with open(self.path, encoding="utf-8") as fh:
+                self.sessions = json.load(fh)
+        except FileNotFoundError:
+            self.sessions = {}
+        except ValueError as exp:
+            log.msg(f"Ignoring unreadable {self.path}: {exp}")
+            self.sessions = {}
+        log.msg(f"{self.path} has {len(self.sessions)} AT sessions")
 
+    def get(self, at_handle: str) -> str | None:
+        """Return the session string of an account, if any."""
+        with self.lock:
+            return self.sessions.get(at_handle)
+
+    def put(self, at_handle: str, session: str):
+        """Keep the session string of an account."""
+        with self.lock:
+            if self.sessions.get(at_handle) == session:
+                return
+            self.sessions[at_handle] = session
+            self._write()
+
+    def discard(self, at_handle: str):
+        """Forget the session string of an account."""
+        with self.lock:
+            if self.sessions.pop(at_handle, None) is not None:
+                self._write()
+
+    def _write(self):
+        """Replace the file, the lock being held."""
+        tmpfn = f"{self.path}.tmp"
+        fd = os.open(tmpfn, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w", encoding="utf-8") as fh:
+            json.dump(self.sessions, fh)
+        os.replace(tmpfn, self.path)
 
-class ATWorkerThread(threading.Thread):
-    """The Worker."""
+
+class ATAccount:
+    """A Bluesky account, its client and its backlog of messages.
+
+    The client is used by one worker at a time, as an account with a
+    message being processed is not handed to another worker.
+
+    Attributes:
+        backlog (deque): messages waiting for a worker.
+        active (bool): the account is queued for or held by a worker.
+        dropped (int): messages refused as the backlog was full.
+        logins (int): logins with the app password.
+        resumes (int): logins resuming a stored session.
+    """
 
     def __init__(
         self,
-        queue: Queue,
         at_handle: str,
         at_password: str,
         message_callback: callable,
-        retry_sleep_seconds: int = 30,
-        sleeper=sleep,
+        sessions: ATSessionStore | None = None,
     ):
         """Constructor."""
-        threading.Thread.__init__(self)
-        self.queue = queue
         self.at_handle = at_handle
         self.at_password = at_password
-        self.retry_sleep_seconds = retry_sleep_seconds
-        self.sleeper = sleeper
         self.message_callback = message_callback
+        self.sessions = sessions
         self.logged_in = False
         self.client = Client()
-        self.daemon = True  # Don't block on shutdown
+        self.client.on_session_change(self.session_changed)
+        self.backlog: deque[dict] = deque()
+        self.active = False
+        self.dropped = 0
+        self.logins = 0
+        self.resumes = 0
 
-    def run(self):
-        """Listen for messages from the queue."""
-        while True:
-            message = self.queue.get()
-            try:
-                if message is None:
-                    break
+    def session_changed(self, event: SessionEvent, session):
+        """Keep a created or refreshed session, called by the client."""
+        if self.sessions is None or event == SessionEvent.IMPORT:
+            return
+        self.sessions.put(self.at_handle, session.export())
 
-                error_counter = 0
-                while True:
-                    try:
-                        self.process_message(message)
-                        break
-                    except InvokeTimeoutError:
-                        error_counter += 1
-                        log.msg(
-                            f"AT request timed out for {self.at_handle}, "
-                            "sleeping "
-                            f"{self.retry_sleep_seconds} and try again, "
-                            f"error count {error_counter}"
-                        )
-                        if error_counter > 5:
-                            log.msg(
-                                f"Too many timeouts for {self.at_handle}, "
-                                f"aborting message {message}"
-                            )
-                            break
-                        self.sleeper(self.retry_sleep_seconds)
-                    # If something happens, best just to trigger a login
-                    # again?
-                    except Exception as exp:
-                        log.err(exp)
-                        self.logged_in = False
-                        break
-            finally:
-                self.queue.task_done()
+    def login(self, **kwargs):
+        """Resume the stored session, else login with the app password."""
+        session = None
+        if self.sessions is not None:
+            session = self.sessions.get(self.at_handle)
+        if session is not None:
+            log.msg(f"Resuming session of {self.at_handle}...")
+            try:
+                me = _at_helper(
+                    self.client.login, session_string=session, **kwargs
+                )
+                self.resumes += 1
+            except RetryableError:
+                raise
+            except Exception as exp:
+                log.msg(f"Resuming session of {self.at_handle} failed {exp}")
+                self.sessions.discard(self.at_handle)
+                session = None
+        if session is None:
+            log.msg(f"Logging in as {self.at_handle}...")
+            me = _at_helper(
+                self.client.login,
+                self.at_handle,
+                self.at_password,
+                **kwargs,
+            )
+            self.logins += 1
+        log.msg(repr(me))
+        self.logged_in = True
 
     def process_message(self, msgdict: dict, **kwargs):
         """Process the message."""
@@ -111,29 +193,16 @@ class ATWorkerThread(threading.Thread):
         imgbytes = None
         if media is not None:
             try:
-                resp = requests.get(media, timeout=30)
-                resp.raise_for_status()
-                imgbytes = resp.content
                 # AT has a size limit of 976.56KB
-                if len(imgbytes) > 1_000_000:
-                    log.msg(f"{media} is too large({len(imgbytes)}) for AT")
-                    imgbytes = None
+                imgbytes = prepare_media(media, "atmosphere")
+                if imgbytes is None:
+                    log.msg(f"{media} could not be fit within the AT limits")
             except Exception as exp:
                 log.err(exp)
 
         # Do we need to login?
         if not self.logged_in:
-            log.msg(f"Logging in as {self.at_handle}...")
-            me = _at_helper(
-                self.client.login,
-                self.at_handle,
-                self.at_password,
-                retry_sleep_seconds=self.retry_sleep_seconds,
-                sleeper=self.sleeper,
-                **kwargs,
-            )
-            log.msg(repr(me))
-            self.logged_in = True
+            self.login(**kwargs)
 
         msg = msgdict["msg"]
         if msg.find("http") > -1:
@@ -147,8 +216,6 @@ class ATWorkerThread(threading.Thread):
                     msg,
                     image=imgbytes,
                     image_alt="IEMBot Image",
-                    retry_sleep_seconds=self.retry_sleep_seconds,
-                    sleeper=self.sleeper,
                     **kwargs,
                 )
                 return
@@ -157,29 +224,89 @@ class ATWorkerThread(threading.Thread):
                     f"Uploading message with image failed {exp}, "
                     "trying without"
                 )
-        resp = _at_helper(
-            self.client.send_post,
-            msg,
-            retry_sleep_seconds=self.retry_sleep_seconds,
-            sleeper=self.sleeper,
-            **kwargs,
-        )
+        resp = _at_helper(self.client.send_post, msg, **kwargs)
         self.message_callback(resp)
 
 
+class ATWorkerThread(threading.Thread):
+    """A pool worker, serving the accounts with messages in turn."""
+
+    def __init__(self, manager: "ATManager", number: int):
+        """Constructor."""
+        threading.Thread.__init__(self, name=f"iembot-atmosphere-{number}")
+        self.manager = manager
+        self.daemon = True  # Don't block on shutdown
+
+    def run(self):
+        """Work on the accounts found on the ready queue."""
+        while True:
+            at_handle = self.manager.ready.get()
+            try:
+                if at_handle is None:
+                    break
+                self.manager.work(at_handle)
+            # Never lose a worker to a bug
+            except Exception as exp:
+                log.err(exp, f"AT worker failed on {at_handle}")
+            finally:
+                self.manager.ready.task_done()
+
+
 class ATManager:
-    """Ensure the creation of clients and submission of tasks is threadsafe."""
+    """Keyed serial queues of the accounts, multiplexed over a few workers.
+
+    Each account keeps its messages in order within its own bounded backlog
+    and is put on the shared ready queue when it has messages and no worker,
+    so the thread count does not grow with the number of accounts.
+
+    Attributes:
+        at_clients (dict): at_handle -> ATAccount.
+        ready (Queue): accounts with messages waiting for a worker.
+        size (int): the number of workers.
+        max_backlog (int): the most messages an account may have waiting.
+        sessions (ATSessionStore): where the sessions are kept, if anywhere.
+    """
 
     def __init__(
         self,
-        retry_sleep_seconds: int = 30,
-        sleeper=sleep,
+        workers: int = WORKERS,
+        max_backlog: int = MAX_BACKLOG,
+        policy: RetryPolicy | None = None,
+        scheduler=_schedule_retry,
     ):
-        """Constructor."""
-        self.at_clients = {}
+        """Constructor.
+
+        Args:
+            workers (int): the number of worker threads.
+            max_backlog (int): the most messages an account may have waiting.
+            policy (RetryPolicy, optional): overrides the atmosphere policy.
+            scheduler (callable): schedules ``func(*args)`` after a delay.
+        """
+        self.at_clients: dict[str, ATAccount] = {}
         self.lock = threading.Lock()
-        self.retry_sleep_seconds = retry_sleep_seconds
-        self.sleeper = sleeper
+        self.ready: Queue = Queue()
+        self.size = workers
+        self.max_backlog = max_backlog
+        self.policy = policy
+        self.scheduler = scheduler
+        self.sessions: ATSessionStore | None = None
+        self.workers: list[ATWorkerThread] = []
+
+    def start(self):
+        """Start the workers, if not already."""
+        with self.lock:
+            if self.workers:
+                return
+            self.workers = [
+                ATWorkerThread(self, number) for number in range(self.size)
+            ]
+        for worker in self.workers:
+            worker.start()
+
+    def stop(self):
+        """Ask the workers to stop once the ready queue is done."""
+        for _ in self.workers:
+            self.ready.put(None)
 
     def add_client(
         self, at_handle: str, at_password: str, message_callback: callable
@@ -188,79 +315,286 @@ class ATManager:
         if at_handle in self.at_clients:
             return
         with self.lock:
-            self.at_clients[at_handle] = ATWorkerThread(
-                Queue(),
-                at_handle,
-                at_password,
-                message_callback,
-                retry_sleep_seconds=self.retry_sleep_seconds,
-                sleeper=self.sleeper,
+            self.at_clients[at_handle] = ATAccount(
+                at_handle, at_password, message_callback, self.sessions
             )
-            self.at_clients[at_handle].start()
+        self.start()
 
-    def submit(self, at_handle: str, message: dict):
-        """Submit a message to the client."""
-        self.at_clients[at_handle].queue.put(message)
+    def reconcile(
+        self,
+        accounts: dict[str, tuple[str, callable]],
+        scope: set[str] | None = None,
+    ):
+        """Match the clients to the accounts found within the database.
 
+        Clients of removed accounts are stopped, those with a changed app
+        password login again and new accounts are added.
 
-def load_atmosphere_from_db(txn, bot: JabberClient):
-    """Query database for our config."""
-    bot.at_routingtable = build_channel_subs(
-        txn,
-        "iembot_atmosphere_accounts",
-    )
+        Args:
+            accounts (dict): at_handle -> (at_password, message_callback).
+            scope (set, optional): the handles that were loaded, when only
+              some accounts were, otherwise all clients are considered.
+        """
+        removed = []
+        with self.lock:
+            candidates = set(self.at_clients) if scope is None else scope
+            for at_handle in candidates - set(accounts):
+                account = self.at_clients.pop(at_handle, None)
+                if account is not None:
+                    removed.append(account)
+            for at_handle, (at_password, callback) in accounts.items():
+                account = self.at_clients.get(at_handle)
+                if account is None:
+                    log.msg(f"Adding AT client for {at_handle}")
+                    self.at_clients[at_handle] = ATAccount(
+                        at_handle, at_password, callback, self.sessions
+                    )
+                    continue
+                account.message_callback = callback
+                if account.at_password != at_password:
+                    log.msg(f"App password of {at_handle} changed")
+                    account.at_password = at_password
+                    account.logged_in = False
+                    if self.sessions is not None:
+                        self.sessions.discard(at_handle)
+        for account in removed:
+            self.remove(account)
+        if self.at_clients:
+            self.start()
+
+    def remove(self, account: ATAccount):
+        """Stop a removed client, dropping its backlog."""
+        log.msg(f"Removing AT client for {account.at_handle}")
+        with self.lock:
+            messages = list(account.backlog)
+            account.backlog.clear()
+        for message in messages:
+            self.finish(message)
+        if self.sessions is not None:
+            self.sessions.discard(account.at_handle)
+
+    def submit(self, at_handle: str, message: dict, retry: bool = False):
+        """Submit a message to the client.
+
+        A message for a client removed meanwhile, like an outbox replay or
+        a retry, is finished without being sent.
+
+        Raises:
+            ATBacklogFull: when the account has too many messages waiting,
+              which retries are exempt from.
+        """
+        account = self.at_clients.get(at_handle)
+        if account is None:
+            log.msg(f"Dropping message for removed AT client {at_handle}")
+            self.finish(message)
+            return
+        with self.lock:
+            if not retry and len(account.backlog) >= self.max_backlog:
+                account.dropped += 1
+                raise ATBacklogFull(f"{at_handle} backlog is full")
+            account.backlog.append(message)
+            if account.active:
+                return
+            account.active = True
+        self.ready.put(at_handle)
+
+    def work(self, at_handle: str):
+        """Process the next message of an account, within a worker."""
+        account = self.at_clients.get(at_handle)
+        if account is None:
+            return
+        with self.lock:
+            # A handle removed and added again has a new, maybe empty, account
+            if not account.backlog:
+                account.active = False
+                return
+            message = account.backlog.popleft()
+        try:
+            account.process_message(message)
+            self.finish(message)
+        except (InvokeTimeoutError, RetryableError) as exp:
+            if self.retry(account, message, exp):
+                # The account stays active, holding its messages in order
+                return
+        # If something happens, best just to trigger a login again?
+        except Exception as exp:
+            log.err(exp)
+            account.logged_in = False
+            self.finish(message)
+        with self.lock:
+            account.active = bool(account.backlog)
+        if account.active:
+            self.ready.put(at_handle)
+
+    def resume(self, account: ATAccount, message: dict):
+        """Put a retried message first again and let the account work."""
+        with self.lock:
+            current = self.at_clients.get(account.at_handle) is account
+            if current:
+                account.backlog.appendleft(message)
+        if not current:
+            log.msg(
+                f"Dropping retry for removed AT client {account.at_handle}"
+            )
+            self.finish(message)
+            return
+        self.ready.put(account.at_handle)
+
+    def retry(self, account: ATAccount, message: dict, exp: Exception) -> bool:
+        """Try the message again later, rather than sleeping.
+
+        The account is held meanwhile, so its newer messages wait.
+
+        Returns:
+            bool: whether the message will be tried again.
+        """
+        policy = self.policy or RETRY_POLICIES["atmosphere"]
+        attempt = message.get("attempt", 1)
+        if attempt >= policy.attempts:
+            log.msg(
+                f"Too many failures for {account.at_handle}, "
+                f"aborting message {message}"
+            )
+            self.finish(message)
+            return False
+        delay = policy.next_delay(attempt)
+        log.msg(
+            f"AT request failed for {account.at_handle} with {exp!r}, "
+            f"trying again in {delay:.1f}s, attempt {attempt}"
+        )
+        self.scheduler(
+            delay, self.resume, account, {**message, "attempt": attempt + 1}
+        )
+        return True
+
+    def finish(self, message: dict):
+        """Fire the message's ``done`` Deferred on the reactor, if any."""
+        done = message.get("done")
+        if done is not None:
+            self.scheduler(0, done.callback, None)
+
+    def backlog(self) -> dict[str, int]:
+        """Return the messages waiting per account, of those with any."""
+        with self.lock:
+            return {
+                at_handle: len(account.backlog)
+                for at_handle, account in self.at_clients.items()
+                if account.backlog
+            }
+
+    def stats(self) -> dict[str, int]:
+        """Return the bookkeeping for the status endpoint."""
+        backlog = self.backlog()
+        res = {
+            "atmosphere.workers": len(self.workers),
+            "atmosphere.accounts": len(self.at_clients),
+            "atmosphere.backlog": sum(backlog.values()),
+            "atmosphere.dropped": sum(
+                account.dropped for account in self.at_clients.values()
+            ),
+            "atmosphere.logins": sum(
+                account.logins for account in self.at_clients.values()
+            ),
+            "atmosphere.resumes": sum(
+                account.resumes for account in self.at_clients.values()
+            ),
+        }
+        for at_handle, count in backlog.items():
+            res[f"atmosphere.backlog.{at_handle}"] = count
+        return res
+
+
+def load_atmosphere_from_db(
+    txn,
+    _bot: JabberClient,
+    iembot_account_id: int | None = None,
+    subs: dict | None = None,
+) -> RoutingSnapshot:
+    """Query database for our config, called from a thread."""
+    if subs is None:
+        subs = build_channel_subs(txn, "atmosphere", iembot_account_id)
+    table = RoutingTable.compile(*subs)
+    acct_sql, params = account_filter("a", iembot_account_id)
 
     users = {}
     txn.execute(
-        """
+        f"""
     SELECT iembot_account_id, handle, app_pass from
-    iembot_atmosphere_accounts
-    """
+    iembot_atmosphere_accounts a WHERE handle is not null{acct_sql}
+    """,
+        params,
     )
     for row in txn.fetchall():
         user_id = row["iembot_account_id"]
         users[user_id] = {
             "at_handle": row["handle"],
+            "at_password": row["app_pass"],
         }
-        msgcb = partial(bot.log_iembot_social_log, row["iembot_account_id"])
-        bot.at_manager.add_client(row["handle"], row["app_pass"], msgcb)
-    bot.at_users = users
     log.msg(f"load_atmosphere_from_db(): {txn.rowcount} accounts found")
+    return RoutingSnapshot("atmosphere", table, users)
+
+
+def reconcile_atmosphere(
+    bot: JabberClient, users: dict, scope: set[str] | None = None
+):
+    """Match the clients to the loaded accounts, on the reactor thread.
+
+    Done as the snapshot is swapped in, so a handle is only resolved by
+    ``at_send_message`` while its client exists.
 
+    Args:
+      bot (JabberClient): the running bot.
+      users (dict): the ``at_users`` that were loaded.
+      scope (set, optional): the handles that were loaded, when only some
+        accounts were.
+    """
+    accounts = {
+        meta["at_handle"]: (
+            meta["at_password"],
+            partial(bot.log_iembot_social_log, user_id),
+        )
+        for user_id, meta in users.items()
+    }
+    bot.at_manager.reconcile(accounts, scope)
+
+
+def at_send_message(
+    bot: JabberClient, iembot_account_id, msg: str, **kwargs
+) -> Deferred | None:
+    """Send a message to the ATmosphere.
 
-def at_send_message(bot: JabberClient, iembot_account_id, msg: str, **kwargs):
-    """Send a message to the ATmosphere."""
+    Returns:
+        Deferred firing once the worker is done with the message.
+    """
     at_handle = bot.at_users.get(iembot_account_id, {}).get("at_handle")
     if at_handle is None:
-        return
+        return None
     message = {"msg": msg}
     message.update(kwargs)
-    bot.at_manager.submit(at_handle, message)
+    message["done"] = Deferred()
+    try:
+        bot.at_manager.submit(at_handle, message)
+    except ATBacklogFull as exp:
+        log.msg(f"Dropping message for {iembot_account_id}: {exp}")
+        return None
+    return message["done"]
 
 
-def route(bot: JabberClient, channels: list, elem: Element):
+def route(bot: JabberClient, message: IngestMessage):
     """Do the message routing."""
     # Require the x.twitter attribute to be set to prevent
     # confusion with some ingestors still sending tweets themself
-    if not elem.x or not elem.x.hasAttribute("twitter"):
+    if message.twitter_text is None:
         return
 
-    lat = elem.x.getAttribute("lat")
-    long = elem.x.getAttribute("long")
-    twitter_media = elem.x.getAttribute("twitter_media")
-    txt = safe_twitter_text(elem.x["twitter"])
-
-    alerted = []
-    for channel in channels:
-        for iembot_account_id in bot.at_routingtable.get(channel, []):
-            if iembot_account_id in alerted:
-                continue
-            alerted.append(iembot_account_id)
-            at_send_message(
-                bot,
-                iembot_account_id,
-                txt,
-                twitter_media=twitter_media,
-                latitude=lat,
-                longitude=long,
-            )
+    for iembot_account_id in bot.fanout.resolve(message.channels)[
+        "atmosphere"
+    ]:
+        bot.deliver(
+            "atmosphere",
+            iembot_account_id,
+            message.twitter_text,
+            twitter_media=message.twitter_media,
+            latitude=message.lat,
+            longitude=message.long,
+        )
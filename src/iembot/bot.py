@@ -8,7 +8,6 @@ import traceback
 from datetime import timedelta
 from io import StringIO
 from pathlib import Path
-from xml.etree import ElementTree as ET
 
 from pyiem.util import utc
 from twisted.application import internet
@@ -20,20 +19,38 @@ from twisted.python import log
 from twisted.python.logfile import DailyLogFile
 from twisted.words.protocols.jabber import client, jid, xmlstream
 from twisted.words.xish import xpath
-from twisted.words.xish.domish import Element
+from twisted.words.xish.domish import Element, escapeToXml
 
 from iembot import DATADIR
+from iembot.atmosphere import (
+    MAX_BACKLOG as AT_MAX_BACKLOG,
+)
+from iembot.atmosphere import (
+    WORKERS as AT_WORKERS,
+)
 from iembot.atmosphere import (
     ATManager,
+    at_send_message,
     load_atmosphere_from_db,
+    reconcile_atmosphere,
 )
-from iembot.mastodon import load_mastodon_from_db
+from iembot.executors import defer_to_executor
+from iembot.mastodon import load_mastodon_from_db, toot
 from iembot.msghandlers import (
     process_groupchat,
     process_privatechat,
 )
+from iembot.pending import SIZE as PENDING_SIZE
+from iembot.pending import TTL as PENDING_TTL
+from iembot.pending import PendingSends
+from iembot.routing import GROUPS, FanoutIndex, RoutingSnapshot
 from iembot.slack import load_slack_from_db
-from iembot.twitter import load_twitter_from_db
+from iembot.slack import send as slack_send
+from iembot.sociallog import BATCH as SOCIAL_LOG_BATCH
+from iembot.sociallog import FLUSH_MS as SOCIAL_LOG_FLUSH_MS
+from iembot.sociallog import MAX_BUFFER as SOCIAL_LOG_BUFFER
+from iembot.sociallog import SocialLogWriter
+from iembot.twitter import load_twitter_from_db, tweet
 from iembot.types import JabberClient as JabberClientType
 from iembot.util import (
     channels_room_add,
@@ -41,10 +58,34 @@ from iembot.util import (
     channels_room_list,
     daily_timestamp,
     email_error,
+    join_chatrooms,
+    load_channel_groups_from_db,
     load_chatlog,
     load_chatrooms_from_db,
+    load_fingerprints_from_db,
+    load_subscriptions_from_db,
+    xml_error,
 )
-from iembot.webhooks import load_webhooks_from_db
+from iembot.webhooks import hook, load_webhooks_from_db
+
+# transport -> function loading its RoutingSnapshot
+LOADERS = {
+    "xmpp": load_chatrooms_from_db,
+    "twitter": load_twitter_from_db,
+    "mastodon": load_mastodon_from_db,
+    "atmosphere": load_atmosphere_from_db,
+    "slack": load_slack_from_db,
+    "webhooks": load_webhooks_from_db,
+    GROUPS: load_channel_groups_from_db,
+}
+# transport -> function delivering a message, see JabberClient.deliver
+DELIVERERS = {
+    "twitter": tweet,
+    "mastodon": toot,
+    "atmosphere": at_send_message,
+    "slack": slack_send,
+    "webhooks": hook,
+}
 
 # http://stackoverflow.com/questions/7016602
 SMTPSenderFactory.noisy = False
@@ -55,6 +96,53 @@ PRESENCE_MUC_ITEM = (
 PRESENCE_MUC_STATUS = (
     "/presence/x[@xmlns='http://jabber.org/protocol/muc#user']/status"
 )
+# Stands in for the recipient within a serialized groupchat fanout
+FANOUT_TO = "{iembot-fanout-to}"
+# The most groupchat contents with a cached well-formedness check
+XML_CHECKS = 1024
+# transport -> JabberClient attribute holding its account metadata
+ACCOUNT_ATTRS = {
+    "twitter": "tw_users",
+    "mastodon": "md_users",
+    "atmosphere": "at_users",
+    "slack": "slack_teams",
+    "webhooks": "webhook_users",
+}
+# Tables, beyond SUBSCRIPTION_TABLES, loaded by each transport
+RELOAD_TABLES = {
+    "xmpp": ("iembot_rooms",),
+    "twitter": ("iembot_twitter_oauth",),
+    "mastodon": ("iembot_mastodon_oauth",),
+    "atmosphere": ("iembot_atmosphere_accounts",),
+    "slack": ("iembot_slack_teams", "iembot_slack_team_channels"),
+    "webhooks": ("iembot_webhooks",),
+    GROUPS: ("iembot_channel_group_membership",),
+}
+SUBSCRIPTION_TABLES = ("iembot_channels", "iembot_subscriptions")
+
+
+def load_transports_from_db(
+    txn, bot: JabberClientType, transports: tuple[str, ...]
+) -> list[RoutingSnapshot]:
+    """Load many transports, sharing one subscriptions query, in a thread.
+
+    Each loader runs within its own savepoint, so a failing one only skips
+    its transport, which keeps its previous routing until the next reload.
+    """
+    accounts = tuple(t for t in transports if t != GROUPS)
+    subs = load_subscriptions_from_db(txn, accounts) if accounts else {}
+    snapshots = []
+    for transport in transports:
+        txn.execute("SAVEPOINT load_transport")
+        try:
+            snapshot = LOADERS[transport](txn, bot, subs=subs.get(transport))
+        except Exception as exp:
+            txn.execute("ROLLBACK TO SAVEPOINT load_transport")
+            log.err(exp, f"Loading the {transport} transport failed")
+            continue
+        txn.execute("RELEASE SAVEPOINT load_transport")
+        snapshots.append(snapshot)
+    return snapshots
 
 
 class JabberClient(JabberClientType):
@@ -69,19 +157,29 @@ class JabberClient(JabberClientType):
         config (dict): Runtime configuration key/value mapping.
         outstanding_pings (list): Ping tracking list for keepalive logic.
         rooms (dict): Mapping of room name to room metadata.
+        room_jids (dict): room name -> its escaped JID bytes.
+        xml_checks (dict): (plain, htmlstr) -> the error found parsing a
+            groupchat with this content, ``None`` when well-formed.
+        xml_checks_hits (int): groupchats whose check was cached.
         chatlog (dict): In-memory chat log storage keyed by room.
         seqnum (int): Latest chat log sequence number.
-        routingtable (dict): Channel routing table for room subscriptions.
+        fanout (FanoutIndex): Channel to per-transport subscription index.
+        social_log (SocialLogWriter): Buffered iembot_social_log writer.
+        pending (PendingSends): groupchats waiting for their room's join.
         at_manager (ATManager): ATmosphere message manager.
         tw_users (dict): Twitter user map keyed by user_id.
-        tw_routingtable (dict): Twitter routing map keyed by channel.
         at_users (dict): Atmosphere user map keyed by user_id.
-        at_routingtable (dict): Atmosphere routing map keyed by channel.
         md_users (dict): Mastodon user map keyed by user_id.
-        md_routingtable (dict): Mastodon routing map keyed by channel.
         slack_teams (dict): Slack teams.
-        slack_routingtable (dict): Slack routing map keyed by channel.
-        webhooks_routingtable (dict): Webhooks routing map keyed by channel.
+        webhook_users (dict): Webhook url map keyed by iembot_account_id.
+        notify_listener (NotifyListenerThread | None): Listener applying
+            subscription changes incrementally, when enabled.
+        fingerprints (dict): transport -> table fingerprints when loaded.
+        reload_inflight (Deferred | None): the running ``reload_config``.
+        reload_pending (bool | None): ``always_join`` of a coalesced reload
+            to run once the inflight one finishes.
+        reload_coalesced (int): reload requests folded into another.
+        reload_skipped (int): transport loads skipped as unchanged.
         xmlstream: Active XMPP XML stream (if connected).
         firstlogin (bool): Whether the bot has completed first login.
         xmllog (DailyLogFile): XML log file handler.
@@ -111,21 +209,52 @@ class JabberClient(JabberClientType):
         # a response. If this gets to 5 items, we reconnect.
         self.outstanding_pings = []
         self.rooms = {}
+        self.room_jids = {}
+        self.xml_checks = {}
+        self.xml_checks_hits = 0
         self.chatlog = {}
         self.seqnum = 0
-        self.routingtable = {}
-        self.at_manager = ATManager()
+        self.fanout = FanoutIndex()
+        self.social_log = SocialLogWriter(
+            dbpool,
+            flush_ms=float(
+                self.config.get("bot.social_log.flush_ms", SOCIAL_LOG_FLUSH_MS)
+            ),
+            batch=int(
+                self.config.get("bot.social_log.batch", SOCIAL_LOG_BATCH)
+            ),
+            max_buffer=int(
+                self.config.get("bot.social_log.buffer", SOCIAL_LOG_BUFFER)
+            ),
+        )
+        self.social_log.start()
+        self.pending = PendingSends(
+            size=int(self.config.get("bot.pending.size", PENDING_SIZE)),
+            ttl=float(self.config.get("bot.pending.ttl", PENDING_TTL)),
+        )
+        self.at_manager = ATManager(
+            workers=int(self.config.get("bot.atmosphere.workers", AT_WORKERS)),
+            max_backlog=int(
+                self.config.get("bot.atmosphere.backlog", AT_MAX_BACKLOG)
+            ),
+        )
         self.at_users = {}
-        self.at_routingtable = {}
         self.tw_users = {}
-        self.tw_routingtable = {}
         self.md_users = {}
-        self.md_routingtable = {}
         # Slack integration
         self.slack_teams = {}
-        self.slack_routingtable = {}
         # Webhooks integration
-        self.webhooks_routingtable = {}
+        self.webhook_users = {}
+        # Set when subscription changes arrive via LISTEN/NOTIFY
+        self.notify_listener = None
+        # Set to record deliveries durably, see iembot.outbox
+        self.outbox = None
+        # transport -> table fingerprints at its last successful load
+        self.fingerprints = {}
+        self.reload_inflight = None
+        self.reload_pending = None
+        self.reload_coalesced = 0
+        self.reload_skipped = 0
         self.xmlstream = None
         self.firstlogin = False
         self.xmllog = DailyLogFile(
@@ -140,22 +269,36 @@ class JabberClient(JabberClientType):
             self.fortunes = fp.read().split("\n%\n")
         load_chatlog(self)
 
-        lc3 = LoopingCall(reactor.callInThread, self.save_chatlog)
+        lc3 = LoopingCall(self.save_chatlog_threaded)
         lc3.start(600, now=False)  # Every 10 minutes
 
     def log_iembot_social_log(
         self,
         iembot_account_id: int,
         response: str,
-    ) -> Deferred:
-        """Persist a log message of a social media response."""
-        df = self.dbpool.runOperation(
-            """
-    insert into iembot_social_log (iembot_account_id, response)
-    values (%s, %s)
-            """,
-            (iembot_account_id, str(response)),
-        )
+    ):
+        """Buffer a log message of a social media response, thread safe."""
+        self.social_log.add(iembot_account_id, response)
+
+    def deliver(self, transport: str, *args, **kwargs) -> Deferred | None:
+        """Deliver a message via a transport, through the outbox if any.
+
+        Args:
+            transport (str): a key of ``DELIVERERS``.
+            args: JSON serializable arguments of the deliverer.
+            kwargs: JSON serializable keyword arguments of the deliverer.
+        """
+        if self.outbox is not None:
+            return self.outbox.put(transport, *args, **kwargs)
+        return self.dispatch(transport, args, kwargs)
+
+    def dispatch(self, transport: str, args, kwargs) -> Deferred | None:
+        """Hand a delivery to the transport's deliverer."""
+        return DELIVERERS[transport](self, *args, **kwargs)
+
+    def save_chatlog_threaded(self) -> Deferred:
+        """Save the chatlog within its executor, errors are logged."""
+        df = defer_to_executor("chatlog", self.save_chatlog)
         df.addErrback(log.err)
         return df
 
@@ -167,13 +310,81 @@ class JabberClient(JabberClientType):
             pickle.dump(copy.deepcopy(self.chatlog), fh)
 
     def reload_config(self, always_join: bool):
-        """Jobs the bot should do when a database reload is needed."""
-        self.load_twitter()
-        self.load_mastodon()
-        self.load_chatrooms(always_join)
-        self.load_webhooks()
-        self.load_slack()
-        self.load_atmosphere()
+        """Jobs the bot should do when a database reload is needed.
+
+        Requests made while a reload is running are coalesced into a single
+        reload done afterwards.  Transports whose tables are unchanged since
+        their last load are skipped, chatrooms are always loaded when
+        ``always_join`` is set.
+        """
+        if self.reload_inflight is not None:
+            self.reload_coalesced += 1
+            self.reload_pending = bool(self.reload_pending) or always_join
+            return
+        tables = SUBSCRIPTION_TABLES + sum(RELOAD_TABLES.values(), ())
+        df = self.dbpool.runInteraction(load_fingerprints_from_db, tables)
+        self.reload_inflight = df
+        df.addErrback(self._fingerprint_failure)
+        df.addCallback(self._reload_changed, always_join)
+        df.addErrback(email_error, self, "reload_config() failure")
+        df.addBoth(self._reload_finished)
+
+    def _fingerprint_failure(self, failure) -> dict:
+        """Log the failure and have everything reloaded."""
+        log.err(failure)
+        return {}
+
+    def _reload_changed(self, fingerprints: dict, always_join: bool):
+        """Load the transports that changed in a single interaction."""
+        changed = {}
+        for transport, tables in RELOAD_TABLES.items():
+            fingerprint = None
+            if fingerprints:
+                fingerprint = tuple(
+                    fingerprints[table]
+                    for table in SUBSCRIPTION_TABLES + tables
+                )
+            unchanged = (
+                fingerprint is not None
+                and self.fingerprints.get(transport) == fingerprint
+            )
+            if unchanged and not (always_join and transport == "xmpp"):
+                self.reload_skipped += 1
+                continue
+            changed[transport] = fingerprint
+        if not changed:
+            return None
+        df = self.dbpool.runInteraction(
+            load_transports_from_db, self, tuple(changed)
+        )
+        df.addCallback(self._apply_snapshots, always_join, changed)
+        return df
+
+    def _apply_snapshots(
+        self, snapshots: list[RoutingSnapshot], always_join: bool, changed
+    ):
+        """Swap in the reloaded transports and remember their fingerprints."""
+        for snapshot in snapshots:
+            if snapshot.transport == "xmpp":
+                join_chatrooms(snapshot, self, always_join)
+                self.send_presence()
+            else:
+                self.swap_snapshot(snapshot)
+            if changed[snapshot.transport] is not None:
+                self.fingerprints[snapshot.transport] = changed[
+                    snapshot.transport
+                ]
+        if self.outbox is not None and self.outbox.leftover:
+            # The accounts are now known, so resume what the last run left
+            self.outbox.resume()
+
+    def _reload_finished(self, _res):
+        """Run a reload that was requested in the meantime."""
+        self.reload_inflight = None
+        if self.reload_pending is not None:
+            always_join = self.reload_pending
+            self.reload_pending = None
+            self.reload_config(always_join)
 
     def authd(self, _xs=None):
         """callback when we are logged into the server!"""
@@ -182,8 +393,8 @@ class JabberClient(JabberClientType):
             self.compute_daily_caller()
             self.firstlogin = True
 
-        # Resets associated with the previous login session, perhaps
-        self.rooms = {}
+        # Resets associated with the previous login session
+        self.leave_rooms()
         self.outstanding_pings = []
 
         self.reload_config(always_join=True)
@@ -200,49 +411,99 @@ class JabberClient(JabberClientType):
         self.seqnum += 1
         return self.seqnum
 
+    def swap_snapshot(self, snapshot: RoutingSnapshot) -> RoutingSnapshot:
+        """Swap in what a load_*_from_db built, called on the reactor thread.
+
+        Args:
+            snapshot (RoutingSnapshot): the loaded accounts and routing.
+        """
+        if snapshot.transport in ACCOUNT_ATTRS:
+            setattr(self, ACCOUNT_ATTRS[snapshot.transport], snapshot.accounts)
+        if snapshot.transport == "atmosphere":
+            reconcile_atmosphere(self, snapshot.accounts)
+        self.fanout.swap(snapshot.transport, snapshot.table)
+        return snapshot
+
+    def merge_snapshot(
+        self, snapshot: RoutingSnapshot, iembot_account_id: int
+    ) -> RoutingSnapshot:
+        """Merge what a loader built for a single account, on the reactor.
+
+        Args:
+            snapshot (RoutingSnapshot): loaded for just ``iembot_account_id``,
+              so empty when the account was removed.
+            iembot_account_id (int): the account that changed.
+        """
+        attr = ACCOUNT_ATTRS[snapshot.transport]
+        accounts = dict(getattr(self, attr))
+        old = accounts.pop(iembot_account_id, None)
+        accounts.update(snapshot.accounts)
+        setattr(self, attr, accounts)
+        if snapshot.transport == "atmosphere":
+            # Only this account was loaded, which may have changed handles
+            scope = set() if old is None else {old["at_handle"]}
+            reconcile_atmosphere(self, snapshot.accounts, scope)
+        self.fanout.replace_target(
+            snapshot.transport,
+            iembot_account_id,
+            snapshot.table.targets.get(iembot_account_id, ()),
+            snapshot.table.groups_of(iembot_account_id),
+        )
+        return snapshot
+
     def load_chatrooms(self, always_join: bool):
         """
         Load up the chatrooms and subscriptions from the database!, I also
         support getting called at a later date for any changes
         """
         log.msg("load_chatrooms() called...")
-        df = self.dbpool.runInteraction(
-            load_chatrooms_from_db, self, always_join
-        )
+        df = self.dbpool.runInteraction(load_chatrooms_from_db, self)
+        df.addCallback(join_chatrooms, self, always_join)
         # Send a presence update, which in the case of the first login will
         # provoke any offline messages to be sent.
         df.addCallback(self.send_presence)
         df.addErrback(email_error, self, "load_chatrooms() failure")
+        return df
 
     def load_twitter(self):
         """Load the twitter subscriptions and access tokens"""
         log.msg("load_twitter() called...")
         df = self.dbpool.runInteraction(load_twitter_from_db, self)
+        df.addCallback(self.swap_snapshot)
         df.addErrback(email_error, self, "load_twitter() failure")
+        return df
 
     def load_atmosphere(self):
         """Load the atmosphere subscriptions and access tokens"""
         log.msg("load_atmosphere() called...")
         df = self.dbpool.runInteraction(load_atmosphere_from_db, self)
+        df.addCallback(self.swap_snapshot)
         df.addErrback(email_error, self, "load_atmosphere() failure")
+        return df
 
     def load_slack(self):
         """Load the slack subscriptions and access tokens"""
         log.msg("load_slack() called...")
         df = self.dbpool.runInteraction(load_slack_from_db, self)
+        df.addCallback(self.swap_snapshot)
         df.addErrback(email_error, self, "load_slack() failure")
+        return df
 
     def load_mastodon(self):
         """Load the Mastodon subscriptions and access tokens"""
         log.msg("load_mastodon() called...")
         df = self.dbpool.runInteraction(load_mastodon_from_db, self)
+        df.addCallback(self.swap_snapshot)
         df.addErrback(email_error, self, "load_mastodon() failure")
+        return df
 
     def load_webhooks(self):
         """Load the twitter subscriptions and access tokens"""
         log.msg("load_webhooks() called...")
         df = self.dbpool.runInteraction(load_webhooks_from_db, self)
+        df.addCallback(self.swap_snapshot)
         df.addErrback(email_error, self, "load_webhooks() failure")
+        return df
 
     def fire_client(self, _res, serviceCollection):
         """Callback from main saying that our database (select 1) is ready."""
@@ -291,6 +552,18 @@ class JabberClient(JabberClientType):
     def disconnected(self, _xs=None):
         """disconnected callback"""
         log.msg("disconnected() was called...")
+        # Queue what is routed until the rooms are joined again
+        self.leave_rooms()
+
+    def leave_rooms(self):
+        """Mark the rooms not joined, as the stream ended.
+
+        The rooms are kept, so messages routed to them are queued within
+        ``self.pending`` until their self-presence after the next login.
+        """
+        for meta in self.rooms.values():
+            meta["joined"] = False
+            meta["occupants"] = {}
 
     def get_fortune(self):
         """Get a random value from the array"""
@@ -395,20 +668,50 @@ class JabberClient(JabberClientType):
             # wrap plain text in a paragraph tag
             p = body.addElement("p")
             p.addContent(plain)
-        # Ensure that we have well formed XML before sending it
-        try:
-            ET.fromstring(message.toXml())
-        except Exception as exp:
-            email_error(exp, self, message.toXml())
-            return None
+        # Ensure that we have well formed XML before sending it, the check
+        # of the same content is the same for every room
+        raw = self.serialize(message)
+        key = (plain, htmlstr)
+        if key in self.xml_checks:
+            self.xml_checks_hits += 1
+            exp = self.xml_checks[key]
         else:
-            self.send_groupchat_elem(message)
+            exp = xml_error(raw)
+            if len(self.xml_checks) >= XML_CHECKS:
+                self.xml_checks.pop(next(iter(self.xml_checks)))
+            self.xml_checks[key] = exp
+        if exp is not None:
+            # Not within an except block, so there is no traceback to print
+            email_error(f"Invalid XML: {exp}", self, raw.decode("utf-8"))
+            return None
+        self.send_groupchat_elem(message, raw=raw)
         return message
 
-    def send_groupchat_elem(self, elem, to=None, secondtrip=False):
-        """Wrapper for sending groupchat elements"""
+    def serialize(self, elem: Element) -> bytes:
+        """Serialize the element as the stream would send it."""
+        xs = self.xmlstream
+        if xs is None:
+            return elem.toXml().encode("utf-8")
+        return elem.toXml(
+            prefixes=xs.prefixes,
+            defaultUri=xs.namespace,
+            prefixesInScope=list(xs.prefixes.values()),
+        ).encode("utf-8")
+
+    def send_groupchat_elem(self, elem, to=None, raw=None):
+        """Wrapper for sending groupchat elements.
+
+        A message to a room not joined yet is queued within
+        ``self.pending`` until the room is joined.
+
+        Args:
+          elem (Element): the groupchat message.
+          to (str, optional): the recipient to set.
+          raw (bytes, optional): the element already serialized.
+        """
         if to is not None:
             elem["to"] = to
+            raw = None
         room = jid.JID(elem["to"]).user
         if room not in self.rooms:
             email_error(
@@ -419,17 +722,61 @@ class JabberClient(JabberClientType):
             )
             return
         if not self.rooms[room]["joined"]:
-            if secondtrip:
-                log.msg(
-                    f"ABORT of send to room: {room}, msg: {elem}, not in room"
-                )
-                return
-            secs = random.randint(0, 10)
-            log.msg(f"delaying by {secs}s send to: {room}, not in room yet")
-            # Need to prevent elem['to'] object overwriting
-            reactor.callLater(secs, self.send_groupchat_elem, elem, elem["to"])
+            # Serialized now, as the element may be sent elsewhere meanwhile
+            self.pending.add(
+                room, self.serialize(elem) if raw is None else raw
+            )
             return
-        self.xmlstream.send(elem)
+        self.xmlstream.send(elem if raw is None else raw)
+
+    def room_jid(self, room: str) -> bytes:
+        """Return the room's JID escaped for an attribute, computed once."""
+        res = self.room_jids.get(room)
+        if res is None:
+            res = escapeToXml(
+                f"{room}@{self.config['bot.mucservice']}", isattrib=1
+            ).encode("utf-8")
+            self.room_jids[room] = res
+        return res
+
+    def send_groupchat_fanout(self, elem: Element, rooms) -> int:
+        """Send the groupchat element to many rooms, serializing it once.
+
+        The element is serialized as the stream would with a placeholder
+        recipient, which each joined room's JID then replaces within the
+        bytes.  Other rooms go through :meth:`send_groupchat_elem`.
+
+        Returns:
+          int: the rooms the bytes were written to.
+        """
+        head = tail = None
+        sent = 0
+        for room in rooms:
+            meta = self.rooms.get(room)
+            if meta is None or not meta["joined"]:
+                self.send_groupchat_elem(
+                    elem, f"{room}@{self.config['bot.mucservice']}"
+                )
+                continue
+            if head is None:
+                head, tail = self._groupchat_template(elem)
+            self.xmlstream.send(head + self.room_jid(room) + tail)
+            sent += 1
+        return sent
+
+    def _groupchat_template(self, elem: Element) -> tuple[bytes, bytes]:
+        """Serialize the element, split where its recipient goes."""
+        to = elem.getAttribute("to")
+        elem["to"] = FANOUT_TO
+        try:
+            raw = self.serialize(elem)
+        finally:
+            if to is None:
+                del elem["to"]
+            else:
+                elem["to"] = to
+        head, tail = raw.split(FANOUT_TO.encode("utf-8"), 1)
+        return head, tail
 
     def send_presence(self, _=None):
         """
@@ -515,6 +862,14 @@ class JabberClient(JabberClientType):
                 "affiliation": affiliation,
                 "role": role,
             }
+        if "110" not in muc_codes:
+            return
+        # Send what was routed to the room while joining, in order
+        if self.rooms[_room]["joined"]:
+            for raw in self.pending.flush(_room):
+                self.xmlstream.send(raw)
+        else:
+            self.pending.discard(_room)
 
     def iq_processor(self, elem: Element):
         """Response to IQ stanzas."""
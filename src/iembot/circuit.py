@@ -0,0 +1,148 @@
+"""Circuit breakers quarantining failing delivery endpoints.
+
+A dead endpoint costs each routed message a timeout and its retries, so
+after ``failures`` consecutive failures its circuit opens and deliveries to
+it are skipped.  Once ``reset`` seconds passed, a single probe delivery is
+let through (half-open): its success closes the circuit and its failure
+opens it again for another ``reset`` seconds.
+
+Only the endpoints with failures are tracked, a success forgets them.
+"""
+
+from __future__ import annotations
+
+import hashlib
+from typing import TYPE_CHECKING
+
+from twisted.internet import reactor
+from twisted.python import log
+
+if TYPE_CHECKING:
+    from collections.abc import Hashable
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+# Consecutive failures opening a circuit
+FAILURES = 5
+# Seconds an open circuit waits before a probe
+RESET = 300
+
+
+def _digest(key: Hashable) -> str:
+    """Return a short hash of an endpoint key, not revealing it."""
+    return hashlib.sha256(str(key).encode("utf-8")).hexdigest()[:12]
+
+
+class CircuitOpen(Exception):
+    """Raised for a delivery to an endpoint whose circuit is open."""
+
+
+class Circuit:
+    """The health of an endpoint.
+
+    Attributes:
+        state (str): ``closed``, ``open`` or ``half-open``.
+        failures (int): consecutive failures.
+        opened (float): when the circuit last opened.
+    """
+
+    __slots__ = ("failures", "opened", "state")
+
+    def __init__(self):
+        """Constructor."""
+        self.state = CLOSED
+        self.failures = 0
+        self.opened = 0.0
+
+
+class CircuitBreakers:
+    """The circuits of the endpoints, used on the reactor thread.
+
+    Attributes:
+        failures (int): consecutive failures opening a circuit.
+        reset (float): seconds an open circuit waits before a probe.
+        skipped (int): deliveries skipped as their circuit was open.
+        opened (int): times a circuit opened.
+    """
+
+    def __init__(
+        self, failures: int = FAILURES, reset: float = RESET, clock=None
+    ):
+        """Constructor."""
+        self.failures = failures
+        self.reset = reset
+        self.clock = clock or reactor
+        self.circuits: dict[Hashable, Circuit] = {}
+        self.skipped = 0
+        self.opened = 0
+
+    def available(self, key: Hashable) -> bool:
+        """Whether a delivery to the endpoint may be attempted, cheaply."""
+        circuit = self.circuits.get(key)
+        if circuit is None or circuit.state == CLOSED:
+            return True
+        if (
+            circuit.state == OPEN
+            and self.clock.seconds() - circuit.opened >= self.reset
+        ):
+            return True
+        self.skipped += 1
+        return False
+
+    def acquire(self, key: Hashable):
+        """Start an attempt, turning an open circuit half-open to probe.
+
+        Raises:
+            CircuitOpen: when the circuit is open or already probing.
+        """
+        if not self.available(key):
+            raise CircuitOpen(f"Circuit of {key} is open")
+        circuit = self.circuits.get(key)
+        if circuit is not None and circuit.state == OPEN:
+            log.msg(f"Probing {key} after {self.reset}s")
+            circuit.state = HALF_OPEN
+
+    def success(self, key: Hashable):
+        """Forget the failures of the endpoint."""
+        circuit = self.circuits.pop(key, None)
+        if circuit is not None and circuit.state != CLOSED:
+            log.msg(f"Circuit of {key} is closed again")
+
+    def failure(self, key: Hashable):
+        """Account for a failure, opening the circuit when due."""
+        circuit = self.circuits.setdefault(key, Circuit())
+        circuit.failures += 1
+        if circuit.state == HALF_OPEN or (
+            circuit.state == CLOSED and circuit.failures >= self.failures
+        ):
+            log.msg(f"Opening circuit of {key} after {circuit.failures} fails")
+            circuit.state = OPEN
+            circuit.opened = self.clock.seconds()
+            self.opened += 1
+
+    def stats(
+        self, prefix: str, names: dict[Hashable, str] | None = None
+    ) -> dict[str, int | str]:
+        """Return the bookkeeping for the status endpoint.
+
+        Args:
+            prefix (str): of the keys.
+            names (dict, optional): the name published for an endpoint key,
+              like a url embedding a secret, those not found are hashed.
+        """
+        res = {
+            f"{prefix}.open": sum(
+                circuit.state != CLOSED for circuit in self.circuits.values()
+            ),
+            f"{prefix}.opened": self.opened,
+            f"{prefix}.skipped": self.skipped,
+        }
+        for key, circuit in self.circuits.items():
+            if circuit.state == CLOSED:
+                continue
+            name = key
+            if names is not None:
+                name = names.get(key) or _digest(key)
+            res[f"{prefix}.{name}"] = circuit.state
+        return res
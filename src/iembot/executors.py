@@ -0,0 +1,171 @@
+"""Named and bounded thread pools for the blocking work of each subsystem.
+
+A slow webhook host or social media API should not starve the other
+subsystems, so each gets its own :class:`BoundedExecutor` rather than
+sharing the reactor threadpool.  An executor rejects work once its queue
+bound is reached, failing the returned Deferred with :class:`ExecutorFull`.
+
+Sizes are configured within ``settings.json`` with keys like
+``bot.executor.webhooks.threads`` and ``bot.executor.webhooks.queue``.
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+from typing import TYPE_CHECKING
+
+from twisted.internet import defer, reactor, threads
+from twisted.python import log
+from twisted.python.threadpool import ThreadPool
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+
+# name -> (threads, queue bound)
+EXECUTOR_DEFAULTS = {
+    "twitter": (16, 1000),
+    "mastodon": (16, 1000),
+    "memcache": (8, 200),
+    "chatlog": (1, 1),
+    "outbox": (1, 10),
+}
+EXECUTORS: dict[str, BoundedExecutor] = {}
+
+
+class ExecutorFull(Exception):
+    """Raised when an executor's queue bound is reached."""
+
+
+class BoundedExecutor:
+    """A named thread pool with a bounded queue and some bookkeeping.
+
+    Attributes:
+        name (str): the subsystem name.
+        max_queue (int): the most calls waiting for a thread.
+        queued (int): calls waiting for a thread.
+        running (int): calls running within a thread.
+        completed (int): calls that finished.
+        rejected (int): calls refused as the queue was full.
+        wait_last (float): seconds the last call waited for a thread.
+        wait_max (float): the longest seconds a call waited for a thread.
+    """
+
+    def __init__(self, name: str, size: int, max_queue: int):
+        """Constructor.
+
+        Args:
+            name (str): the subsystem name.
+            size (int): the number of threads.
+            max_queue (int): the most calls waiting for a thread.
+        """
+        self.name = name
+        self.max_queue = max_queue
+        self.pool = ThreadPool(0, size, name=f"iembot-{name}")
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.rejected = 0
+        self.wait_last = 0.0
+        self.wait_max = 0.0
+        self._wait_total = 0.0
+
+    def start(self):
+        """Start the pool and stop it when the reactor does."""
+        self.pool.start()
+        reactor.addSystemEventTrigger("during", "shutdown", self.stop)
+
+    def stop(self):
+        """Stop the pool, waiting on running calls."""
+        if self.pool.started:
+            self.pool.stop()
+
+    def submit(self, func: Callable, *args, **kwargs) -> defer.Deferred:
+        """Run ``func`` within the pool, like ``deferToThread``."""
+        with self._lock:
+            if self.queued >= self.max_queue:
+                self.rejected += 1
+                return defer.fail(
+                    ExecutorFull(f"{self.name} executor queue is full")
+                )
+            self.queued += 1
+        return threads.deferToThreadPool(
+            reactor,
+            self.pool,
+            self._run,
+            time.monotonic(),
+            func,
+            *args,
+            **kwargs,
+        )
+
+    def _run(self, enqueued: float, func: Callable, *args, **kwargs):
+        """Account for the call, within a pool thread."""
+        wait = time.monotonic() - enqueued
+        with self._lock:
+            self.queued -= 1
+            self.running += 1
+            self.wait_last = wait
+            self.wait_max = max(self.wait_max, wait)
+            self._wait_total += wait
+        try:
+            return func(*args, **kwargs)
+        finally:
+            with self._lock:
+                self.running -= 1
+                self.completed += 1
+
+    def stats(self) -> dict[str, float]:
+        """Return the bookkeeping for the status endpoint."""
+        with self._lock:
+            started = self.completed + self.running
+            return {
+                "threads": self.pool.max,
+                "queued": self.queued,
+                "running": self.running,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "wait_last": round(self.wait_last, 3),
+                "wait_max": round(self.wait_max, 3),
+                "wait_avg": round(self._wait_total / max(started, 1), 3),
+            }
+
+
+def configure_executors(config: dict):
+    """(Re)create the executors with sizes found within the config."""
+    for name, defaults in EXECUTOR_DEFAULTS.items():
+        size = int(config.get(f"bot.executor.{name}.threads", defaults[0]))
+        max_queue = int(config.get(f"bot.executor.{name}.queue", defaults[1]))
+        old = EXECUTORS.pop(name, None)
+        if old is not None:
+            old.stop()
+        log.msg(f"Executor {name} threads: {size} queue: {max_queue}")
+        EXECUTORS[name] = BoundedExecutor(name, size, max_queue)
+        EXECUTORS[name].start()
+
+
+def get_executor(name: str) -> BoundedExecutor:
+    """Return the named executor, created with the defaults if needed."""
+    executor = EXECUTORS.get(name)
+    if executor is None:
+        executor = BoundedExecutor(name, *EXECUTOR_DEFAULTS[name])
+        executor.start()
+        EXECUTORS[name] = executor
+    return executor
+
+
+def defer_to_executor(
+    name: str, func: Callable, *args, **kwargs
+) -> defer.Deferred:
+    """Run ``func`` within the named executor, like ``deferToThread``."""
+    return get_executor(name).submit(func, *args, **kwargs)
+
+
+def executor_stats() -> dict[str, float]:
+    """Return the flattened stats of all executors."""
+    res = {}
+    for name, executor in EXECUTORS.items():
+        for key, value in executor.stats().items():
+            res[f"executor.{name}.{key}"] = value
+    return res
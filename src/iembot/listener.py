@@ -0,0 +1,223 @@
+"""Incremental subscription reloads driven by Postgres LISTEN/NOTIFY.
+
+The triggers in ``scripts/iembot_notify_triggers.sql`` emit a JSON payload
+on the ``iembot_changes`` channel for every row changed within the
+subscription and account tables, like::
+
+    {"table": "iembot_subscriptions", "op": "INSERT",
+     "iembot_account_id": 123}
+
+A :class:`NotifyListenerThread` waits on its own database connection and
+hands each payload to the reactor, where the :class:`DeltaReloader` reloads
+just the one account and merges it into the running routing tables.  Tables
+without an ``iembot_account_id`` fall back to reloading their transport.
+"""
+
+from __future__ import annotations
+
+import json
+import threading
+import time
+from typing import TYPE_CHECKING
+
+import psycopg
+from psycopg.rows import dict_row
+from twisted.internet import reactor
+from twisted.python import log
+
+from iembot.bot import LOADERS
+from iembot.routing import EMPTY_TABLE, TRANSPORTS, RoutingSnapshot
+from iembot.sessions import SESSIONS
+from iembot.util import merge_chatroom
+
+if TYPE_CHECKING:
+    from iembot.types import JabberClient
+
+NOTIFY_CHANNEL = "iembot_changes"
+# Seconds to wait between reconnection attempts
+RETRY_DELAY = 10
+# Seconds to block waiting on notifications before checking for stop
+POLL_TIMEOUT = 5
+
+# Table with the iembot_account_id -> transport
+ACCOUNT_TABLES = {
+    "iembot_rooms": "xmpp",
+    "iembot_twitter_oauth": "twitter",
+    "iembot_mastodon_oauth": "mastodon",
+    "iembot_atmosphere_accounts": "atmosphere",
+    "iembot_slack_team_channels": "slack",
+    "iembot_webhooks": "webhooks",
+}
+
+
+def load_account_from_db(
+    txn, bot: JabberClient, iembot_account_id: int
+) -> RoutingSnapshot | None:
+    """Load a single account, called from a thread.
+
+    Returns:
+        RoutingSnapshot or None when the account no longer exists.
+    """
+    txn.execute(
+        " UNION ALL ".join(
+            f"select '{transport}' as transport from {table} "
+            "WHERE iembot_account_id = %s"
+            for table, transport in ACCOUNT_TABLES.items()
+        ),
+        (iembot_account_id,) * len(ACCOUNT_TABLES),
+    )
+    row = txn.fetchone()
+    if row is None:
+        return None
+    return LOADERS[row["transport"]](txn, bot, iembot_account_id)
+
+
+class DeltaReloader:
+    """Apply NOTIFY payloads to the bot, called on the reactor thread.
+
+    Notifications arriving while an account is being reloaded mark it dirty
+    so that a burst of row changes costs at most one more reload.
+
+    Attributes:
+        bot (JabberClient): the running bot.
+        inflight (set): accounts currently being reloaded.
+        dirty (set): accounts changed again while in flight.
+        deltas (int): number of single account reloads applied.
+        full_reloads (int): number of fallback full reloads.
+    """
+
+    def __init__(self, bot: JabberClient):
+        """Constructor."""
+        self.bot = bot
+        self.inflight = set()
+        self.dirty = set()
+        self.deltas = 0
+        self.full_reloads = 0
+
+    def full_reload(self):
+        """Reload everything, when a delta can not be determined."""
+        self.full_reloads += 1
+        self.bot.reload_config(always_join=False)
+
+    def notify(self, payload: str | None):
+        """Process a NOTIFY payload, ``None`` after a reconnect."""
+        if not self.bot.firstlogin:
+            # The initial login loads everything
+            return
+        try:
+            change = json.loads(payload) if payload is not None else {}
+        except ValueError:
+            log.msg(f"Unparsable NOTIFY payload: {payload}")
+            change = {}
+        iembot_account_id = change.get("iembot_account_id")
+        if change.get("table") == "iembot_slack_teams":
+            self.full_reloads += 1
+            self.bot.load_slack()
+        elif iembot_account_id is None:
+            self.full_reload()
+        else:
+            self.reload_account(iembot_account_id)
+
+    def reload_account(self, iembot_account_id: int):
+        """Reload a single account from the database."""
+        if iembot_account_id in self.inflight:
+            self.dirty.add(iembot_account_id)
+            return
+        self.inflight.add(iembot_account_id)
+        df = self.bot.dbpool.runInteraction(
+            load_account_from_db, self.bot, iembot_account_id
+        )
+        df.addCallback(self.apply, iembot_account_id)
+        df.addErrback(log.err)
+        df.addBoth(self._finished, iembot_account_id)
+
+    def apply(self, snapshot: RoutingSnapshot | None, iembot_account_id: int):
+        """Merge the reloaded account into the bot."""
+        self.deltas += 1
+        if snapshot is None:
+            log.msg(f"Removing iembot_account_id: {iembot_account_id}")
+            self.release(iembot_account_id)
+            snapshots = [
+                RoutingSnapshot(transport, EMPTY_TABLE, {})
+                for transport in TRANSPORTS
+            ]
+        else:
+            snapshots = [snapshot]
+        for snap in snapshots:
+            if snap.transport == "xmpp":
+                merge_chatroom(snap, self.bot, iembot_account_id)
+            else:
+                self.bot.merge_snapshot(snap, iembot_account_id)
+
+    def release(self, iembot_account_id: int):
+        """Close the clients kept for a removed account."""
+        for transport in ("twitter", "mastodon"):
+            SESSIONS.discard((transport, iembot_account_id))
+        meta = self.bot.at_users.get(iembot_account_id)
+        if meta is not None:
+            self.bot.at_manager.reconcile({}, {meta["at_handle"]})
+
+    def _finished(self, _res, iembot_account_id: int):
+        """Reload again if more changes arrived in the meantime."""
+        self.inflight.discard(iembot_account_id)
+        if iembot_account_id in self.dirty:
+            self.dirty.discard(iembot_account_id)
+            self.reload_account(iembot_account_id)
+
+
+class NotifyListenerThread(threading.Thread):
+    """Wait on database notifications and pass them to the reactor."""
+
+    def __init__(
+        self,
+        dbargs: dict,
+        reloader: DeltaReloader,
+        sleeper=time.sleep,
+    ):
+        """Constructor.
+
+        Args:
+            dbargs (dict): ``psycopg.connect`` keyword arguments.
+            reloader (DeltaReloader): receives the payloads on the reactor.
+            sleeper (callable): used to wait between reconnects.
+        """
+        super().__init__(name="iembot-notify", daemon=True)
+        self.dbargs = dbargs
+        self.reloader = reloader
+        self.sleeper = sleeper
+        self.stopping = threading.Event()
+        self.connects = 0
+
+    def stop(self):
+        """Ask the thread to stop at its next poll."""
+        self.stopping.set()
+
+    def listen(self):
+        """Connect and relay notifications until stopped or disconnected."""
+        with psycopg.connect(
+            **self.dbargs, autocommit=True, row_factory=dict_row
+        ) as conn:
+            conn.execute(f"LISTEN {NOTIFY_CHANNEL}")
+            self.connects += 1
+            log.msg(f"Listening for {NOTIFY_CHANNEL} notifications")
+            if self.connects > 1:
+                # Changes may have been missed while disconnected
+                reactor.callFromThread(self.reloader.notify, None)
+            while not self.stopping.is_set():
+                for notify in conn.notifies(timeout=POLL_TIMEOUT):
+                    reactor.callFromThread(
+                        self.reloader.notify, notify.payload
+                    )
+
+    def run(self):
+        """Thread entry point."""
+        while not self.stopping.is_set():
+            try:
+                self.listen()
+            except psycopg.Error as exp:
+                log.msg(f"NOTIFY listener failed: {exp}")
+                self.sleeper(RETRY_DELAY)
+            except Exception as exp:
+                # Never let the thread die quietly
+                log.err(exp, "NOTIFY listener failed unexpectedly")
+                self.sleeper(RETRY_DELAY)
@@ -20,9 +20,18 @@ from twisted.python.logfile import DailyLogFile
 from twisted.web import server
 
 from iembot import webservices
+from iembot.asynchttp import HTTP_CLIENT, configure_http
+from iembot.atmosphere import ATSessionStore
 from iembot.bot import JabberClient
+from iembot.executors import configure_executors
+from iembot.listener import DeltaReloader, NotifyListenerThread
+from iembot.media import configure_media_cache, shutdown_media_pool
 from iembot.memcache import build_memcache_client
 from iembot.msghandlers import register_handler
+from iembot.outbox import Outbox
+from iembot.retry import configure_retry_policies
+from iembot.sessions import SESSIONS, configure_sessions
+from iembot.webhooks import BATCHER, configure_webhooks
 
 
 def _load_config(path: str) -> dict:
@@ -30,19 +39,61 @@ def _load_config(path: str) -> dict:
         return json.load(fh)
 
 
-def _build_dbpool(config: dict) -> adbapi.ConnectionPool:
+def _dbargs(config: dict) -> dict:
     # Password should be set via .pgpass or environment.
+    return {
+        "dbname": config.get("bot.dbname", "iembot"),
+        "host": config.get("bot.dbhost", "localhost"),
+        "user": config.get("bot.dbuser", "iembot"),
+        "gssencmode": "disable",
+    }
+
+
+def _close_dbpool(jabber: JabberClient, dbpool: adbapi.ConnectionPool):
+    """Close the dbpool once the buffered social log rows are written.
+
+    The triggers of a shutdown phase do not wait on each other, so the
+    writer is stopped here rather than within its own trigger.
+    """
+    df = jabber.social_log.stop()
+    df.addErrback(log.err)
+    df.addCallback(lambda _: dbpool.close())
+    return df
+
+
+def _build_dbpool(config: dict) -> adbapi.ConnectionPool:
     return adbapi.ConnectionPool(
         "psycopg",
         cp_reconnect=True,
-        dbname=config.get("bot.dbname", "iembot"),
-        host=config.get("bot.dbhost", "localhost"),
-        user=config.get("bot.dbuser", "iembot"),
-        gssencmode="disable",
         row_factory=dict_row,
+        **_dbargs(config),
     )
 
 
+def _start_notify_listener(
+    config: dict, jabber: JabberClient
+) -> NotifyListenerThread:
+    listener = NotifyListenerThread(_dbargs(config), DeltaReloader(jabber))
+    jabber.notify_listener = listener
+    listener.start()
+    return listener
+
+
+def _start_outbox(path: str, jabber: JabberClient) -> Outbox:
+    outbox = Outbox(path, jabber.dispatch)
+    outbox.open()
+    outbox.start()
+    jabber.outbox = outbox
+    return outbox
+
+
+def _load_at_sessions(path: str, jabber: JabberClient) -> ATSessionStore:
+    sessions = ATSessionStore(path)
+    sessions.load()
+    jabber.at_manager.sessions = sessions
+    return sessions
+
+
 def _start_logging(logfile: str | None) -> None:
     if logfile in (None, "", "-"):
         log.startLogging(sys.stdout)
@@ -82,6 +133,13 @@ def main() -> None:
 
 
 @main.command()
+@click.option(
+    "--at-sessions",
+    type=str,
+    default="iembot_at_sessions.json",
+    show_default=True,
+    help="File of Bluesky sessions resumed on restart (empty to disable)",
+)
 @click.option(
     "--config",
     "-c",
@@ -116,7 +174,7 @@ def main() -> None:
     type=int,
     default=512,
     show_default=True,
-    help="Max Twisted threadpool size",
+    help="Max Twisted threadpool size, see also bot.executor.* settings",
 )
 @click.option(
     "--logfile",
@@ -158,7 +216,21 @@ def main() -> None:
     default=False,
     help="Disable Mastodon message handler",
 )
+@click.option(
+    "--listen-notify",
+    is_flag=True,
+    default=False,
+    help="Apply subscription changes from database NOTIFY events",
+)
+@click.option(
+    "--outbox",
+    type=str,
+    default="iembot_outbox.db",
+    show_default=True,
+    help="SQLite file of deliveries resumed on restart (empty to disable)",
+)
 def run(
+    at_sessions: str,
     config: str,
     json_port: int,
     rss_port: int,
@@ -170,6 +242,8 @@ def run(
     disable_twitter: bool,
     disable_atmosphere: bool,
     disable_mastodon: bool,
+    listen_notify: bool,
+    outbox: str,
 ) -> None:
     """Run the IEMBot service (Twisted reactor)."""
 
@@ -195,10 +269,25 @@ def run(
     service_collection = service.IServiceCollection(application)
 
     settings = _load_config(config)
+    configure_executors(settings)
+    configure_retry_policies(settings)
+    configure_media_cache(settings)
+    configure_sessions(settings)
+    configure_http(settings)
+    configure_webhooks(settings)
     dbpool = _build_dbpool(settings)
     memcache_client = build_memcache_client(memcache)
 
     jabber = JabberClient("iembot", dbpool, settings, memcache_client)
+    if listen_notify:
+        listener = _start_notify_listener(settings, jabber)
+        reactor.addSystemEventTrigger("before", "shutdown", listener.stop)
+    # Registered ahead of the outbox, so flushed batches are recorded
+    reactor.addSystemEventTrigger("before", "shutdown", BATCHER.flush_all)
+    if outbox:
+        _start_outbox(outbox, jabber)
+    if at_sessions:
+        _load_at_sessions(at_sessions, jabber)
 
     # Lame means to ensure the database is reachable before starting.
     d = dbpool.runQuery("select 1")
@@ -229,7 +318,12 @@ def run(
         "shutdown",
         service_collection.stopService,
     )
-    reactor.addSystemEventTrigger("before", "shutdown", dbpool.close)
+    reactor.addSystemEventTrigger(
+        "before", "shutdown", _close_dbpool, jabber, dbpool
+    )
+    reactor.addSystemEventTrigger("during", "shutdown", shutdown_media_pool)
+    reactor.addSystemEventTrigger("during", "shutdown", SESSIONS.clear)
+    reactor.addSystemEventTrigger("before", "shutdown", HTTP_CLIENT.close)
     if pidfile:
         reactor.addSystemEventTrigger(
             "before",
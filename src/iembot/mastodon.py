@@ -1,34 +1,48 @@
 """Mastodon stuff."""
 
-import time
+from functools import partial
+from io import BytesIO
+from urllib.parse import urlparse
 
 import mastodon as Mastodon
-import requests
 from mastodon.errors import MastodonError, MastodonIOError
-from twisted.internet import threads
 from twisted.python import log
-from twisted.words.xish.domish import Element
 
+from iembot.media import media_type, prepare_media
+from iembot.message import IngestMessage
+from iembot.retry import RetryableError, log_exhausted, retry_call
+from iembot.routing import RoutingSnapshot, RoutingTable
+from iembot.sessions import SESSIONS, http_session
 from iembot.types import JabberClient
-from iembot.util import build_channel_subs, email_error, safe_twitter_text
-
-
-def load_mastodon_from_db(txn, bot: JabberClient):
-    """Load Mastodon config from database"""
-    bot.md_routingtable = build_channel_subs(
-        txn,
-        "iembot_mastodon_oauth",
-    )
+from iembot.util import (
+    account_filter,
+    build_channel_subs,
+    email_error,
+)
+
+
+def load_mastodon_from_db(
+    txn,
+    _bot: JabberClient,
+    iembot_account_id: int | None = None,
+    subs: dict | None = None,
+) -> RoutingSnapshot:
+    """Load Mastodon config from database, called from a thread."""
+    if subs is None:
+        subs = build_channel_subs(txn, "mastodon", iembot_account_id)
+    table = RoutingTable.compile(*subs)
+    acct_sql, params = account_filter("o", iembot_account_id)
 
     mdusers = {}
     txn.execute(
-        """
+        f"""
         select server, o.iembot_account_id,
         o.access_token, o.screen_name, o.iem_owned
         from iembot_mastodon_apps a JOIN iembot_mastodon_oauth o
             on (a.id = o.appid) WHERE o.access_token is not null and
-        not o.disabled
-        """
+        not o.disabled{acct_sql}
+        """,
+        params,
     )
     for row in txn.fetchall():
         mdusers[row["iembot_account_id"]] = {
@@ -37,8 +51,8 @@ def load_mastodon_from_db(txn, bot: JabberClient):
             "api_base_url": row["server"],
             "iem_owned": row["iem_owned"],
         }
-    bot.md_users = mdusers
     log.msg(f"load_mastodon_from_db(): {txn.rowcount} access tokens found")
+    return RoutingSnapshot("mastodon", table, mdusers)
 
 
 def disable_user_by_mastodon_exp(
@@ -75,6 +89,7 @@ def disable_user_by_mastodon_exp(
         return False
 
     bot.md_users.pop(iembot_account_id)
+    SESSIONS.discard(("mastodon", iembot_account_id))
     log.msg(
         f"Removing Mastodon access token for user: {iembot_account_id} "
         f"({screen_name}) due to {exp.args}"
@@ -107,13 +122,15 @@ def toot(self, iembot_account_id: int, twttxt: str, **kwargs):
     """
     Send a message to Mastodon
     """
-    df = threads.deferToThread(
+    df = retry_call(
+        "mastodon",
         really_toot,
         self,
         iembot_account_id,
         twttxt,
         **kwargs,
     )
+    df.addErrback(log_exhausted)
     df.addCallback(toot_cb, self, iembot_account_id)
     df.addErrback(
         email_error,
@@ -126,14 +143,22 @@ def toot(self, iembot_account_id: int, twttxt: str, **kwargs):
 def really_toot(
     bot: JabberClient, iembot_account_id: int, twttxt: str, **kwargs
 ) -> dict | None:
-    """Called from a thread, so we can block here."""
+    """Called from a thread, a single attempt retried by :func:`toot`."""
     meta = bot.md_users.get(iembot_account_id)
     if meta is None:
         log.msg(f"toot() called with unknown user: {iembot_account_id}")
         return None
-    api = Mastodon.Mastodon(
-        access_token=meta["access_token"],
-        api_base_url=meta["api_base_url"],
+    # Accounts of a server share its connections
+    session = http_session(urlparse(meta["api_base_url"]).netloc)
+    api = SESSIONS.get(
+        ("mastodon", iembot_account_id),
+        partial(
+            Mastodon.Mastodon,
+            access_token=meta["access_token"],
+            api_base_url=meta["api_base_url"],
+            session=session,
+        ),
+        (meta["access_token"], meta["api_base_url"]),
     )
     media = kwargs.get("twitter_media")
     media_id = None
@@ -141,66 +166,49 @@ def really_toot(
     params = {
         "status": twttxt,
     }
-    for attempt in range(2):
-        try:
-            # If we have media, we have some work to do!
-            if media is not None:
-                resp = requests.get(media, timeout=30, stream=True)
-                media = None  # One shot
-                resp.raise_for_status()
-                # TODO: Is this always image/png?
-                media_id = api.media_post(resp.raw, mime_type="image/png")
+    try:
+        # If we have media, we have some work to do!
+        if media is not None:
+            imgbytes = prepare_media(media, "mastodon")
+            if imgbytes is not None:
+                media_id = api.media_post(
+                    BytesIO(imgbytes), mime_type=media_type(imgbytes)
+                )
                 params["media_ids"] = [media_id]
-            return api.status_post(**params)
-        except Exception as exp:
-            emsg = f"User: {iembot_account_id} ({meta['screen_name']})"
-            params.pop("media_ids", None)  # Try again without media
-            # These are hopefully a class of non-user fault errors to retry
-            if isinstance(exp, MastodonIOError):
-                log.msg(f"MastodonIOError for {emsg}, {exp.args}")
-                time.sleep(kwargs.get("sleep", 30))
-                continue
-            if isinstance(exp, MastodonError):
-                if len(exp.args) > 1:
-                    if not isinstance(exp.args[1], int):
-                        log.msg(f"Unhandled MastodonError {emsg}, {exp.args}")
-                        return None
-                    if exp.args[1] >= 500:  # temp fail
-                        # Since this called from a thread, sleeping won't jam
-                        time.sleep(kwargs.get("sleep", 30))
-                        continue
-                if disable_user_by_mastodon_exp(bot, iembot_account_id, exp):
+        return api.status_post(**params)
+    except Exception as exp:
+        emsg = f"User: {iembot_account_id} ({meta['screen_name']})"
+        # These are hopefully a class of non-user fault errors to retry,
+        # which is done without the media
+        if isinstance(exp, MastodonIOError):
+            log.msg(f"MastodonIOError for {emsg}, {exp.args}")
+            raise RetryableError(str(exp), twitter_media=None) from exp
+        if isinstance(exp, MastodonError):
+            if len(exp.args) > 1:
+                if not isinstance(exp.args[1], int):
+                    log.msg(f"Unhandled MastodonError {emsg}, {exp.args}")
                     return None
-            log.msg(
-                f"Error sending to Mastodon {emsg}, {twttxt}' media:{media}"
-            )
-            # Something else bad happened when submitting this to the Mastodon
-            log.err(exp)
-            if attempt == 0:
-                # Since this called from a thread, sleeping should not jam
-                time.sleep(kwargs.get("sleep", 30))
-    return None
-
-
-def route(bot: JabberClient, channels: list, elem: Element):
+                if exp.args[1] >= 500:  # temp fail
+                    raise RetryableError(str(exp), twitter_media=None) from exp
+            if disable_user_by_mastodon_exp(bot, iembot_account_id, exp):
+                return None
+        log.msg(f"Error sending to Mastodon {emsg}, {twttxt}' media:{media}")
+        # Something else bad happened when submitting this to the Mastodon
+        log.err(exp)
+        raise RetryableError(str(exp), twitter_media=None) from exp
+
+
+def route(bot: JabberClient, message: IngestMessage):
     """Do Maston stuff."""
     # Require the x.twitter attribute to be set to prevent
     # confusion with some ingestors still sending tweets themselfs
-    if not elem.x or not elem.x.hasAttribute("twitter"):
+    if message.twitter_text is None:
         return
 
-    txt = safe_twitter_text(elem.x["twitter"])
-    twitter_media = elem.x.getAttribute("twitter_media")
-
-    alerted = []
-    for channel in channels:
-        for iembot_account_id in bot.md_routingtable.get(channel, []):
-            if iembot_account_id in alerted:
-                continue
-            alerted.append(iembot_account_id)
-            toot(
-                bot,
-                iembot_account_id,
-                txt,
-                twitter_media=twitter_media,
-            )
+    for iembot_account_id in bot.fanout.resolve(message.channels)["mastodon"]:
+        bot.deliver(
+            "mastodon",
+            iembot_account_id,
+            message.twitter_text,
+            twitter_media=message.twitter_media,
+        )
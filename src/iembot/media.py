@@ -0,0 +1,356 @@
+"""Shared cache of the ``twitter_media`` images sent along with messages.
+
+A product's image is posted by every subscribed account of every transport,
+so it is fetched once and the bytes handed to all of them.  The fetches
+happen within the delivery threads and are singleflight: the first thread
+asking for a url fetches it while the others asking meanwhile wait for that
+result, failures included, instead of fetching it again.  Fetched images
+are kept within a LRU bounded by total bytes and expire after a TTL, since
+a url like a radar image is updated in place.
+
+Each platform also limits the bytes and pixels of an image, so
+:func:`prepare_media` downsizes and recompresses the image to a platform's
+:class:`MediaProfile` rather than it being dropped or refused.  The
+encoding is CPU heavy, so it runs within a process pool and its result is
+cached per url and profile, once per product rather than once per account.
+Pillow is optional, without it images are passed as is when within the
+byte limit.
+
+The cache is sized within ``settings.json`` with the keys
+``bot.media.cache_bytes`` and ``bot.media.ttl``, the process pool with
+``bot.media.processes`` (0 to transform within the calling thread).
+"""
+
+from __future__ import annotations
+
+import math
+import multiprocessing
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from typing import TYPE_CHECKING, NamedTuple
+
+import requests
+from twisted.python import log
+
+try:
+    from PIL import Image
+except ImportError:  # pragma: no cover
+    Image = None
+
+if TYPE_CHECKING:
+    from collections.abc import Callable, Hashable
+
+# Total bytes of images to keep
+CACHE_BYTES = 64 * 1024 * 1024
+# Seconds to keep an image
+CACHE_TTL = 300
+# Seconds to wait for the fetch of an image
+FETCH_TIMEOUT = 30
+# Seconds to wait for the transform of an image
+TRANSFORM_TIMEOUT = 60
+# Processes transforming images
+PROCESSES = 2
+# JPEG qualities tried in turn when the PNG is too large
+JPEG_QUALITIES = (85, 70, 55, 40)
+
+
+class MediaProfile(NamedTuple):
+    """The image limits of a platform.
+
+    Attributes:
+        max_bytes (int): the largest encoded image.
+        max_pixels (int): the most pixels (width times height).
+    """
+
+    max_bytes: int
+    max_pixels: int
+
+
+PROFILES = {
+    "twitter": MediaProfile(5_242_880, 4096 * 4096),
+    "mastodon": MediaProfile(16_777_216, 3840 * 2160),
+    "atmosphere": MediaProfile(1_000_000, 2000 * 2000),
+}
+
+
+def _fetch(url: str) -> bytes:
+    """Fetch an image, raising for a non-2xx response."""
+    resp = requests.get(url, timeout=FETCH_TIMEOUT)
+    resp.raise_for_status()
+    return resp.content
+
+
+class MediaCache:
+    """Thread safe singleflight LRU cache of url (or other key) -> bytes.
+
+    Attributes:
+        max_bytes (int): the most bytes to keep.
+        ttl (float): seconds to keep an entry.
+        timeout (float): seconds to wait on another thread's fetch, which
+          must cover all that its fetcher may take.
+        hits (int): gets answered from the cache.
+        misses (int): gets that fetched the url.
+        coalesced (int): gets that waited on another thread's fetch.
+        evictions (int): entries dropped to stay within ``max_bytes``.
+        size (int): bytes currently kept.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = CACHE_BYTES,
+        ttl: float = CACHE_TTL,
+        fetcher: Callable[[Hashable], bytes] = _fetch,
+        timeout: float = FETCH_TIMEOUT * 2,
+    ):
+        """Constructor."""
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.fetcher = fetcher
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        # url -> (expires, bytes)
+        self._entries: OrderedDict[Hashable, tuple[float, bytes]] = (
+            OrderedDict()
+        )
+        self._inflight: dict[Hashable, Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.size = 0
+
+    def get(self, url: Hashable) -> bytes:
+        """Return the bytes of the url, blocking, so called from a thread.
+
+        Raises:
+            Exception: what fetching the url raised.
+        """
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self._entries.move_to_end(url)
+                    self.hits += 1
+                    return entry[1]
+                self._discard(url)
+            future = self._inflight.get(url)
+            if future is not None:
+                self.coalesced += 1
+                leader = False
+            else:
+                future = Future()
+                self._inflight[url] = future
+                self.misses += 1
+                leader = True
+        if not leader:
+            return future.result(timeout=self.timeout)
+        try:
+            content = self.fetcher(url)
+        except Exception as exp:
+            future.set_exception(exp)
+            raise
+        else:
+            future.set_result(content)
+            self._store(url, content)
+            return content
+        finally:
+            with self._lock:
+                self._inflight.pop(url, None)
+
+    def _store(self, url: Hashable, content: bytes):
+        """Keep the content, when it fits."""
+        if len(content) > self.max_bytes:
+            log.msg(f"{url} is too large ({len(content)}) to cache")
+            return
+        with self._lock:
+            self._discard(url)
+            self._entries[url] = (time.monotonic() + self.ttl, content)
+            self.size += len(content)
+            while self.size > self.max_bytes:
+                _url, (_expires, old_content) = self._entries.popitem(
+                    last=False
+                )
+                self.size -= len(old_content)
+                self.evictions += 1
+
+    def _discard(self, url: Hashable):
+        """Drop an entry, the lock being held."""
+        entry = self._entries.pop(url, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+
+    def clear(self):
+        """Drop all entries."""
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self) -> dict[str, int]:
+        """Return the bookkeeping for the status endpoint."""
+        with self._lock:
+            return {
+                "media.entries": len(self._entries),
+                "media.bytes": self.size,
+                "media.hits": self.hits,
+                "media.misses": self.misses,
+                "media.coalesced": self.coalesced,
+                "media.evictions": self.evictions,
+            }
+
+
+def media_type(content: bytes) -> str:
+    """Return the mime type of an encoded image."""
+    if content.startswith(b"\xff\xd8"):
+        return "image/jpeg"
+    if content.startswith(b"GIF8"):
+        return "image/gif"
+    return "image/png"
+
+
+def _encode(img, max_bytes: int) -> bytes | None:
+    """Encode as PNG, else as JPEG of decreasing quality, within the bytes."""
+    buf = BytesIO()
+    img.save(buf, format="PNG", optimize=True)
+    if buf.tell() <= max_bytes:
+        return buf.getvalue()
+    rgb = img.convert("RGB")
+    for quality in JPEG_QUALITIES:
+        buf = BytesIO()
+        rgb.save(buf, format="JPEG", quality=quality, optimize=True)
+        if buf.tell() <= max_bytes:
+            return buf.getvalue()
+    return None
+
+
+def transform(content: bytes, max_bytes: int, max_pixels: int) -> bytes:
+    """Fit an image within the limits, run within the process pool.
+
+    Returns:
+        bytes: the image, as is when it already fits, empty when it can not
+          be made to fit.
+    """
+    if Image is None:
+        return content if len(content) <= max_bytes else b""
+    try:
+        img = Image.open(BytesIO(content))
+        pixels = img.width * img.height
+    except Exception:
+        # Not an image that we understand, let the platform decide
+        return content if len(content) <= max_bytes else b""
+    if len(content) <= max_bytes and pixels <= max_pixels:
+        return content
+    if img.mode not in ("RGB", "RGBA", "L", "P"):
+        img = img.convert("RGBA")
+    scale = min(1.0, math.sqrt(max_pixels / pixels))
+    # Shrink further until the encoding fits, giving up at a thumbnail
+    while scale * max(img.width, img.height) >= 200:
+        if scale < 1:
+            resized = img.resize(
+                (int(img.width * scale), int(img.height * scale)),
+                Image.Resampling.LANCZOS,
+            )
+        else:
+            resized = img
+        encoded = _encode(resized, max_bytes)
+        if encoded is not None:
+            return encoded
+        scale *= 0.75
+    return b""
+
+
+MEDIA_CACHE = MediaCache()
+_POOL: ProcessPoolExecutor | None = None
+_POOL_LOCK = threading.Lock()
+
+
+def _transform_in_pool(key: tuple[str, str]) -> bytes:
+    """Fetch and transform an image for a profile, called from a thread."""
+    url, profile = key
+    content = MEDIA_CACHE.get(url)
+    limits = PROFILES[profile]
+    if PROCESSES < 1:
+        return transform(content, *limits)
+    pool = _get_pool()
+    try:
+        return pool.submit(transform, content, *limits).result(
+            timeout=TRANSFORM_TIMEOUT
+        )
+    except BrokenProcessPool:
+        # A worker died, so the pool refuses all work until replaced
+        _drop_pool(pool)
+        raise
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    """Return the process pool, starting it when needed."""
+    global _POOL  # noqa: PLW0603
+    with _POOL_LOCK:
+        if _POOL is None:
+            # spawn, as forking a threaded reactor process is not safe
+            _POOL = ProcessPoolExecutor(
+                PROCESSES, mp_context=multiprocessing.get_context("spawn")
+            )
+        return _POOL
+
+
+def _drop_pool(pool: ProcessPoolExecutor):
+    """Forget a broken pool, so the next transform starts another."""
+    global _POOL  # noqa: PLW0603
+    with _POOL_LOCK:
+        if _POOL is not pool:
+            # Another thread replaced it already
+            return
+        log.msg("Media process pool is broken, replacing it")
+        _POOL = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+# The leader may wait on the image as a follower, then on its transform
+PREPARED_CACHE = MediaCache(
+    fetcher=_transform_in_pool,
+    timeout=MEDIA_CACHE.timeout + TRANSFORM_TIMEOUT,
+)
+
+
+def configure_media_cache(config: dict):
+    """Size the media caches with settings found within the config."""
+    global PROCESSES  # noqa: PLW0603
+    for cache in (MEDIA_CACHE, PREPARED_CACHE):
+        cache.max_bytes = int(config.get("bot.media.cache_bytes", CACHE_BYTES))
+        cache.ttl = float(config.get("bot.media.ttl", CACHE_TTL))
+    PROCESSES = int(config.get("bot.media.processes", PROCESSES))
+
+
+def shutdown_media_pool():
+    """Stop the transform processes, if started."""
+    global _POOL  # noqa: PLW0603
+    with _POOL_LOCK:
+        if _POOL is not None:
+            _POOL.shutdown(wait=False, cancel_futures=True)
+            _POOL = None
+
+
+def fetch_media(url: str) -> bytes:
+    """Return the bytes of a ``twitter_media`` url, called from a thread."""
+    return MEDIA_CACHE.get(url)
+
+
+def prepare_media(url: str, profile: str) -> bytes | None:
+    """Return the image of a url fit for a platform, called from a thread.
+
+    Args:
+        url (str): the ``twitter_media`` url.
+        profile (str): a key of ``PROFILES``.
+
+    Returns:
+        bytes or None when the image can not be made to fit.
+
+    Raises:
+        Exception: what fetching the url raised.
+    """
+    content = PREPARED_CACHE.get((url, profile))
+    return content or None
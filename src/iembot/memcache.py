@@ -5,9 +5,10 @@ from __future__ import annotations
 from typing import TYPE_CHECKING
 
 from pymemcache.client.base import Client as MemcacheClient
-from twisted.internet import threads
 from twisted.python import log
 
+from iembot.executors import defer_to_executor
+
 if TYPE_CHECKING:
     from twisted.internet.defer import Deferred
 
@@ -48,7 +49,7 @@ class ThreadedMemcacheClient:
                 except Exception as exp:
                     log.err(exp)
 
-        return threads.deferToThread(_get)
+        return defer_to_executor("memcache", _get)
 
 
 def build_memcache_client(memcache: str = "") -> ThreadedMemcacheClient:
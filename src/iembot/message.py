@@ -0,0 +1,119 @@
+"""The messages received from the ingest system, parsed once.
+
+Each routed message was handed as its ``Element`` to every transport, each
+reading the ``x`` attributes again and normalizing the same twitter text.
+:func:`prepare_message` instead parses the stanza once into an immutable
+:class:`IngestMessage` that all the handlers consume.
+"""
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+from pyiem.util import utc
+
+from iembot.util import safe_twitter_text
+
+if TYPE_CHECKING:
+    from twisted.words.xish.domish import Element
+
+
+class IngestMessage:
+    """A message to route, its attributes can not be changed.
+
+    Attributes:
+        elem (Element): the stanza, sent to the chatrooms.
+        channels (tuple[str, ...]): the channels to route to.
+        body (str): the text body.
+        html (Element | None): the XHTML body.
+        product_id (str | None): the product, for the room logs.
+        twitter (str | None): the ``x`` twitter text, as sent.
+        twitter_text (str | None): the twitter text fit for social media.
+        twitter_media (str | None): the url of the media to attach.
+        lat (str | None): the latitude of the message.
+        long (str | None): the longitude of the message.
+        valid (datetime): when the message was received.
+    """
+
+    __slots__ = (
+        "body",
+        "channels",
+        "elem",
+        "html",
+        "lat",
+        "long",
+        "product_id",
+        "twitter",
+        "twitter_media",
+        "twitter_text",
+        "valid",
+    )
+
+    def __init__(self, elem: Element, channels, body: str, **kwargs):
+        """Constructor, the keyword arguments set the other attributes."""
+        setter = super().__setattr__
+        setter("elem", elem)
+        setter("channels", tuple(channels))
+        setter("body", body)
+        setter("valid", kwargs.pop("valid", None) or utc())
+        for attr in self.__slots__:
+            if attr not in ("body", "channels", "elem", "valid"):
+                setter(attr, kwargs.pop(attr, None))
+        if kwargs:
+            raise TypeError(f"Unknown attributes {sorted(kwargs)}")
+
+    def __setattr__(self, name, value):
+        """Refuse changes, as the message is shared by the handlers."""
+        raise AttributeError(f"IngestMessage.{name} is read-only")
+
+    def __delattr__(self, name):
+        """Refuse changes, as the message is shared by the handlers."""
+        raise AttributeError(f"IngestMessage.{name} is read-only")
+
+    def __repr__(self) -> str:
+        """Represent the message by its channels and body."""
+        return f"IngestMessage({self.channels!r}, {self.body[:40]!r})"
+
+
+def prepare_message(elem: Element, channels=None) -> IngestMessage | None:
+    """Parse the stanza, returning ``None`` for one without a body.
+
+    Args:
+      elem (Element): the message stanza.
+      channels (list, optional): the channels to route to, by default those
+        of the ``x`` element or else the body's prefix.
+    """
+    body = x = html = None
+    for child in elem.elements():
+        if child.name == "body" and body is None:
+            body = str(child)
+        elif child.name == "x" and x is None:
+            x = child
+        elif child.name == "html" and html is None:
+            html = child
+    if not body:
+        return None
+    if channels is None:
+        if x is not None and x.hasAttribute("channels"):
+            channels = x["channels"].split(",")
+        else:
+            channels = [body.split(":", 1)[0]]
+    if html is not None:
+        html = next(
+            (child for child in html.elements() if child.name == "body"),
+            None,
+        )
+    kwargs = {}
+    if x is not None:
+        twitter = x.getAttribute("twitter")
+        kwargs = {
+            "product_id": x.getAttribute("product_id"),
+            "twitter": twitter,
+            "twitter_text": (
+                None if twitter is None else safe_twitter_text(twitter)
+            ),
+            "twitter_media": x.getAttribute("twitter_media"),
+            "lat": x.getAttribute("lat"),
+            "long": x.getAttribute("long"),
+        }
+    return IngestMessage(elem, channels, body, html=html, **kwargs)
@@ -8,13 +8,17 @@ from twisted.words.xish import xpath
 from twisted.words.xish.domish import Element
 
 from iembot import ROOM_LOG_ENTRY
+from iembot.message import prepare_message
 from iembot.types import JabberClient
 
 REGISTERED_HANDLERS = []
 
 
 def register_handler(handler: callable):
-    """Add a message handler to the registry."""
+    """Add a message handler to the registry.
+
+    A handler is called with the bot and the :class:`IngestMessage`.
+    """
     if handler not in REGISTERED_HANDLERS:
         REGISTERED_HANDLERS.append(handler)
 
@@ -45,28 +49,19 @@ def process_privatechat(bot: JabberClient, elem: Element) -> None:
 
 def process_message_from_ingest(bot: JabberClient, elem: Element) -> None:
     """Process a message received from the ingest system."""
-
-    # Go look for body to see routing info!
-    # Get the body string
-    bstring = xpath.queryForString("/message/body", elem)
-    if not bstring:
+    # Parsed once for all the handlers
+    message = prepare_message(elem)
+    if message is None:
         log.msg("Nothing found in body?")
         return
 
-    if elem.x and elem.x.hasAttribute("channels"):
-        channels = elem.x["channels"].split(",")
-    else:
-        # The body string contains
-        channel = bstring.split(":", 1)[0]
-        channels = [channel]
-
     # Always send to botstalk
     elem["to"] = f"botstalk@{bot.config['bot.mucservice']}"
     elem["type"] = "groupchat"
     bot.send_groupchat_elem(elem)
 
     for handler in REGISTERED_HANDLERS:
-        handler(bot, channels, elem)
+        handler(bot, message)
 
 
 def process_groupchat(bot: JabberClient, elem: Element) -> None:
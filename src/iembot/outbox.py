@@ -0,0 +1,239 @@
+"""Durable outbound delivery queue.
+
+Social media and webhook deliveries are otherwise only found within
+Deferreds and thread queues, so a restart of the bot loses them.  When the
+bot has an :class:`Outbox`, :meth:`JabberClient.deliver` records each
+delivery within a SQLite database (in WAL mode) before handing it to the
+transport, and removes it once the transport is done with it, whether it
+succeeded or gave up.  The deliveries left over by the previous process are
+handed to the transports again after the first subscription reload.
+
+Writes stay off the reactor thread.  Enqueued deliveries and completions
+are buffered in memory and written by the ``outbox`` executor in a single
+transaction every ``FLUSH_INTERVAL`` seconds, so there is one fsync per
+batch rather than per delivery.  A crash may so lose the last interval of
+deliveries, the buffer is flushed at a clean shutdown.
+"""
+
+from __future__ import annotations
+
+import json
+import sqlite3
+import time
+from typing import TYPE_CHECKING
+
+from twisted.internet import defer, reactor
+from twisted.internet.task import LoopingCall
+from twisted.python import log
+
+from iembot.executors import defer_to_executor
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+
+# Seconds between writes of the buffered changes
+FLUSH_INTERVAL = 0.1
+# Deliveries to resume at a time, and the seconds between
+RESUME_BATCH = 100
+RESUME_INTERVAL = 1
+# Seconds after which a delivery is too stale to resume
+MAX_AGE = 3600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox(
+    id INTEGER PRIMARY KEY,
+    transport TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    created REAL NOT NULL)
+"""
+
+
+class Outbox:
+    """A SQLite backed queue of the deliveries in flight.
+
+    Attributes:
+        path (str): the database file.
+        dispatch (callable): ``dispatch(transport, args, kwargs)`` hands a
+          delivery to its transport, returning a Deferred firing when done,
+          or ``None`` when done already.
+        pending (list): rows to be inserted by the next flush.
+        acks (list): ids to be deleted by the next flush.
+        enqueued (int): deliveries recorded.
+        completed (int): deliveries the transports are done with.
+        resumed (int): deliveries resumed from the previous process.
+        expired (int): deliveries too stale to resume.
+        flushes (int): batches written.
+        failures (int): batches whose write failed, kept for the next.
+    """
+
+    def __init__(self, path: str, dispatch: Callable, clock=None):
+        """Constructor.
+
+        Args:
+            path (str): the database file.
+            dispatch (callable): hands a delivery to its transport.
+            clock (IReactorTime, optional): schedules the resumption.
+        """
+        self.path = path
+        self.dispatch = dispatch
+        self.clock = clock or reactor
+        self.conn = None
+        self.next_id = 1
+        self.pending: list[tuple] = []
+        self.acks: list[int] = []
+        self.leftover: list[tuple] = []
+        self.flushing: defer.Deferred | None = None
+        self.enqueued = 0
+        self.completed = 0
+        self.resumed = 0
+        self.expired = 0
+        self.flushes = 0
+        self.failures = 0
+        self._lc = LoopingCall(self.flush)
+        self._lc.clock = self.clock
+
+    def open(self):
+        """Open the database and find the leftovers, blocking at startup."""
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # Each batch is one transaction, so one fsync
+        self.conn.execute("PRAGMA synchronous=FULL")
+        self.conn.execute(SCHEMA)
+        self.leftover = self.conn.execute(
+            "SELECT id, transport, payload, created FROM outbox ORDER by id"
+        ).fetchall()
+        if self.leftover:
+            self.next_id = self.leftover[-1][0] + 1
+        log.msg(f"Outbox {self.path} has {len(self.leftover)} deliveries")
+
+    def start(self):
+        """Start writing batches and flush them at shutdown."""
+        self._lc.start(FLUSH_INTERVAL, now=False)
+        reactor.addSystemEventTrigger("before", "shutdown", self.stop)
+
+    def stop(self) -> defer.Deferred:
+        """Flush what is buffered and close the database."""
+        if self._lc.running:
+            self._lc.stop()
+        df = defer.maybeDeferred(self.flush)
+        df.addCallback(lambda _: self.flush())
+        df.addCallback(lambda _: self.conn.close())
+        return df
+
+    def put(self, transport: str, *args, **kwargs) -> defer.Deferred | None:
+        """Record a delivery and hand it to the transport.
+
+        The arguments must be JSON serializable, so it can be resumed.
+        """
+        outbox_id = self.next_id
+        self.next_id += 1
+        self.enqueued += 1
+        self.pending.append(
+            (
+                outbox_id,
+                transport,
+                json.dumps([args, kwargs]),
+                time.time(),
+            )
+        )
+        return self._dispatch(outbox_id, transport, args, kwargs)
+
+    def _dispatch(self, outbox_id: int, transport: str, args, kwargs):
+        """Hand a delivery to the transport, acking it when done."""
+        try:
+            df = self.dispatch(transport, args, kwargs)
+        except Exception as exp:
+            log.err(exp)
+            df = None
+        if df is None:
+            self.ack(outbox_id)
+            return None
+        df.addBoth(self._completed, outbox_id)
+        return df
+
+    def _completed(self, res, outbox_id: int):
+        """Transport is done with the delivery, passing its result on."""
+        self.ack(outbox_id)
+        return res
+
+    def ack(self, outbox_id: int):
+        """Forget a delivery with the next flush."""
+        self.completed += 1
+        self.acks.append(outbox_id)
+
+    def resume(self):
+        """Hand the previous process' deliveries to the transports again."""
+        rows, self.leftover = self.leftover, []
+        cutoff = time.time() - MAX_AGE
+        fresh = []
+        for row in rows:
+            if row[3] < cutoff:
+                self.expired += 1
+                self.ack(row[0])
+            else:
+                fresh.append(row)
+        if self.expired:
+            log.msg(f"Outbox dropped {self.expired} stale deliveries")
+        self._resume(fresh)
+
+    def _resume(self, rows: list[tuple]):
+        """Resume a batch of deliveries and schedule the next."""
+        for outbox_id, transport, payload, _created in rows[:RESUME_BATCH]:
+            args, kwargs = json.loads(payload)
+            self.resumed += 1
+            self._dispatch(outbox_id, transport, args, kwargs)
+        if len(rows) > RESUME_BATCH:
+            self.clock.callLater(
+                RESUME_INTERVAL, self._resume, rows[RESUME_BATCH:]
+            )
+
+    def flush(self) -> defer.Deferred | None:
+        """Write the buffered changes within the ``outbox`` executor."""
+        if self.flushing is not None:
+            return self.flushing
+        if not self.pending and not self.acks:
+            return None
+        rows, self.pending = self.pending, []
+        acks, self.acks = self.acks, []
+        self.flushing = defer_to_executor("outbox", self._write, rows, acks)
+        self.flushing.addErrback(self._failed, rows, acks)
+        self.flushing.addBoth(self._flushed)
+        return self.flushing
+
+    def _failed(self, failure, rows: list[tuple], acks: list[int]):
+        """Keep the changes of a failed write for the next flush."""
+        log.err(failure, "Writing the outbox failed")
+        self.failures += 1
+        self.pending[:0] = rows
+        self.acks[:0] = acks
+
+    def _flushed(self, _res):
+        """Allow the next flush."""
+        self.flushing = None
+        self.flushes += 1
+
+    def _write(self, rows: list[tuple], acks: list[int]):
+        """Insert and delete a batch within one transaction, in a thread."""
+        with self.conn:
+            self.conn.executemany(
+                "INSERT INTO outbox(id, transport, payload, created) "
+                "VALUES (?, ?, ?, ?)",
+                rows,
+            )
+            self.conn.executemany(
+                "DELETE FROM outbox WHERE id = ?", [(i,) for i in acks]
+            )
+
+    def stats(self) -> dict[str, int]:
+        """Return the bookkeeping for the status endpoint."""
+        return {
+            "outbox.enqueued": self.enqueued,
+            "outbox.completed": self.completed,
+            "outbox.inflight": (
+                self.enqueued + self.resumed + self.expired - self.completed
+            ),
+            "outbox.resumed": self.resumed,
+            "outbox.expired": self.expired,
+            "outbox.flushes": self.flushes,
+            "outbox.failures": self.failures,
+        }
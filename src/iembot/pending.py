@@ -0,0 +1,100 @@
+"""Groupchat messages waiting for their chatroom to be joined.
+
+After a (re)connect, hundreds of chatrooms are joined over a minute or so
+and the messages routed to a room not joined yet were retried once after a
+random delay, then dropped.  They are instead queued per room by
+:class:`PendingSends`, already serialized, and sent in order as soon as the
+room's self-presence (MUC status code 110) says it is joined.
+
+A room queues at most ``bot.pending.size`` messages, the oldest being
+dropped for a newer one, and a message is dropped once it waited
+``bot.pending.ttl`` seconds.  The messages of a room the bot is reported
+to have left are dropped right away.
+"""
+
+from __future__ import annotations
+
+from collections import deque
+
+from twisted.internet import reactor
+from twisted.python import log
+
+# Messages queued per room
+SIZE = 50
+# Seconds a message may wait for its room
+TTL = 300
+
+
+class PendingSends:
+    """The per-room queues of serialized groupchat messages.
+
+    Attributes:
+        size (int): messages queued per room.
+        ttl (float): seconds a message may wait.
+        queued (int): messages queued.
+        sent (int): messages sent once their room was joined.
+        expired (int): messages dropped as too old.
+        dropped (int): messages dropped for a full queue or a room left.
+    """
+
+    def __init__(self, size: int = SIZE, ttl: float = TTL, clock=None):
+        """Constructor."""
+        self.size = size
+        self.ttl = ttl
+        self.clock = clock or reactor
+        # room -> deque of (expires, raw)
+        self.rooms: dict[str, deque[tuple[float, bytes]]] = {}
+        self.queued = 0
+        self.sent = 0
+        self.expired = 0
+        self.dropped = 0
+
+    def add(self, room: str, raw: bytes):
+        """Queue the serialized message until the room is joined."""
+        now = self.clock.seconds()
+        queue = self.rooms.setdefault(room, deque())
+        self._expire(queue, now)
+        if len(queue) >= self.size:
+            queue.popleft()
+            self.dropped += 1
+        queue.append((now + self.ttl, raw))
+        self.queued += 1
+
+    def flush(self, room: str) -> list[bytes]:
+        """Return the room's messages to send, in order, forgetting them."""
+        queue = self.rooms.pop(room, None)
+        if not queue:
+            return []
+        self._expire(queue, self.clock.seconds())
+        if queue:
+            log.msg(f"Sending {len(queue)} messages queued for {room}")
+        self.sent += len(queue)
+        return [raw for _expires, raw in queue]
+
+    def discard(self, room: str) -> int:
+        """Drop the room's messages as it was left, returning how many."""
+        queue = self.rooms.pop(room, None)
+        if not queue:
+            return 0
+        self._expire(queue, self.clock.seconds())
+        if queue:
+            log.msg(f"Dropping {len(queue)} messages queued for {room}")
+        self.dropped += len(queue)
+        return len(queue)
+
+    def _expire(self, queue: deque, now: float):
+        """Drop the messages of the queue that waited too long."""
+        while queue and queue[0][0] <= now:
+            queue.popleft()
+            self.expired += 1
+
+    def stats(self) -> dict[str, int]:
+        """Return the bookkeeping for the status endpoint."""
+        return {
+            "pending.rooms": len(self.rooms),
+            "pending.waiting": sum(len(q) for q in self.rooms.values()),
+            "pending.queued": self.queued,
+            "pending.sent": self.sent,
+            "pending.expired": self.expired,
+            "pending.dropped": self.dropped,
+        }
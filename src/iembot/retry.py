@@ -0,0 +1,174 @@
+"""Retry blocking deliveries without holding a thread while waiting.
+
+A delivery attempt runs within its subsystem's executor and raises
+:class:`RetryableError` (or another exception listed by the transport's
+:class:`RetryPolicy`) when it should be tried again.  The thread is then
+released and the next attempt is scheduled on the reactor with
+``callLater``, using exponential backoff with jitter.  So an outage of one
+destination does not fill a pool with sleeping threads.
+
+Policies are configured within ``settings.json`` with keys like
+``bot.retry.twitter.attempts``, ``bot.retry.twitter.delay`` and
+``bot.retry.twitter.max_delay``.
+"""
+
+from __future__ import annotations
+
+import random
+from typing import TYPE_CHECKING, NamedTuple
+
+from requests import RequestException
+from twisted.internet import defer, reactor
+from twisted.python import log
+
+from iembot.asynchttp import TRANSIENT_ERRORS
+from iembot.executors import defer_to_executor
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+
+    from twisted.python.failure import Failure
+
+
+class RetryableError(Exception):
+    """Raised by a delivery attempt that should be tried again later.
+
+    Attributes:
+        changes (dict): keyword arguments to update for the next attempt,
+          for example to drop media that failed.
+    """
+
+    def __init__(self, msg: str, **changes):
+        """Constructor."""
+        super().__init__(msg)
+        self.changes = changes
+
+
+class RetriesExhausted(Exception):
+    """Raised when the last attempt allowed by the policy failed."""
+
+
+class RetryPolicy(NamedTuple):
+    """How often and how long to wait before trying again.
+
+    Attributes:
+        attempts (int): the total number of attempts.
+        delay (float): seconds to wait after the first failed attempt.
+        backoff (float): multiplier of the delay for each further attempt.
+        max_delay (float): the most seconds to wait.
+        jitter (float): +/- fraction of random jitter applied to the delay.
+        retry_on (tuple): the exception types to retry.
+    """
+
+    attempts: int = 2
+    delay: float = 30
+    backoff: float = 2
+    max_delay: float = 600
+    jitter: float = 0.2
+    retry_on: tuple[type[Exception], ...] = (RetryableError,)
+
+    def next_delay(self, attempt: int) -> float:
+        """Return the seconds to wait after the given failed attempt."""
+        delay = min(self.max_delay, self.delay * self.backoff ** (attempt - 1))
+        if self.jitter:
+            delay *= random.uniform(1 - self.jitter, 1 + self.jitter)
+        return delay
+
+
+RETRY_POLICIES = {
+    "twitter": RetryPolicy(),
+    "mastodon": RetryPolicy(),
+    "webhooks": RetryPolicy(retry_on=(RequestException, *TRANSIENT_ERRORS)),
+    "atmosphere": RetryPolicy(attempts=6),
+}
+# "<name>.retried" and "<name>.exhausted" -> count
+RETRY_COUNTS: dict[str, int] = {}
+
+
+def configure_retry_policies(config: dict):
+    """Update the retry policies with settings found within the config."""
+    for name, policy in list(RETRY_POLICIES.items()):
+        RETRY_POLICIES[name] = policy._replace(
+            attempts=int(
+                config.get(f"bot.retry.{name}.attempts", policy.attempts)
+            ),
+            delay=float(config.get(f"bot.retry.{name}.delay", policy.delay)),
+            max_delay=float(
+                config.get(f"bot.retry.{name}.max_delay", policy.max_delay)
+            ),
+        )
+
+
+def _count(key: str):
+    """Increment a retry counter."""
+    RETRY_COUNTS[key] = RETRY_COUNTS.get(key, 0) + 1
+
+
+def retry_call(
+    name: str,
+    func: Callable,
+    *args,
+    policy: RetryPolicy | None = None,
+    clock=None,
+    threaded: bool = True,
+    **kwargs,
+) -> defer.Deferred:
+    """Run ``func`` within the named executor, retrying per the policy.
+
+    With ``threaded`` false, ``func`` instead runs on the reactor and
+    returns a Deferred, as the asynchronous HTTP deliveries do.
+
+    The historical ``sleep`` keyword argument, when provided, overrides the
+    policy's delay and disables the jitter.
+
+    Args:
+        name (str): the executor and retry policy name.
+        func (callable): the blocking delivery attempt.
+        policy (RetryPolicy, optional): overrides the named policy.
+        clock (IReactorTime, optional): schedules the retries.
+        threaded (bool): run ``func`` within the executor.
+
+    Returns:
+        Deferred: firing with the result of the successful attempt, or
+          failing with :class:`RetriesExhausted`.
+    """
+    policy = policy or RETRY_POLICIES[name]
+    if "sleep" in kwargs:
+        policy = policy._replace(delay=kwargs["sleep"], jitter=0)
+    clock = clock or reactor
+    result = defer.Deferred()
+
+    def _attempt(attempt: int):
+        if threaded:
+            df = defer_to_executor(name, func, *args, **kwargs)
+        else:
+            df = defer.maybeDeferred(func, *args, **kwargs)
+        df.addCallbacks(result.callback, _failed, errbackArgs=(attempt,))
+
+    def _failed(failure: Failure, attempt: int):
+        if not failure.check(*policy.retry_on):
+            result.errback(failure)
+            return
+        if attempt >= policy.attempts:
+            _count(f"{name}.exhausted")
+            exp = RetriesExhausted(
+                f"{name} gave up after {attempt} attempts: {failure.value}"
+            )
+            exp.__cause__ = failure.value
+            result.errback(exp)
+            return
+        if failure.check(RetryableError):
+            kwargs.update(failure.value.changes)
+        _count(f"{name}.retried")
+        delay = policy.next_delay(attempt)
+        log.msg(f"Retrying {name} in {delay:.1f}s after: {failure.value}")
+        clock.callLater(delay, _attempt, attempt + 1)
+
+    _attempt(1)
+    return result
+
+
+def log_exhausted(failure: Failure):
+    """Errback logging, rather than raising, a :class:`RetriesExhausted`."""
+    failure.trap(RetriesExhausted)
+    log.msg(str(failure.value))
@@ -0,0 +1,350 @@
+"""Compiled message fanout index.
+
+Each ``load_*_from_db`` function builds a ``channel -> [target, ...]``
+table for its transport and compiles it into an immutable
+:class:`RoutingTable` of frozensets.  Resolving the targets of a message is
+then a union of the sets found for its channels, which also dedups targets
+that are subscribed to more than one of the channels.  A reverse index of
+target -> channels is kept alongside for the subscription admin commands.
+
+Channel groups are kept as an indirection level rather than expanded into
+each of their channels.  The ``groups`` pseudo-transport holds the
+channel -> groups membership shared by all transports and each transport's
+table holds its group -> targets subscriptions, so the index grows with
+the number of subscriptions and not by subscriptions times group size.
+
+The loaders run within ``dbpool.runInteraction`` threads, so they do not
+touch the running bot.  They return a :class:`RoutingSnapshot` and the
+reactor thread swaps it into the :class:`FanoutIndex` as a single reference,
+so message routing never sees a partially built table nor needs a lock.
+
+Ingest repeats the same channel combinations many times over (every update
+of a warning), so :meth:`FanoutIndex.resolve` keeps a bounded LRU cache of
+the results keyed by the set of channels.  Cache entries are stamped with
+the ``generation`` of the index, which every swap bumps.
+"""
+
+from __future__ import annotations
+
+from collections import OrderedDict
+from types import MappingProxyType
+from typing import TYPE_CHECKING, Any, NamedTuple
+
+if TYPE_CHECKING:
+    from collections.abc import Hashable, Iterable, Mapping
+
+# The transports (message handlers) that consume the index
+TRANSPORTS = (
+    "xmpp",
+    "twitter",
+    "mastodon",
+    "atmosphere",
+    "slack",
+    "webhooks",
+)
+
+# Pseudo-transport holding the channel -> group membership
+GROUPS = "groups"
+
+EMPTY = frozenset()
+EMPTY_MAPPING = MappingProxyType({})
+# Number of distinct channel combinations to keep resolved
+CACHE_SIZE = 4096
+
+
+def _replace(mapping: Mapping, key: Hashable, values: frozenset):
+    """Copy the mapping with one entry set, or removed when empty."""
+    res = dict(mapping)
+    if values:
+        res[key] = values
+    else:
+        res.pop(key, None)
+    return MappingProxyType(res)
+
+
+class RoutingTable(NamedTuple):
+    """Immutable compiled subscriptions of a single transport.
+
+    Attributes:
+        channels (Mapping): channel -> frozenset of targets.
+        targets (Mapping): target -> frozenset of channels.
+        groups (Mapping): group_id -> frozenset of targets.
+    """
+
+    channels: Mapping[str, frozenset]
+    targets: Mapping[Hashable, frozenset]
+    groups: Mapping[int, frozenset] = EMPTY_MAPPING
+
+    @classmethod
+    def compile(
+        cls,
+        table: dict[str, Iterable[Hashable]],
+        groups: dict[int, Iterable[Hashable]] | None = None,
+    ) -> RoutingTable:
+        """Compile ``channel -> [target, ...]`` tables, safe off-thread.
+
+        Args:
+            table (dict): channel -> iterable of targets.
+            groups (dict, optional): group_id -> iterable of targets.
+        """
+        channels = {
+            channel: frozenset(targets)
+            for channel, targets in table.items()
+            if targets
+        }
+        reverse: dict[Hashable, set[str]] = {}
+        for channel, targets in channels.items():
+            for target in targets:
+                reverse.setdefault(target, set()).add(channel)
+        return cls(
+            MappingProxyType(channels),
+            MappingProxyType(
+                {target: frozenset(chans) for target, chans in reverse.items()}
+            ),
+            MappingProxyType(
+                {
+                    group: frozenset(targets)
+                    for group, targets in (groups or {}).items()
+                    if targets
+                }
+            ),
+        )
+
+    def groups_of(self, target: Hashable) -> frozenset:
+        """Return the groups a target is subscribed to."""
+        return frozenset(
+            group
+            for group, targets in self.groups.items()
+            if target in targets
+        )
+
+    def add(self, channel: str, target: Hashable) -> RoutingTable:
+        """Return a copy of the table with a subscription added."""
+        return self._replace(
+            channels=_replace(
+                self.channels,
+                channel,
+                self.channels.get(channel, EMPTY) | {target},
+            ),
+            targets=_replace(
+                self.targets,
+                target,
+                self.targets.get(target, EMPTY) | {channel},
+            ),
+        )
+
+    def discard(self, channel: str, target: Hashable) -> RoutingTable:
+        """Return a copy of the table with a subscription removed."""
+        return self._replace(
+            channels=_replace(
+                self.channels,
+                channel,
+                self.channels.get(channel, EMPTY) - {target},
+            ),
+            targets=_replace(
+                self.targets,
+                target,
+                self.targets.get(target, EMPTY) - {channel},
+            ),
+        )
+
+    def replace_target(
+        self,
+        target: Hashable,
+        channels: Iterable[str],
+        groups: Iterable[int] = (),
+    ) -> RoutingTable:
+        """Return a copy of the table with a target's subscriptions replaced.
+
+        Args:
+            target: the chatroom or iembot_account_id.
+            channels (iterable): the complete channels for the target, empty
+              to remove the target.
+            groups (iterable): the complete groups for the target.
+        """
+        channels = frozenset(channels)
+        groups = frozenset(groups)
+        old = self.targets.get(target, EMPTY)
+        old_groups = self.groups_of(target)
+        if channels == old and groups == old_groups:
+            return self
+        return self._replace(
+            channels=_retarget(self.channels, target, old, channels),
+            targets=_replace(self.targets, target, channels),
+            groups=_retarget(self.groups, target, old_groups, groups),
+        )
+
+
+def _retarget(
+    mapping: Mapping, target: Hashable, old: frozenset, new: frozenset
+):
+    """Copy a key -> targets mapping with a target moved between keys."""
+    res = dict(mapping)
+    for key in old - new:
+        targets = res[key] - {target}
+        if targets:
+            res[key] = targets
+        else:
+            del res[key]
+    for key in new - old:
+        res[key] = res.get(key, EMPTY) | {target}
+    return MappingProxyType(res)
+
+
+EMPTY_TABLE = RoutingTable(EMPTY_MAPPING, EMPTY_MAPPING)
+
+
+class RoutingSnapshot(NamedTuple):
+    """What a ``load_*_from_db`` built for the reactor to swap in.
+
+    Attributes:
+        transport (str): one of ``TRANSPORTS``.
+        table (RoutingTable): the compiled subscriptions.
+        accounts (dict): account metadata keyed by target.
+    """
+
+    transport: str
+    table: RoutingTable
+    accounts: dict[Hashable, Any]
+
+
+class FanoutIndex:
+    """Map each channel to a set of targets per transport.
+
+    Targets are chatroom names for ``xmpp`` and ``iembot_account_id`` values
+    for the other transports.  The methods changing the index are to be
+    called from the reactor thread only.
+
+    Attributes:
+        tables (Mapping): transport -> RoutingTable, replaced on each swap.
+        generation (int): counter bumped by every change to ``tables``.
+        cache_size (int): maximum number of cached resolutions.
+        cache_hits (int): number of ``resolve`` calls served from cache.
+        cache_misses (int): number of ``resolve`` calls computed.
+    """
+
+    def __init__(self, cache_size: int = CACHE_SIZE):
+        """Constructor."""
+        self.tables: Mapping[str, RoutingTable] = MappingProxyType(
+            dict.fromkeys((*TRANSPORTS, GROUPS), EMPTY_TABLE)
+        )
+        self.generation = 0
+        self.cache_size = cache_size
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._cache: OrderedDict[frozenset, tuple[int, dict]] = OrderedDict()
+
+    def swap(self, transport: str, table: RoutingTable):
+        """Swap in a new compiled routing table for the given transport."""
+        tables = dict(self.tables)
+        tables[transport] = table
+        self.tables = MappingProxyType(tables)
+        self.generation += 1
+
+    def update(
+        self,
+        transport: str,
+        table: dict[str, Iterable[Hashable]],
+        groups: dict[int, Iterable[Hashable]] | None = None,
+    ):
+        """Compile and swap in a ``channel -> [target, ...]`` table.
+
+        Args:
+            transport (str): one of ``TRANSPORTS`` or ``GROUPS``.
+            table (dict): channel -> iterable of targets.
+            groups (dict, optional): group_id -> iterable of targets.
+        """
+        self.swap(transport, RoutingTable.compile(table, groups))
+
+    def add(self, transport: str, channel: str, target: Hashable):
+        """Add a single target subscription."""
+        self.swap(transport, self.tables[transport].add(channel, target))
+
+    def discard(self, transport: str, channel: str, target: Hashable):
+        """Remove a single target subscription, if it exists."""
+        self.swap(transport, self.tables[transport].discard(channel, target))
+
+    def replace_target(
+        self,
+        transport: str,
+        target: Hashable,
+        channels: Iterable[str],
+        groups: Iterable[int] = (),
+    ):
+        """Replace all of a single target's subscriptions."""
+        table = self.tables[transport]
+        new_table = table.replace_target(target, channels, groups)
+        if new_table is not table:
+            self.swap(transport, new_table)
+
+    def channels(self, transport: str, target: Hashable) -> frozenset:
+        """Return the channels a target is directly subscribed to."""
+        return self.tables[transport].targets.get(target, EMPTY)
+
+    def subscribers(self, transport: str, channel: str) -> frozenset:
+        """Return the targets directly subscribed to a channel."""
+        return self.tables[transport].channels.get(channel, EMPTY)
+
+    def groups(self, channels: Iterable[str]) -> frozenset:
+        """Return the groups containing any of the channels."""
+        table = self.tables[GROUPS].channels
+        found = [table[channel] for channel in channels if channel in table]
+        return EMPTY.union(*found)
+
+    def targets(
+        self,
+        transport: str,
+        channels: Iterable[str],
+        groups: frozenset | None = None,
+    ) -> frozenset:
+        """Return the unique targets for a transport and list of channels.
+
+        Args:
+            transport (str): one of ``TRANSPORTS``.
+            channels (iterable): the channels of the message.
+            groups (frozenset, optional): the groups of the channels, when
+              already known.
+        """
+        table = self.tables[transport]
+        found = [
+            table.channels[channel]
+            for channel in channels
+            if channel in table.channels
+        ]
+        if table.groups:
+            if groups is None:
+                groups = self.groups(channels)
+            found.extend(
+                table.groups[group]
+                for group in groups
+                if group in table.groups
+            )
+        if not found:
+            return EMPTY
+        if len(found) == 1:
+            return found[0]
+        return EMPTY.union(*found)
+
+    def resolve(self, channels: Iterable[str]) -> dict[str, frozenset]:
+        """Return the unique targets for each transport.
+
+        The returned dictionary is shared by the cache, so do not modify it.
+        """
+        key = frozenset(channels)
+        entry = self._cache.get(key)
+        if entry is not None and entry[0] == self.generation:
+            self._cache.move_to_end(key)
+            self.cache_hits += 1
+            return entry[1]
+        self.cache_misses += 1
+        generation = self.generation
+        groups = self.groups(key)
+        res = {
+            transport: self.targets(transport, key, groups)
+            for transport in TRANSPORTS
+        }
+        self._cache[key] = (generation, res)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return res
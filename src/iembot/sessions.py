@@ -0,0 +1,205 @@
+"""Cached keep-alive HTTP sessions of the social accounts.
+
+Building a new client for each post means a new connection, so each post
+paid the DNS lookup plus the TCP and TLS handshakes.  The clients are
+instead kept within a :class:`SessionCache`, keyed by account (or by host
+for the connections shared by accounts), so the connection pools of the
+underlying ``requests.Session`` are reused.
+
+A client is built with the account's credentials, which a reload of the
+configuration may change, so each lookup provides the current credentials
+and a client built with others is closed and built again.  Clients not used
+for ``bot.sessions.idle`` seconds are closed, which also retires those of
+removed accounts.
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+from typing import TYPE_CHECKING, Any
+
+import requests
+from twisted.python import log
+
+if TYPE_CHECKING:
+    from collections.abc import Callable, Hashable
+
+# Seconds after which an unused session is closed
+IDLE_TIMEOUT = 300
+# Seconds between the sweeps for idle sessions
+SWEEP_INTERVAL = 60
+
+
+def _pool_counts(client: Any) -> tuple[int, int]:
+    """Return the requests made and connections opened by a session."""
+    requests_made = 0
+    connections = 0
+    if not isinstance(client, requests.Session):
+        return requests_made, connections
+    for adapter in client.adapters.values():
+        poolmanager = getattr(adapter, "poolmanager", None)
+        if poolmanager is None:
+            continue
+        for key in poolmanager.pools.keys():
+            pool = poolmanager.pools.get(key)
+            if pool is None:
+                continue
+            requests_made += pool.num_requests
+            connections += pool.num_connections
+    return requests_made, connections
+
+
+class SessionCache:
+    """Thread safe cache of clients keyed by account or host.
+
+    Attributes:
+        idle (float): seconds after which an unused client is closed.
+        hits (int): lookups answered with a cached client.
+        created (int): clients built.
+        invalidated (int): clients closed as the credentials changed.
+        evicted (int): clients closed as idle.
+        raced (int): clients closed as another thread built one first.
+    """
+
+    def __init__(self, idle: float = IDLE_TIMEOUT):
+        """Constructor."""
+        self.idle = idle
+        self._lock = threading.Lock()
+        # key -> [credentials, client, last used]
+        self._entries: dict[Hashable, list] = {}
+        self._next_sweep = time.monotonic() + SWEEP_INTERVAL
+        self.hits = 0
+        self.created = 0
+        self.invalidated = 0
+        self.evicted = 0
+        self.raced = 0
+        # Counts of the closed sessions
+        self._requests = 0
+        self._connections = 0
+
+    def get(
+        self,
+        key: Hashable,
+        factory: Callable[[], Any],
+        credentials: Hashable = None,
+    ) -> Any:
+        """Return the client of a key, built by ``factory`` when needed.
+
+        The client is built without holding the lock, so a slow factory
+        only delays its caller.  When two threads build one at once, the
+        first kept wins and the other is closed.
+
+        Args:
+            key: the account or host.
+            factory (callable): builds the client.
+            credentials: what the client was built with, a client built
+              with other credentials is replaced.
+        """
+        now = time.monotonic()
+        stale = []
+        with self._lock:
+            if now >= self._next_sweep:
+                self._next_sweep = now + SWEEP_INTERVAL
+                stale.extend(self._pop_idle(now))
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] != credentials:
+                self.invalidated += 1
+                stale.append(self._entries.pop(key)[1])
+                entry = None
+            if entry is not None:
+                entry[2] = now
+                self.hits += 1
+        if entry is None:
+            client = factory()
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None and entry[0] == credentials:
+                    self.raced += 1
+                    stale.append(client)
+                else:
+                    if entry is not None:
+                        self.invalidated += 1
+                        stale.append(entry[1])
+                    entry = [credentials, client, now]
+                    self._entries[key] = entry
+                    self.created += 1
+        for client in stale:
+            self._close(client)
+        return entry[1]
+
+    def _pop_idle(self, now: float) -> list:
+        """Remove the idle clients, the lock being held."""
+        idle = [
+            key
+            for key, entry in self._entries.items()
+            if now - entry[2] > self.idle
+        ]
+        self.evicted += len(idle)
+        return [self._entries.pop(key)[1] for key in idle]
+
+    def discard(self, key: Hashable):
+        """Close the client of a key, if any."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._close(entry[1])
+
+    def clear(self):
+        """Close all clients."""
+        with self._lock:
+            clients = [entry[1] for entry in self._entries.values()]
+            self._entries.clear()
+        for client in clients:
+            self._close(client)
+
+    def _close(self, client: Any):
+        """Close a client, keeping its connection counts."""
+        requests_made, connections = _pool_counts(client)
+        with self._lock:
+            self._requests += requests_made
+            self._connections += connections
+        try:
+            if isinstance(client, requests.Session):
+                client.close()
+        except Exception as exp:
+            log.err(exp)
+
+    def stats(self) -> dict[str, float]:
+        """Return the bookkeeping for the status endpoint."""
+        with self._lock:
+            clients = [entry[1] for entry in self._entries.values()]
+            requests_made = self._requests
+            connections = self._connections
+            res = {
+                "sessions.entries": len(clients),
+                "sessions.hits": self.hits,
+                "sessions.created": self.created,
+                "sessions.invalidated": self.invalidated,
+                "sessions.evicted": self.evicted,
+                "sessions.raced": self.raced,
+            }
+        for client in clients:
+            counts = _pool_counts(client)
+            requests_made += counts[0]
+            connections += counts[1]
+        res["sessions.requests"] = requests_made
+        res["sessions.connections"] = connections
+        # Share of the requests not needing a new connection
+        res["sessions.reuse_ratio"] = (
+            round(1 - connections / requests_made, 3) if requests_made else 0
+        )
+        return res
+
+
+SESSIONS = SessionCache()
+
+
+def configure_sessions(config: dict):
+    """Set the idle timeout with the setting found within the config."""
+    SESSIONS.idle = float(config.get("bot.sessions.idle", IDLE_TIMEOUT))
+
+
+def http_session(host: str) -> requests.Session:
+    """Return the keep-alive session shared by the requests to a host."""
+    return SESSIONS.get(("http", host), requests.Session)
@@ -5,20 +5,28 @@ import urllib
 from functools import partial
 
 import requests
-from twisted.internet import threads
+from twisted.internet.defer import Deferred
 from twisted.python import log
 from twisted.web import resource
 from twisted.web.server import NOT_DONE_YET
-from twisted.words.xish.domish import Element
 
+from iembot.asynchttp import HTTP_CLIENT
+from iembot.message import IngestMessage
+from iembot.routing import RoutingSnapshot, RoutingTable
 from iembot.types import JabberClient
-from iembot.util import build_channel_subs
+from iembot.util import account_filter, build_channel_subs
 
+POST_MESSAGE_URL = "https://slack.com/api/chat.postMessage"
 
-def send_to_slack(access_token: str, channel_id: str, elem: Element) -> str:
-    """Send a message to Slack, called from thread."""
+
+def send_to_slack(access_token: str, channel_id: str, text: str) -> Deferred:
+    """Send a message to Slack.
+
+    Returns:
+        Deferred: firing with the response text.
+    """
     payload = {
-        "text": elem.x["twitter"],
+        "text": text,
         "mrkdwn": False,
         "channel": channel_id,
         "unfurl_links": False,
@@ -29,29 +37,39 @@ def send_to_slack(access_token: str, channel_id: str, elem: Element) -> str:
         "Authorization": f"Bearer {access_token}",
     }
     log.msg("Posting to slack")
-    resp = requests.post(
-        "https://slack.com/api/chat.postMessage",
-        headers=headers,
-        data=json.dumps(payload),
+    df = HTTP_CLIENT.post(
+        POST_MESSAGE_URL,
+        json.dumps(payload).encode("utf-8"),
+        headers,
     )
-    log.msg(f"Got response {resp} {resp.content}")
-    resp.raise_for_status()
-    return resp.text
 
+    def _cb(body: bytes) -> str:
+        log.msg(f"Got response {body}")
+        return body.decode("utf-8", "ignore")
 
-def load_slack_from_db(txn, bot: JabberClient):
-    """Load the Slack integration."""
-    bot.slack_routingtable = build_channel_subs(
-        txn,
-        "iembot_slack_team_channels",
-    )
+    df.addCallback(_cb)
+    return df
+
+
+def load_slack_from_db(
+    txn,
+    _bot: JabberClient,
+    iembot_account_id: int | None = None,
+    subs: dict | None = None,
+) -> RoutingSnapshot:
+    """Load the Slack integration, called from a thread."""
+    if subs is None:
+        subs = build_channel_subs(txn, "slack", iembot_account_id)
+    table = RoutingTable.compile(*subs)
+    acct_sql, params = account_filter("c", iembot_account_id)
 
     txn.execute(
-        """
+        f"""
     select iembot_account_id, c.channel_id, t.access_token from
     iembot_slack_teams t JOIN iembot_slack_team_channels c on
-    (t.team_id = c.team_id) WHERE not t.disabled
-        """
+    (t.team_id = c.team_id) WHERE not t.disabled{acct_sql}
+        """,
+        params,
     )
     teams = {}
     for row in txn.fetchall():
@@ -60,32 +78,39 @@ def load_slack_from_db(txn, bot: JabberClient):
             "channel_id": row["channel_id"],
         }
 
-    bot.slack_teams = teams
     log.msg(f"Loaded {len(teams)} Slack teams")
+    return RoutingSnapshot("slack", table, teams)
 
 
-def route(bot: JabberClient, channels: list, elem: Element):
+def reload_slack(bot: JabberClient):
+    """Reload Slack after a change, unless NOTIFY already delivers it."""
+    if bot.notify_listener is None:
+        bot.load_slack()
+
+
+def send(bot: JabberClient, iembot_account_id: int, text: str):
+    """Send a message to a Slack channel."""
+    meta = bot.slack_teams.get(iembot_account_id)
+    if meta is None:
+        return None
+    df = send_to_slack(
+        meta["access_token"],
+        meta["channel_id"],
+        text,
+    )
+    df.addCallback(partial(bot.log_iembot_social_log, iembot_account_id))
+    df.addErrback(log.err)
+    return df
+
+
+def route(bot: JabberClient, message: IngestMessage):
     """Do Slack message routing."""
-    alerted = []
-    if not elem.x or elem.x.getAttribute("twitter") is None:
+    if message.twitter is None:
         log.msg("No twitter content found, skipping slack route")
         return
-    for channel in channels:
-        for iembot_account_id in bot.slack_routingtable.get(channel, []):
-            if (
-                iembot_account_id in alerted
-                or iembot_account_id not in bot.slack_teams
-            ):
-                continue
-            alerted.append(iembot_account_id)
-            meta = bot.slack_teams[iembot_account_id]
-            df = threads.deferToThread(
-                send_to_slack, meta["access_token"], meta["channel_id"], elem
-            )
-            df.addCallback(
-                partial(bot.log_iembot_social_log, iembot_account_id)
-            )
-            df.addErrback(log.err)
+    for iembot_account_id in bot.fanout.resolve(message.channels)["slack"]:
+        if iembot_account_id in bot.slack_teams:
+            bot.deliver("slack", iembot_account_id, message.twitter)
 
 
 class SlackSubscribeChannel(resource.Resource):
@@ -164,7 +189,7 @@ class SlackSubscribeChannel(resource.Resource):
             lambda _: request.write(f"Subscribed to {subkey}".encode("ascii"))
         )
         defer.addBoth(lambda _: request.finish())
-        defer.addCallback(lambda _: self.iembot.load_slack())
+        defer.addCallback(lambda _: reload_slack(self.iembot))
 
         return NOT_DONE_YET
 
@@ -260,7 +285,7 @@ class SlackUnsubscribeChannel(resource.Resource):
             )
         )
         defer.addBoth(lambda _: request.finish())
-        defer.addCallback(lambda _: self.iembot.load_slack())
+        defer.addCallback(lambda _: reload_slack(self.iembot))
 
         return NOT_DONE_YET
 
@@ -336,7 +361,7 @@ class SlackOauthChannel(resource.Resource):
             self.do_request_in_thread, data
         )
         defer.addCallback(self._cb_oauth, request)
-        defer.addCallback(lambda _: self.iembot.load_slack())
+        defer.addCallback(lambda _: reload_slack(self.iembot))
         defer.addErrback(self._eb_oauth, request)
         return NOT_DONE_YET
 
@@ -0,0 +1,150 @@
+"""Buffered writer of the ``iembot_social_log`` rows.
+
+Each delivery, including each chatroom a message is routed to, logs its
+response, which made for thousands of single row transactions a minute.
+The rows are instead buffered by :class:`SocialLogWriter` and written with
+one ``COPY`` every ``bot.social_log.flush_ms`` milliseconds, or sooner once
+``bot.social_log.batch`` rows are waiting.  The buffer holds at most
+``bot.social_log.buffer`` rows, the rows beyond are dropped and counted, so
+a database outage does not grow the bot's memory without bound.  What is
+buffered is written at shutdown, before the dbpool is closed.
+"""
+
+from __future__ import annotations
+
+import threading
+
+from twisted.internet import defer, reactor
+from twisted.internet.task import LoopingCall
+from twisted.python import log
+
+# Milliseconds between writes
+FLUSH_MS = 500
+# Rows waiting that trigger a write
+BATCH = 500
+# The most rows buffered
+MAX_BUFFER = 20000
+
+COPY_SQL = "COPY iembot_social_log (iembot_account_id, response) FROM STDIN"
+
+
+class SocialLogWriter:
+    """Buffers the log rows and writes them in batches.
+
+    Rows may be added from any thread, the writes are started from the
+    reactor thread.
+
+    Attributes:
+        written (int): rows written.
+        dropped (int): rows dropped as the buffer was full.
+        failed (int): rows lost to a failed write.
+        flushes (int): writes made.
+    """
+
+    def __init__(
+        self,
+        dbpool,
+        flush_ms: float = FLUSH_MS,
+        batch: int = BATCH,
+        max_buffer: int = MAX_BUFFER,
+        clock=None,
+    ):
+        """Constructor."""
+        self.dbpool = dbpool
+        self.flush_ms = flush_ms
+        self.batch = batch
+        self.max_buffer = max_buffer
+        self.clock = clock or reactor
+        self._lock = threading.Lock()
+        self.rows: list[tuple[int, str]] = []
+        self.flushing: defer.Deferred | None = None
+        self._flush_scheduled = False
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.flushes = 0
+        self._lc = LoopingCall(self.flush)
+        self._lc.clock = self.clock
+
+    def start(self):
+        """Start the periodic writes."""
+        self._lc.start(self.flush_ms / 1000.0, now=False)
+
+    @defer.inlineCallbacks
+    def stop(self):
+        """Stop the periodic writes and write what is buffered.
+
+        Rows may be added while a write runs, so this fires only once no
+        write is running and none are left, the dbpool being closed after.
+        """
+        if self._lc.running:
+            self._lc.stop()
+        while True:
+            with self._lock:
+                if self.flushing is None and not self.rows:
+                    return
+            # A write ends with None, its failure being logged
+            yield self.flushing or self.flush()
+
+    def add(self, iembot_account_id: int, response: str):
+        """Buffer a row, called from any thread."""
+        with self._lock:
+            if len(self.rows) >= self.max_buffer:
+                self.dropped += 1
+                return
+            self.rows.append((iembot_account_id, str(response)))
+            if len(self.rows) < self.batch or self._flush_scheduled:
+                return
+            self._flush_scheduled = True
+        reactor.callFromThread(self.flush)
+
+    def flush(self) -> defer.Deferred | None:
+        """Write the buffered rows, one write at a time."""
+        with self._lock:
+            self._flush_scheduled = False
+            if self.flushing is not None or not self.rows:
+                return self.flushing
+            rows, self.rows = self.rows, []
+        self.flushing = self.dbpool.runInteraction(self._write, rows)
+        self.flushing.addCallbacks(
+            self._written, self._failed, (rows,), None, (rows,)
+        )
+        self.flushing.addBoth(self._flushed)
+        return self.flushing
+
+    @staticmethod
+    def _write(txn, rows: list[tuple[int, str]]):
+        """Copy the rows, within a database thread."""
+        with txn.copy(COPY_SQL) as copy:
+            for row in rows:
+                copy.write_row(row)
+
+    def _written(self, _res, rows: list):
+        """Account for the written rows."""
+        self.written += len(rows)
+
+    def _failed(self, failure, rows: list):
+        """Log a failed write, the rows are lost."""
+        self.failed += len(rows)
+        log.err(failure, f"Writing {len(rows)} iembot_social_log rows")
+
+    def _flushed(self, _res):
+        """Allow the next write, starting it when a batch is waiting."""
+        self.flushes += 1
+        self.flushing = None
+        with self._lock:
+            waiting = len(self.rows) >= self.batch
+        if waiting:
+            self.flush()
+
+    def stats(self) -> dict[str, int]:
+        """Return the bookkeeping for the status endpoint."""
+        with self._lock:
+            buffered = len(self.rows)
+        return {
+            "social_log.buffered": buffered,
+            "social_log.written": self.written,
+            "social_log.dropped": self.dropped,
+            "social_log.failed": self.failed,
+            "social_log.flushes": self.flushes,
+        }
@@ -1,17 +1,24 @@
 """Twitter/X stuff."""
 
-import time
+from functools import partial
 
 import requests
 from requests.exceptions import JSONDecodeError
 from requests_oauthlib import OAuth1Session
-from twisted.internet import threads
 from twisted.internet.defer import Deferred
 from twisted.python import log
-from twisted.words.xish.domish import Element
 
+from iembot.media import media_type, prepare_media
+from iembot.message import IngestMessage
+from iembot.retry import RetryableError, log_exhausted, retry_call
+from iembot.routing import RoutingSnapshot, RoutingTable
+from iembot.sessions import SESSIONS
 from iembot.types import JabberClient
-from iembot.util import build_channel_subs, email_error, safe_twitter_text
+from iembot.util import (
+    account_filter,
+    build_channel_subs,
+    email_error,
+)
 
 TWEET_API = "https://api.x.com/2/tweets"
 # 89: Expired token, so we shall revoke for now
@@ -35,22 +42,30 @@ class TwitterRequestError(Exception):
         self.status_code = status_code
 
 
-def load_twitter_from_db(txn, bot: JabberClient):
-    """Load twitter config from database"""
-    bot.tw_routingtable = build_channel_subs(
-        txn,
-        "iembot_twitter_oauth",
+def load_twitter_from_db(
+    txn,
+    _bot: JabberClient,
+    iembot_account_id: int | None = None,
+    subs: dict | None = None,
+) -> RoutingSnapshot:
+    """Load twitter config from database, called from a thread."""
+    if subs is None:
+        subs = build_channel_subs(txn, "twitter", iembot_account_id)
+    table = RoutingTable.compile(*subs)
+    acct_sql, params = account_filter(
+        "iembot_twitter_oauth", iembot_account_id
     )
 
     twusers = {}
     txn.execute(
-        """
+        f"""
     SELECT iembot_account_id, access_token, access_token_secret, screen_name,
     iem_owned from
     iembot_twitter_oauth WHERE (iem_owned or (access_token is not null and
     access_token_secret is not null)) and user_id is not null and
-    screen_name is not null and not disabled
-    """
+    screen_name is not null and not disabled{acct_sql}
+    """,
+        params,
     )
     for row in txn.fetchall():
         user_id = row["iembot_account_id"]
@@ -60,8 +75,8 @@ def load_twitter_from_db(txn, bot: JabberClient):
             "access_token_secret": row["access_token_secret"],
             "iem_owned": row["iem_owned"],
         }
-    bot.tw_users = twusers
     log.msg(f"load_twitter_from_db(): {txn.rowcount} oauth tokens found")
+    return RoutingSnapshot("twitter", table, twusers)
 
 
 def disable_twitter_user(bot: JabberClient, iembot_account_id: int, errcode=0):
@@ -83,6 +98,7 @@ def disable_twitter_user(bot: JabberClient, iembot_account_id: int, errcode=0):
         )
         return False
     bot.tw_users.pop(iembot_account_id, None)
+    SESSIONS.discard(("twitter", iembot_account_id))
     log.msg(
         f"Removing twitter access token for user: {iembot_account_id} "
         f"({screen_name}) errcode: {errcode}"
@@ -109,15 +125,18 @@ def _helper(oauth: OAuth1Session, params):
 
 def _upload_media_to_twitter(oauth: OAuth1Session, url: str) -> str | None:
     """Upload Media to Twitter and return its ID"""
-    resp = requests.get(url, timeout=30)
-    if resp.status_code != 200:
-        log.msg(f"Fetching `{url}` got status_code: {resp.status_code}")
+    try:
+        payload = prepare_media(url, "twitter")
+    except requests.RequestException as exp:
+        log.msg(f"Fetching `{url}` failed: {exp}")
+        return None
+    if payload is None:
+        log.msg(f"`{url}` could not be fit within the X limits")
         return None
-    payload = resp.content
     resp = oauth.post(
         "https://api.x.com/2/media/upload",
         data={"media_category": "tweet_image"},
-        files={"media": (url, payload, "image/png")},
+        files={"media": (url, payload, media_type(payload))},
     )
     if resp.status_code != 200:
         log.msg(
@@ -194,14 +213,19 @@ def _twitter_error_code_from_payload(payload: dict) -> int:
 def really_tweet(
     bot: JabberClient, iembot_account_id: int, twttxt: str, **kwargs
 ):
-    """Blocking tweet method."""
+    """Blocking tweet method, a single attempt retried by :func:`tweet`."""
     meta = bot.tw_users[iembot_account_id]
-    oauth = OAuth1Session(
+    credentials = (
         bot.config["bot.twitter.consumerkey"],
         bot.config["bot.twitter.consumersecret"],
         meta["access_token"],
         meta["access_token_secret"],
     )
+    oauth = SESSIONS.get(
+        ("twitter", iembot_account_id),
+        partial(OAuth1Session, *credentials),
+        credentials,
+    )
     log.msg(
         f"Tweeting {meta['screen_name']}({iembot_account_id}) "
         f"'{twttxt}' media:{kwargs.get('twitter_media')}"
@@ -221,36 +245,28 @@ def really_tweet(
         log.msg(f"Uploading media for {media} failed with:")
         log.err(err)
 
-    res = None
-    # We now make two attempts to post to Twitter.
-    for _ in range(2):
-        try:
-            res = _helper(oauth, params)
-            break
-        except TwitterRequestError as exp:
-            errcode = exp.code
-            if errcode in [185, 187, 403]:
-                # 185: Over quota
-                # 187: duplicate tweet
-                # 403: Forbidden (duplicate)
-                return None
-            if errcode in DISABLE_TWITTER_CODES:
-                disable_twitter_user(bot, iembot_account_id, errcode)
-                return None
-            if 0 < errcode < 500:
-                # Anything 500 is likely transient server side?
-                # We really should add code to account for these.
-                log.msg(
-                    f"Unhandled X error posting tweet, errcode: {errcode}, "
-                    f"payload: {exp.payload}, exception follows as:"
-                )
-                log.err(exp)
-
-            # Evasive manuevers, just remove the media and try again
-            params.pop("media", None)
-            # We are in a thread, so this is OK
-            time.sleep(kwargs.get("sleep", 30))
-    return res
+    try:
+        return _helper(oauth, params)
+    except TwitterRequestError as exp:
+        errcode = exp.code
+        if errcode in [185, 187, 403]:
+            # 185: Over quota
+            # 187: duplicate tweet
+            # 403: Forbidden (duplicate)
+            return None
+        if errcode in DISABLE_TWITTER_CODES:
+            disable_twitter_user(bot, iembot_account_id, errcode)
+            return None
+        if 0 < errcode < 500:
+            # Anything 500 is likely transient server side?
+            # We really should add code to account for these.
+            log.msg(
+                f"Unhandled X error posting tweet, errcode: {errcode}, "
+                f"payload: {exp.payload}, exception follows as:"
+            )
+            log.err(exp)
+        # Evasive manuevers, just remove the media and try again later
+        raise RetryableError(str(exp), twitter_media=None) from exp
 
 
 def tweet(
@@ -259,13 +275,15 @@ def tweet(
     """
     Tweet a message
     """
-    df = threads.deferToThread(
+    df = retry_call(
+        "twitter",
         really_tweet,
         bot,
         iembot_account_id,
         twttxt,
         **kwargs,
     )
+    df.addErrback(log_exhausted)
     df.addCallback(tweet_cb, bot, iembot_account_id)
     df.addErrback(
         email_error,
@@ -275,37 +293,27 @@ def tweet(
     return df
 
 
-def route(bot: JabberClient, channels: list, elem: Element):
+def route(bot: JabberClient, message: IngestMessage):
     """Do the twitter work."""
     # Require the x.twitter attribute to be set to prevent
     # confusion with some ingestors still sending tweets themself
-    if not elem.x or not elem.x.hasAttribute("twitter"):
-        log.msg(f"Failing to tweet message without x {elem.toXml()}")
+    if message.twitter_text is None:
+        log.msg(f"Failing to tweet message without x {message.body}")
         return
-    msgtxt = safe_twitter_text(elem.x["twitter"])
 
-    lat = elem.x.getAttribute("lat")
-    long = elem.x.getAttribute("long")
-    twitter_media = elem.x.getAttribute("twitter_media")
-
-    alerted = []
-    for channel in channels:
-        for iembot_account_id in bot.tw_routingtable.get(channel, []):
-            if iembot_account_id in alerted:
-                continue
-            alerted.append(iembot_account_id)
-            # Ensure we have creds needed for this...
-            if iembot_account_id not in bot.tw_users:
-                log.msg(f"Tweet fail no access_tokens {iembot_account_id}")
-                continue
-            if bot.tw_users[iembot_account_id]["access_token"] is None:
-                log.msg(f"No twitter access token for {iembot_account_id}")
-                continue
-            tweet(
-                bot,
-                iembot_account_id,
-                msgtxt,
-                twitter_media=twitter_media,
-                latitude=lat,
-                longitude=long,
-            )
+    for iembot_account_id in bot.fanout.resolve(message.channels)["twitter"]:
+        # Ensure we have creds needed for this...
+        if iembot_account_id not in bot.tw_users:
+            log.msg(f"Tweet fail no access_tokens {iembot_account_id}")
+            continue
+        if bot.tw_users[iembot_account_id]["access_token"] is None:
+            log.msg(f"No twitter access token for {iembot_account_id}")
+            continue
+        bot.deliver(
+            "twitter",
+            iembot_account_id,
+            message.twitter_text,
+            twitter_media=message.twitter_media,
+            latitude=message.lat,
+            longitude=message.long,
+        )
@@ -9,6 +9,8 @@ if TYPE_CHECKING:
 
     from twisted.internet.defer import Deferred
 
+    from iembot.routing import FanoutIndex
+
 
 class JabberClient(Protocol):
     """Structural type for JabberClient to avoid import cycles."""
@@ -22,30 +24,38 @@ class JabberClient(Protocol):
     outstanding_pings: list
     chatlog: dict[str, Any]
     seqnum: int
+    # channel -> transport -> {target, ...}
+    fanout: FanoutIndex
+    # Buffered iembot_social_log writer
+    social_log: Any
+    # Groupchats waiting for their chatroom to be joined
+    pending: Any
+
     # XMPP
     rooms: dict[str, dict[str, Any]]
-    # channel -> [room, room, ...]
-    routingtable: dict[str, list[str]]
+    room_jids: dict[str, bytes]
 
     # Atmosphere
     at_manager: Any
     at_users: dict[str, dict[str, Any]]
-    at_routingtable: dict[str, list[str]]
 
     # Twitter/X
     tw_users: dict[int, dict[str, Any]]
-    tw_routingtable: dict[str, list[int]]
 
     # Mastodon
     md_users: dict[int, dict[str, Any]]
-    md_routingtable: dict[str, list[int]]
 
     # Slack
     slack_teams: dict[str, dict[str, str]]
-    slack_routingtable: dict[str, list[str]]
 
     # Webhooks
-    webhooks_routingtable: dict[str, list[dict[str, Any]]]
+    webhook_users: dict[int, dict[str, Any]]
+
+    # LISTEN/NOTIFY incremental reloads
+    notify_listener: Any | None
+
+    # Durable deliveries
+    outbox: Any | None
 
     xmlstream: Any | None
     firstlogin: bool
@@ -60,9 +70,17 @@ class JabberClient(Protocol):
     def fire_client(self, xs: Any, service_collection: Any) -> None:
         """Fire up the client."""
 
+    def deliver(
+        self, transport: str, *args: Any, **kwargs: Any
+    ) -> Deferred | None:
+        """Deliver a message via a transport."""
+
+    def send_groupchat_fanout(self, elem: Any, rooms: Any) -> int:
+        """Send a groupchat element to many rooms."""
+
     def log_iembot_social_log(
         self,
         iembot_account_id: int,
         response: str,
-    ) -> Deferred:
+    ) -> None:
         """Persist social response."""
@@ -6,10 +6,13 @@ import pickle
 import re
 import socket
 import traceback
+from collections.abc import Iterable
 from datetime import datetime, timedelta
 from email.mime.text import MIMEText
+from functools import partial
 from html import unescape
 from io import BytesIO
+from xml.parsers import expat
 
 from pyiem.reference import TWEET_CHARS
 from pyiem.util import utc
@@ -19,6 +22,13 @@ from twisted.python import log
 from twisted.words.xish import domish
 
 import iembot
+from iembot.routing import (
+    EMPTY,
+    GROUPS,
+    TRANSPORTS,
+    RoutingSnapshot,
+    RoutingTable,
+)
 from iembot.types import JabberClient
 
 
@@ -72,47 +82,119 @@ def safe_twitter_text(text: str, max_size: int = TWEET_CHARS) -> str:
     return text[:max_size]
 
 
-def build_channel_subs(txn, auth_table: str) -> dict[int : list[str]]:
-    """Build the subscriptions based on the given auth table."""
-    # Sometimes we need to do a bit more for checking.
-    xtra_sql = {
-        "iembot_twitter_oauth": (
-            "and o.access_token is not null and not disabled"
-        )
-    }
-    # First find explicit subscriptions
+def account_filter(
+    alias: str, iembot_account_id: int | None
+) -> tuple[str, tuple]:
+    """Build SQL to optionally limit a loader to a single account.
+
+    Args:
+        alias (str): the table (alias) holding the iembot_account_id column.
+        iembot_account_id (int, optional): the account to limit to.
+
+    Returns:
+        (str, tuple): the SQL to append to a WHERE clause and its params.
+    """
+    if iembot_account_id is None:
+        return "", ()
+    return f" and {alias}.iembot_account_id = %s", (iembot_account_id,)
+
+
+# transport -> (account table, target column, SQL limiting the accounts)
+SUBSCRIBERS = {
+    "xmpp": ("iembot_rooms", "roomname", "roomname is not null"),
+    "twitter": (
+        "iembot_twitter_oauth",
+        "null",
+        "access_token is not null and not disabled",
+    ),
+    "mastodon": ("iembot_mastodon_oauth", "null", "true"),
+    "atmosphere": ("iembot_atmosphere_accounts", "null", "true"),
+    "slack": ("iembot_slack_team_channels", "null", "true"),
+    "webhooks": ("iembot_webhooks", "null", "url != ''"),
+}
+
+
+def load_subscriptions_from_db(
+    txn,
+    transports: Iterable[str] = TRANSPORTS,
+    iembot_account_id: int | None = None,
+) -> dict[str, tuple[dict[str, list], dict[int, list]]]:
+    """Load the channel and group subscriptions of many transports at once.
+
+    A single query finds the subscriptions of all the accounts, which are
+    then partitioned by transport in one pass over the rows.  Groups are not
+    expanded into their channels, see ``load_channel_groups_from_db``.
+
+    Args:
+        txn (cursor): database transaction
+        transports (iterable): the transports to load.
+        iembot_account_id (int, optional): only load this account.
+
+    Returns:
+        dict: transport -> (channel -> list of targets, group_id -> list of
+          targets), with targets being the roomname for ``xmpp`` and
+          iembot_account_id otherwise.
+    """
+    transports = tuple(transports)
+    accounts_sql = " UNION ALL ".join(
+        f"select '{transport}' as transport, iembot_account_id, "
+        f"{SUBSCRIBERS[transport][1]} as target "
+        f"from {SUBSCRIBERS[transport][0]} "
+        f"WHERE {SUBSCRIBERS[transport][2]}"
+        for transport in transports
+    )
+    acct_sql, params = account_filter("a", iembot_account_id)
     txn.execute(
         f"""
-        select o.iembot_account_id, channel_name
-        from {auth_table} o, iembot_subscriptions s, iembot_channels c
-        WHERE o.iembot_account_id = s.iembot_account_id and s.channel_id = c.id
-        {xtra_sql.get(auth_table, "")}
-        """
+        WITH accounts as ({accounts_sql})
+        select a.transport, a.iembot_account_id, a.target, c.channel_name,
+        s.group_id from accounts a JOIN iembot_subscriptions s
+        on (a.iembot_account_id = s.iembot_account_id)
+        LEFT JOIN iembot_channels c on (s.channel_id = c.id)
+        WHERE (c.channel_name is not null or s.group_id is not null){acct_sql}
+        """,
+        params,
     )
-    subs = {}
-    count_subs = 0
+    res = {transport: ({}, {}) for transport in transports}
     for row in txn.fetchall():
-        subs.setdefault(row["channel_name"], []).append(
-            row["iembot_account_id"]
-        )
-        count_subs += 1
-    # Find subscriptions based on groups
+        target = row["target"]
+        if target is None:
+            target = row["iembot_account_id"]
+        channels, groups = res[row["transport"]]
+        if row["channel_name"] is not None:
+            channels.setdefault(row["channel_name"], []).append(target)
+        if row["group_id"] is not None:
+            groups.setdefault(row["group_id"], []).append(target)
+    log.msg(f"Built {txn.rowcount} subscriptions for {len(transports)} types")
+    return res
+
+
+def build_channel_subs(
+    txn, transport: str, iembot_account_id: int | None = None
+) -> tuple[dict[str, list], dict[int, list]]:
+    """Load the subscriptions of a single transport."""
+    return load_subscriptions_from_db(txn, (transport,), iembot_account_id)[
+        transport
+    ]
+
+
+def load_channel_groups_from_db(
+    txn,
+    _bot: JabberClient,
+    _iembot_account_id: int | None = None,
+    **_kwargs,
+) -> RoutingSnapshot:
+    """Load the channel -> group membership, called from a thread."""
     txn.execute(
-        """
-        select o.iembot_account_id, channel_name from
-        iembot_mastodon_oauth o, iembot_subscriptions s,
-        iembot_channel_group_membership m, iembot_channels c
-        WHERE o.iembot_account_id = s.iembot_account_id and
-        s.group_id = m.group_id and m.channel_id = c.id
-        """
+        "select c.channel_name, m.group_id from "
+        "iembot_channel_group_membership m JOIN iembot_channels c "
+        "on (m.channel_id = c.id)"
     )
+    table = {}
     for row in txn.fetchall():
-        subs.setdefault(row["channel_name"], []).append(
-            row["iembot_account_id"]
-        )
-        count_subs += 1
-    log.msg(f"Built {count_subs} subscriptions from {auth_table}")
-    return subs
+        table.setdefault(row["channel_name"], []).append(row["group_id"])
+    log.msg(f"load_channel_groups_from_db(): {txn.rowcount} members found")
+    return RoutingSnapshot(GROUPS, RoutingTable.compile(table), {})
 
 
 def channels_room_list(bot: JabberClient, room: str):
@@ -120,11 +202,7 @@ def channels_room_list(bot: JabberClient, room: str):
     Send a listing of channels that the room is subscribed to...
     @param room to list
     """
-    channels = [
-        channel
-        for channel in bot.routingtable.keys()
-        if room in bot.routingtable[channel]
-    ]
+    channels = sorted(bot.fanout.channels("xmpp", room))
 
     # Need to add a space in the channels listing so that the string does
     # not get so long that it causes chat clients to bail
@@ -133,7 +211,10 @@ def channels_room_list(bot: JabberClient, room: str):
 
 
 def channels_room_add(txn, bot: JabberClient, room: str, channel: str):
-    """Add a channel subscription to a chatroom
+    """Add a channel subscription to a chatroom, called from a thread.
+
+    Changes to the routing and messages to the room are handed to the
+    reactor thread.
 
     Args:
         txn (cursor): database transaction
@@ -141,23 +222,20 @@ def channels_room_add(txn, bot: JabberClient, room: str, channel: str):
         room (str): the chatroom to add the subscription to
         channel (str): the channel to subscribe to for the room
     """
+    say = partial(reactor.callFromThread, bot.send_groupchat, room)
     # Remove extraneous fluff, all channels are uppercase
     channel = channel.upper().strip().replace(" ", "")
     if channel == "":
-        bot.send_groupchat(
-            room,
+        say(
             "Failed to add channel to room subscription, you supplied a "
             "blank channel?",
         )
         return
     # Allow channels to be comma delimited
-    for ch in channel.split(","):
-        if ch not in bot.routingtable:
-            bot.routingtable[ch] = []
+    for ch in dict.fromkeys(channel.split(",")):
         # If we are already subscribed, let em know!
-        if room in bot.routingtable[ch]:
-            bot.send_groupchat(
-                room,
+        if room in bot.fanout.subscribers("xmpp", ch):
+            say(
                 "Error adding subscription, your room is already subscribed "
                 f"to the '{ch}' channel",
             )
@@ -177,7 +255,7 @@ def channels_room_add(txn, bot: JabberClient, room: str, channel: str):
         channel_id = txn.fetchone()["id"]
 
         # Add to routing table
-        bot.routingtable[ch].append(room)
+        reactor.callFromThread(bot.fanout.add, "xmpp", ch, room)
         # Add to database
         txn.execute(
             """
@@ -189,35 +267,37 @@ def channels_room_add(txn, bot: JabberClient, room: str, channel: str):
     """,
             (room, channel_id),
         )
-        bot.send_groupchat(room, f"Subscribed {room} to channel '{ch}'")
+        say(f"Subscribed {room} to channel '{ch}'")
     # Send room a listing of channels!
-    channels_room_list(bot, room)
+    reactor.callFromThread(channels_room_list, bot, room)
 
 
 def channels_room_del(txn, bot: JabberClient, room: str, channel: str):
-    """Removes a channel subscription for a given room
+    """Removes a channel subscription for a given room, called from a thread.
 
     Args:
         txn (cursor): database cursor
         room (str): room to unsubscribe
         channel (str): channel to unsubscribe from
     """
+    say = partial(reactor.callFromThread, bot.send_groupchat, room)
     channel = channel.upper().strip().replace(" ", "")
     if channel == "":
-        bot.send_groupchat(room, "Blank or missing channel")
+        say("Blank or missing channel")
         return
 
-    for ch in channel.split(","):
-        if ch not in bot.routingtable:
-            bot.send_groupchat(room, f"Unknown channel: '{ch}'")
+    for ch in dict.fromkeys(channel.split(",")):
+        subscribers = bot.fanout.subscribers("xmpp", ch)
+        if not subscribers:
+            say(f"Unknown channel: '{ch}'")
             continue
 
-        if room not in bot.routingtable[ch]:
-            bot.send_groupchat(room, f"Room not subscribed to channel: '{ch}'")
+        if room not in subscribers:
+            say(f"Room not subscribed to channel: '{ch}'")
             continue
 
         # Remove from routing table
-        bot.routingtable[ch].remove(room)
+        reactor.callFromThread(bot.fanout.discard, "xmpp", ch, room)
         # Remove from database
         txn.execute(
             """
@@ -229,8 +309,18 @@ def channels_room_del(txn, bot: JabberClient, room: str, channel: str):
     """,
             (room, ch),
         )
-        bot.send_groupchat(room, f"Unsubscribed {room} to channel '{ch}'")
-    channels_room_list(bot, room)
+        say(f"Unsubscribed {room} to channel '{ch}'")
+    reactor.callFromThread(channels_room_list, bot, room)
+
+
+def xml_error(raw: bytes) -> Exception | None:
+    """Return the error found parsing the XML, ``None`` when well-formed."""
+    parser = expat.ParserCreate(namespace_separator=" ")
+    try:
+        parser.Parse(raw, True)
+    except expat.ExpatError as exp:
+        return exp
+    return None
 
 
 def email_error(exp, bot: JabberClient, message=""):
@@ -304,70 +394,159 @@ def email_error(exp, bot: JabberClient, message=""):
     return True
 
 
-def load_chatrooms_from_db(txn, bot: JabberClient, always_join: bool = False):
-    """Load database configuration and do work
+def load_fingerprints_from_db(txn, tables) -> dict[str, tuple[int, int]]:
+    """Fingerprint tables to cheaply detect changes, called from a thread.
+
+    The row count catches deletes and the largest ``xmin`` (the id of the
+    transaction that wrote the row) catches inserts and updates.
+
+    Args:
+        txn (cursor): database transaction
+        tables (iterable): the table names to fingerprint
+
+    Returns:
+        dict: table name -> (row count, max xmin)
+    """
+    res = {}
+    for table in tables:
+        txn.execute(
+            "select count(*) as cnt, coalesce(max(xmin::text::bigint), 0) "
+            f"as xmax from {table}"
+        )
+        row = txn.fetchone()
+        res[table] = (row["cnt"], row["xmax"])
+    return res
+
+
+def load_chatrooms_from_db(
+    txn,
+    _bot: JabberClient,
+    iembot_account_id: int | None = None,
+    subs: dict | None = None,
+) -> RoutingSnapshot:
+    """Load chatroom configuration from the database, called from a thread.
 
     Args:
       txn (dbtransaction): database cursor
       bot (JabberClient): the running bot instance
-      always_join (boolean): do we force joining each room, regardless
+      iembot_account_id (int, optional): only load this account
+      subs (dict, optional): subscriptions already loaded in bulk
+
+    Returns:
+      RoutingSnapshot: with accounts being roomname -> iembot_account_id
     """
+    acct_sql, params = account_filter("iembot_rooms", iembot_account_id)
     # Load up a list of chatrooms
     txn.execute(
         "SELECT iembot_account_id, roomname from iembot_rooms "
-        "WHERE roomname is not null ORDER by roomname ASC"
+        f"WHERE roomname is not null{acct_sql} ORDER by roomname ASC",
+        params,
     )
-    oldrooms = list(bot.rooms.keys())
+    rooms = {}
+    for row in txn.fetchall():
+        rooms[row["roomname"]] = row["iembot_account_id"]
+
+    if subs is None:
+        subs = build_channel_subs(txn, "xmpp", iembot_account_id)
+    return RoutingSnapshot("xmpp", RoutingTable.compile(*subs), rooms)
+
+
+def _room_presence(bot: JabberClient, room: str, typ: str | None = None):
+    """Build a MUC presence for the given room."""
+    presence = domish.Element(("jabber:client", "presence"))
+    presence["to"] = f"{room}@{bot.conference}/{bot.myjid.user}"
+    if typ is not None:
+        presence["type"] = typ
+    return presence
+
+
+def _leave_room(bot: JabberClient, room: str):
+    """Leave a chatroom and forget about it."""
+    bot.xmlstream.send(_room_presence(bot, room, "unavailable"))
+    del bot.rooms[room]
+
+
+def merge_chatroom(
+    snapshot: RoutingSnapshot, bot: JabberClient, iembot_account_id: int
+) -> RoutingSnapshot:
+    """Merge a single chatroom account, on the reactor thread.
+
+    Args:
+      snapshot (RoutingSnapshot): from ``load_chatrooms_from_db`` limited to
+        the ``iembot_account_id``, so empty when the room was removed
+      bot (JabberClient): the running bot instance
+      iembot_account_id (int): the account that changed
+    """
+    oldrooms = [
+        rm
+        for rm, meta in bot.rooms.items()
+        if meta.get("iembot_account_id") == iembot_account_id
+    ]
+    for rm in oldrooms:
+        if rm not in snapshot.accounts:
+            log.msg(f"Leaving removed chatroom {rm}")
+            _leave_room(bot, rm)
+            bot.fanout.replace_target("xmpp", rm, EMPTY)
+    for rm, account_id in snapshot.accounts.items():
+        if rm not in bot.rooms:
+            log.msg(f"Joining new chatroom {rm}")
+            bot.rooms[rm] = {
+                "iembot_account_id": account_id,
+                "occupants": {},
+                "joined": False,
+            }
+            bot.xmlstream.send(_room_presence(bot, rm))
+        bot.fanout.replace_target(
+            "xmpp",
+            rm,
+            snapshot.table.targets.get(rm, EMPTY),
+            snapshot.table.groups_of(rm),
+        )
+    return snapshot
+
+
+def join_chatrooms(
+    snapshot: RoutingSnapshot, bot: JabberClient, always_join: bool = False
+) -> RoutingSnapshot:
+    """Join/leave chatrooms and swap in their routing, on the reactor thread.
+
+    Args:
+      snapshot (RoutingSnapshot): from ``load_chatrooms_from_db``
+      bot (JabberClient): the running bot instance
+      always_join (boolean): do we force joining each room, regardless
+    """
+    oldrooms = set(bot.rooms.keys())
     joined = 0
-    xref = {}
     if always_join or "botstalk" not in oldrooms:
         # botstalk is special and should be joined immediately
-        presence = domish.Element(("jabber:client", "presence"))
-        presence["to"] = f"botstalk@{bot.conference}/{bot.myjid.user}"
-        bot.xmlstream.send(presence)
+        bot.xmlstream.send(_room_presence(bot, "botstalk"))
 
-    for i, row in enumerate(txn.fetchall()):
-        rm = row["roomname"]
-        xref[row["iembot_account_id"]] = rm
+    for i, (rm, iembot_account_id) in enumerate(snapshot.accounts.items()):
         # Setup Room Config Dictionary
         if rm not in bot.rooms:
             bot.rooms[rm] = {
-                "iembot_account_id": row["iembot_account_id"],
+                "iembot_account_id": iembot_account_id,
                 "occupants": {},
                 "joined": False,
             }
 
         if always_join or rm not in oldrooms:
-            presence = domish.Element(("jabber:client", "presence"))
-            presence["to"] = f"{rm}@{bot.conference}/{bot.myjid.user}"
             # Some jitter to prevent overloading
-            reactor.callLater(i % 30, bot.xmlstream.send, presence)
+            reactor.callLater(
+                i % 30, bot.xmlstream.send, _room_presence(bot, rm)
+            )
             joined += 1
-        if rm in oldrooms:
-            oldrooms.remove(rm)
+        oldrooms.discard(rm)
 
     # Check old rooms for any rooms we need to vacate!
     for rm in oldrooms:
-        presence = domish.Element(("jabber:client", "presence"))
-        presence["to"] = f"{rm}@{bot.conference}/{bot.myjid.user}"
-        presence["type"] = "unavailable"
-        bot.xmlstream.send(presence)
-
-        del bot.rooms[rm]
+        _leave_room(bot, rm)
     log.msg(
-        f"... loaded {txn.rowcount} chatrooms, joined {joined} of them, "
-        f"left {len(oldrooms)} of them"
-    )
-
-    # Doing an ugly pivot with this
-    rt_using_account_ids = build_channel_subs(
-        txn,
-        "iembot_rooms",
+        f"... loaded {len(snapshot.accounts)} chatrooms, joined {joined} of "
+        f"them, left {len(oldrooms)} of them"
     )
-    rt = {}
-    for channel, accounts in rt_using_account_ids.items():
-        rt[channel] = [xref[account] for account in accounts]
-    bot.routingtable = rt
+    bot.fanout.swap("xmpp", snapshot.table)
+    return snapshot
 
 
 def load_chatlog(bot: JabberClient):
@@ -1,85 +1,236 @@
-"""Send content to various webhooks."""
+"""Send content to various webhooks.
+
+Each url has a circuit breaker, so a dead endpoint is quarantined rather
+than costing every routed message its timeouts, see ``iembot.circuit`` and
+the ``bot.webhooks.circuit.failures`` and ``bot.webhooks.circuit.reset``
+settings.
+
+A webhook may instead ask for its messages in batches, with the
+``batch_ms`` and ``batch_size`` columns of ``iembot_webhooks``: messages are
+buffered until ``batch_ms`` milliseconds passed since the first or
+``batch_size`` are waiting, then POSTed as one JSON array.
+"""
 
 import json
-import time
 from functools import partial
-from typing import Any
 
-import requests
-from twisted.internet.threads import deferToThread
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
 from twisted.python import log
 
+from iembot.asynchttp import HTTP_CLIENT
+from iembot.circuit import FAILURES, RESET, CircuitBreakers, CircuitOpen
+from iembot.message import IngestMessage
+from iembot.retry import retry_call
+from iembot.routing import RoutingSnapshot, RoutingTable
 from iembot.types import JabberClient
+from iembot.util import account_filter, build_channel_subs
+
+# Defaults of a batched webhook missing one of its settings
+BATCH_MS = 1000
+BATCH_SIZE = 50
+
+BREAKERS = CircuitBreakers()
+
+
+def configure_webhooks(config: dict):
+    """Set the circuit breakers with the settings found within the config."""
+    BREAKERS.failures = int(
+        config.get("bot.webhooks.circuit.failures", FAILURES)
+    )
+    BREAKERS.reset = float(config.get("bot.webhooks.circuit.reset", RESET))
+
+
+def _has_batch_columns(txn) -> bool:
+    """Whether ``scripts/iembot_webhooks_batch.sql`` was applied."""
+    txn.execute(
+        "select count(*) as n from information_schema.columns where "
+        "table_name = 'iembot_webhooks' and "
+        "column_name in ('batch_ms', 'batch_size')"
+    )
+    return txn.fetchone()["n"] == 2
 
 
-def load_webhooks_from_db(txn, bot: JabberClient):
-    """Load twitter config from database"""
+def load_webhooks_from_db(
+    txn,
+    _bot: JabberClient,
+    iembot_account_id: int | None = None,
+    subs: dict | None = None,
+) -> RoutingSnapshot:
+    """Load webhooks config from database, called from a thread."""
+    if subs is None:
+        subs = build_channel_subs(txn, "webhooks", iembot_account_id)
+    acct_sql, params = account_filter("w", iembot_account_id)
+    # Without the migration, no webhook is batched
+    batch_cols = (
+        "w.batch_ms, w.batch_size"
+        if _has_batch_columns(txn)
+        else "null as batch_ms, null as batch_size"
+    )
     txn.execute(
-        """
-    select c.channel_name, w.iembot_account_id, w.url from iembot_webhooks w,
-    iembot_subscriptions s, iembot_channels c
-    where w.iembot_account_id = s.iembot_account_id and s.channel_id = c.id
-    order by channel_name asc
-        """
+        f"""
+    select w.iembot_account_id, w.url, {batch_cols}
+    from iembot_webhooks w where w.url != ''{acct_sql}
+        """,
+        params,
     )
-    table = {}
+    users = {}
     for row in txn.fetchall():
-        url = row["url"]
-        channel = row["channel_name"]
-        # Unsure how this could happen, but just in case
-        if url != "" and channel != "":
-            res: list[dict[str, Any]] = table.setdefault(channel, [])
-            res.append(
-                {
-                    "iembot_account_id": row["iembot_account_id"],
-                    "url": url,
-                }
+        meta = {"url": row["url"]}
+        if row["batch_ms"] or row["batch_size"]:
+            meta["batch_ms"] = row["batch_ms"] or BATCH_MS
+            meta["batch_size"] = row["batch_size"] or BATCH_SIZE
+        users[row["iembot_account_id"]] = meta
+    log.msg(f"load_webhooks_from_db(): {txn.rowcount} webhooks found")
+    return RoutingSnapshot("webhooks", RoutingTable.compile(*subs), users)
+
+
+def really_hook(url: str, postdata: bytes, **_kwargs: dict) -> Deferred:
+    """Make a single webhook attempt on the reactor.
+
+    Returns:
+        Deferred: firing with the response text, or failing with one of
+          ``iembot.asynchttp.TRANSIENT_ERRORS``, which the webhooks retry
+          policy schedules to be tried again.
+    """
+    df = HTTP_CLIENT.post(url, postdata, {"Content-Type": "application/json"})
+    df.addCallback(lambda body: body.decode("utf-8", "ignore"))
+    return df
+
+
+def _attempt(url: str, postdata: bytes, **kwargs) -> Deferred:
+    """Make an attempt the url's circuit allows, recording its outcome."""
+    BREAKERS.acquire(url)
+    df = really_hook(url, postdata, **kwargs)
+
+    def _succeeded(res: str) -> str:
+        BREAKERS.success(url)
+        return res
+
+    def _failed(failure):
+        BREAKERS.failure(url)
+        return failure
+
+    df.addCallbacks(_succeeded, _failed)
+    return df
+
+
+def _skipped(failure, url: str):
+    """Log, rather than raise, a delivery skipped by the circuit."""
+    failure.trap(CircuitOpen)
+    log.msg(f"Skipped webhook {url}: {failure.value}")
+
+
+def hook(
+    bot: JabberClient,
+    iembot_account_id: int,
+    url: str,
+    text: str | list[str],
+    **kwargs,
+):
+    """Post a message, or a list of them as a JSON array, to a webhook."""
+    if isinstance(text, list):
+        payload = [{"text": item} for item in text]
+    else:
+        payload = {"text": text}
+    postdata = json.dumps(payload).encode("utf-8", "ignore")
+    df = retry_call(
+        "webhooks", _attempt, url, postdata, threaded=False, **kwargs
+    )
+    df.addCallback(partial(bot.log_iembot_social_log, iembot_account_id))
+    df.addErrback(_skipped, url)
+    df.addErrback(log.err)
+    return df
+
+
+class WebhookBatcher:
+    """Buffers of the messages of the batched webhooks, keyed by url.
+
+    Attributes:
+        batches (int): batches delivered.
+        messages (int): messages delivered within batches.
+    """
+
+    def __init__(self, clock=None):
+        """Constructor."""
+        self.clock = clock or reactor
+        # url -> [bot, iembot_account_id, texts, kwargs, DelayedCall]
+        self.buffers: dict[str, list] = {}
+        self.batches = 0
+        self.messages = 0
+
+    def add(
+        self,
+        bot: JabberClient,
+        iembot_account_id: int,
+        meta: dict,
+        text: str,
+        **kwargs,
+    ):
+        """Buffer a message, delivering the batch when full."""
+        url = meta["url"]
+        buffer = self.buffers.get(url)
+        if buffer is None:
+            timer = self.clock.callLater(
+                meta["batch_ms"] / 1000.0, self.flush, url
             )
-    bot.webhooks_routingtable = table
-    log.msg(f"load_webhooks_from_db(): {txn.rowcount} subs found")
+            buffer = [bot, iembot_account_id, [], kwargs, timer]
+            self.buffers[url] = buffer
+        buffer[2].append(text)
+        if len(buffer[2]) >= meta["batch_size"]:
+            self.flush(url)
 
+    def flush(self, url: str):
+        """Deliver the buffered messages of a url."""
+        buffer = self.buffers.pop(url, None)
+        if buffer is None:
+            return
+        bot, iembot_account_id, texts, kwargs, timer = buffer
+        if timer.active():
+            timer.cancel()
+        self.batches += 1
+        self.messages += len(texts)
+        bot.deliver("webhooks", iembot_account_id, url, texts, **kwargs)
 
-def really_hook(url: str, postdata: bytes, **kwargs: dict) -> str:
-    """Process the webook within a thread, so sleeping is OK..."""
-    try:
-        resp = requests.post(url, data=postdata, timeout=5)
-        resp.raise_for_status()
-        if resp.status_code == 200:
-            return resp.text
-    except Exception as e:
-        log.err(f"Webhook error {url}: {e}")
-        time.sleep(kwargs.get("sleep", 30))
-    # One more time
-    resp = requests.post(url, data=postdata, timeout=5)
-    resp.raise_for_status()
-    return resp.text
+    def flush_all(self):
+        """Deliver all buffered messages, at shutdown."""
+        for url in list(self.buffers):
+            self.flush(url)
 
+    def stats(self) -> dict[str, int]:
+        """Return the bookkeeping for the status endpoint."""
+        return {
+            "webhooks.batch.buffered": sum(
+                len(buffer[2]) for buffer in self.buffers.values()
+            ),
+            "webhooks.batch.batches": self.batches,
+            "webhooks.batch.messages": self.messages,
+        }
 
-def route(bot: JabberClient, channels, elem, **kwargs):
-    """Route messages found in provided elem.
+
+BATCHER = WebhookBatcher()
+
+
+def route(bot: JabberClient, message: IngestMessage, **kwargs):
+    """Route the message.
 
     Args:
       bot: iembot instance.
-      channels (list): channels for this message.
-      elem: xish element.
+      message (IngestMessage): the message to route.
     """
-    subs = [
-        bot.webhooks_routingtable[channel]
-        for channel in channels
-        if channel in bot.webhooks_routingtable
-    ]
-    if not subs:
-        return
-    data = {"text": str(elem.body)}
-    postdata = json.dumps(data).encode("utf-8", "ignore")
-    used = []
-    for hooks in subs:
-        for entry in hooks:
-            if entry["url"] in used:
-                continue
-            used.append(entry["url"])
-            df = deferToThread(really_hook, entry["url"], postdata, **kwargs)
-            df.addCallback(
-                partial(bot.log_iembot_social_log, entry["iembot_account_id"])
-            )
-            df.addErrback(log.err)
+    # Multiple accounts could share an url, only post once to each
+    hooks: dict[str, int] = {}
+    for iembot_account_id in bot.fanout.resolve(message.channels)["webhooks"]:
+        meta = bot.webhook_users.get(iembot_account_id)
+        if meta is not None:
+            hooks.setdefault(meta["url"], iembot_account_id)
+    text = message.body
+    for url, iembot_account_id in hooks.items():
+        # Quarantined urls are skipped before recording the delivery
+        if not BREAKERS.available(url):
+            continue
+        meta = bot.webhook_users[iembot_account_id]
+        if "batch_ms" in meta:
+            BATCHER.add(bot, iembot_account_id, meta, text, **kwargs)
+            continue
+        bot.deliver("webhooks", iembot_account_id, url, text, **kwargs)
@@ -12,6 +12,11 @@ from twisted.web import resource
 from twisted.web.http import Request
 
 import iembot.util as botutil
+from iembot.asynchttp import HTTP_CLIENT
+from iembot.executors import executor_stats
+from iembot.media import MEDIA_CACHE, PREPARED_CACHE
+from iembot.retry import RETRY_COUNTS
+from iembot.sessions import SESSIONS
 from iembot.slack import (
     SlackInstallChannel,
     SlackListChannel,
@@ -20,6 +25,8 @@ from iembot.slack import (
     SlackUnsubscribeChannel,
 )
 from iembot.types import JabberClient
+from iembot.webhooks import BATCHER as WEBHOOK_BATCHER
+from iembot.webhooks import BREAKERS as WEBHOOK_BREAKERS
 
 XML_CACHE = {}
 XML_CACHE_EXPIRES = {}
@@ -206,11 +213,46 @@ class StatusChannel(resource.Resource):
     def render(self, _request):
         """Answer the call."""
         tp = reactor.getThreadPool()
+        fanout = self.iembot.fanout
         res = {
             "threadpool.max": tp.max,
             "threadpool.waiters": len(tp.waiters),
             "threadpool.working": len(tp.working),
+            "fanout.generation": fanout.generation,
+            "fanout.cache_hits": fanout.cache_hits,
+            "fanout.cache_misses": fanout.cache_misses,
+            "reload.coalesced": self.iembot.reload_coalesced,
+            "reload.skipped": self.iembot.reload_skipped,
+            "groupchat.xml_checks": len(self.iembot.xml_checks),
+            "groupchat.xml_checks_hits": self.iembot.xml_checks_hits,
         }
+        res.update(executor_stats())
+        res.update({f"retry.{key}": val for key, val in RETRY_COUNTS.items()})
+        res.update(self.iembot.at_manager.stats())
+        res.update(self.iembot.social_log.stats())
+        res.update(self.iembot.pending.stats())
+        res.update(MEDIA_CACHE.stats())
+        res.update(
+            {
+                f"media.prepared.{key[6:]}": val
+                for key, val in PREPARED_CACHE.stats().items()
+            }
+        )
+        res.update(SESSIONS.stats())
+        res.update(HTTP_CLIENT.stats())
+        # The urls embed the subscriber's secret, so named by account
+        names = {}
+        for user_id, meta in self.iembot.webhook_users.items():
+            names.setdefault(meta["url"], []).append(str(user_id))
+        res.update(
+            WEBHOOK_BREAKERS.stats(
+                "webhooks.circuit",
+                {url: ",".join(ids) for url, ids in names.items()},
+            )
+        )
+        res.update(WEBHOOK_BATCHER.stats())
+        if self.iembot.outbox is not None:
+            res.update(self.iembot.outbox.stats())
         return json.dumps(res).encode("utf-8")
 
 
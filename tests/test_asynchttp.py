@@ -0,0 +1,97 @@
+"""Test iembot.asynchttp"""
+
+import pytest
+import pytest_twisted
+from twisted.internet import defer, reactor
+from twisted.internet.task import deferLater
+from twisted.web import resource, server
+
+from iembot.asynchttp import (
+    HTTP_CLIENT,
+    AsyncHTTPClient,
+    HTTPStatusError,
+    configure_http,
+)
+
+
+class _Held(resource.Resource):
+    """Hold the requests until released."""
+
+    isLeaf = True
+
+    def __init__(self):
+        super().__init__()
+        self.held = []
+
+    def render_POST(self, request):
+        self.held.append(request)
+        return server.NOT_DONE_YET
+
+    def release(self):
+        held, self.held = self.held, []
+        for request in held:
+            request.write(b"done")
+            request.finish()
+
+
+@pytest.fixture
+def held_server():
+    """A local HTTP server holding the requests."""
+    held = _Held()
+    port = reactor.listenTCP(0, server.Site(held), interface="127.0.0.1")
+    yield f"http://127.0.0.1:{port.getHost().port}/", held
+    port.stopListening()
+
+
+@pytest_twisted.inlineCallbacks
+def test_host_concurrency(held_server):
+    """Test that a host has at most the limit of requests in flight."""
+    url, held = held_server
+    client = AsyncHTTPClient(concurrency=2)
+    dfs = [client.post(url, b"x") for _ in range(3)]
+    yield deferLater(reactor, 0.2, lambda: None)
+    assert len(held.held) == 2
+    assert client.stats()["http.waiting"] == 1
+    held.release()
+    yield deferLater(reactor, 0.2, lambda: None)
+    held.release()
+    res = yield defer.gatherResults(dfs)
+    assert res == [b"done"] * 3
+    stats = client.stats()
+    assert stats["http.requests"] == 3
+    assert stats["http.inflight"] == 0
+    assert stats["http.hosts"] == 0
+    yield client.close()
+
+
+@pytest_twisted.inlineCallbacks
+def test_timeout(held_server):
+    """Test that a slow request is given up."""
+    url, held = held_server
+    client = AsyncHTTPClient(timeout=0.2)
+    with pytest.raises(defer.TimeoutError):
+        yield client.post(url, b"x")
+    assert client.stats()["http.timeouts"] == 1
+    held.release()
+    yield client.close()
+
+
+@pytest_twisted.inlineCallbacks
+def test_status_error(http_server):
+    """Test that a non-2xx response fails."""
+    url, recorder = http_server
+    recorder.status = 404
+    client = AsyncHTTPClient()
+    with pytest.raises(HTTPStatusError) as exc:
+        yield client.post(url, b"x", {"X-Test": "1"})
+    assert exc.value.body == b"ok"
+    assert client.stats()["http.failures"] == 1
+    yield client.close()
+
+
+def test_configure_http():
+    """Test the settings."""
+    configure_http({"bot.http.concurrency": "4", "bot.http.timeout": "3"})
+    assert HTTP_CLIENT.concurrency == 4
+    assert HTTP_CLIENT.timeout == 3
+    configure_http({})
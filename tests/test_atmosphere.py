@@ -1,22 +1,27 @@
 """Tests for iembot atmosphere module."""
 
-import queue
+import os
 from functools import partial
 from unittest import mock
 
 import pytest
 import responses
+from atproto import SessionEvent
 from atproto_client.exceptions import InvokeTimeoutError, RequestException
 from twisted.words.xish.domish import Element
 
 from iembot.atmosphere import (
+    ATAccount,
+    ATBacklogFull,
     ATManager,
-    ATWorkerThread,
+    ATSessionStore,
     _at_helper,
     at_send_message,
     load_atmosphere_from_db,
     route,
 )
+from iembot.message import prepare_message
+from iembot.retry import RetryableError, RetryPolicy
 from iembot.types import JabberClient
 
 
@@ -26,8 +31,14 @@ class FakeATClient:
         self.login_calls = []
         self.send_post_calls = []
         self.send_image_calls = []
-
-    def login(self, handle, password):
+        self.session_calls = []
+
+    def login(self, handle=None, password=None, session_string=None):
+        if session_string is not None:
+            if session_string == "expired":
+                raise RequestException(response=mock.Mock(status_code=400))
+            self.session_calls.append(session_string)
+            return "me"
         self.login_calls.append((handle, password))
         return "me"
 
@@ -40,85 +51,112 @@ class FakeATClient:
         self.send_image_calls.append((msg, image, image_alt))
 
 
+def _manager(**kwargs) -> ATManager:
+    """Build a manager with one account using a fake client."""
+    kwargs.setdefault("scheduler", mock.Mock())
+    kwargs.setdefault("workers", 1)
+    manager = ATManager(**kwargs)
+    account = ATAccount("user", "pw", mock.Mock())
+    account.client = FakeATClient()
+    manager.at_clients["user"] = account
+    return manager
+
+
+def _drain(manager: ATManager):
+    """Run the workers until the accounts have nothing left."""
+    manager.start()
+    manager.ready.join()
+    manager.stop()
+    for worker in manager.workers:
+        worker.join(timeout=2)
+        assert not worker.is_alive()
+
+
 @pytest.mark.timeout(10)  # Ensure the thread hackery does not cause trouble
 def test_gh168_invocation_timeout():
     """Test the handling of a timeout."""
-    q = queue.Queue()
-    worker = ATWorkerThread(q, 123, "user", "pw", sleeper=lambda _s: None)
-    worker.client = FakeATClient()
+    manager = _manager()
 
     def _fakey(_user, _pass):
         raise InvokeTimeoutError("Simulated timeout")
 
-    worker.client.login = _fakey
-    # Put a message with media and msg
-    q.put({"msg": "hello http://link"})
-    # Sentinel to stop the thread cleanly after message handling
-    q.put(None)
-
-    worker.start()
-    q.join()  # Wait for all tasks
-    worker.join(timeout=2)
-    assert not worker.is_alive()
+    manager.at_clients["user"].client.login = _fakey
+    manager.submit("user", {"msg": "hello http://link"})
+    _drain(manager)
+    # The message is tried again later, not slept on
+    _delay, func, account, message = manager.scheduler.call_args.args
+    assert func == manager.resume
+    assert account is manager.at_clients["user"]
+    assert message == {"msg": "hello http://link", "attempt": 2}
 
 
 @pytest.mark.timeout(10)  # Ensure the thread hackery does not cause trouble
 def test_gh183_proxy_error():
     """Test the handling of a 503.."""
-    q = queue.Queue()
-    worker = ATWorkerThread(q, 123, "user", "pw", sleeper=lambda _s: None)
-    worker.client = FakeATClient()
+    manager = _manager()
 
     def _fakey(_user, _pass):
         raise RequestException(response=mock.Mock(status_code=503))
 
-    worker.client.login = _fakey
-    # Put a message with media and msg
-    q.put({"msg": "hello http://link"})
-    # Sentinel to stop the thread cleanly after message handling
-    q.put(None)
-
-    worker.start()
-    q.join()  # Wait for all tasks
-    worker.join(timeout=2)
-    assert not worker.is_alive()
+    manager.at_clients["user"].client.login = _fakey
+    manager.submit("user", {"msg": "hello http://link"})
+    _drain(manager)
+    manager.scheduler.assert_called_once()
 
 
-def test_at_helper_uses_injected_retry_sleep():
-    """Test _at_helper retries 5xx once and uses injected sleeper."""
-    sleeper = mock.Mock()
+def test_at_helper_server_error_is_retryable():
+    """Test _at_helper raises a 5xx as retryable, without sleeping."""
 
     def _fakey(_user, _pass):
         raise RequestException(response=mock.Mock(status_code=503))
 
+    with pytest.raises(RetryableError):
+        _at_helper(_fakey, "user", "pw")
+
+
+def test_at_helper_client_error():
+    """Test _at_helper raises a 4xx as is."""
+
+    def _fakey(_user, _pass):
+        raise RequestException(response=mock.Mock(status_code=400))
+
     with pytest.raises(RequestException):
-        _at_helper(
-            _fakey,
-            "user",
-            "pw",
-            retry_sleep_seconds=7,
-            sleeper=sleeper,
-        )
-    sleeper.assert_called_once_with(7)
+        _at_helper(_fakey, "user", "pw")
+
+
+def test_atmanager_retry_gives_up():
+    """Test that a message is dropped after the policy's attempts."""
+    manager = _manager(policy=RetryPolicy(attempts=3, delay=1, jitter=0))
+    account = manager.at_clients["user"]
+    done = mock.Mock()
+    manager.retry(account, {"msg": "hi", "attempt": 2}, RetryableError("x"))
+    manager.scheduler.assert_called_once_with(
+        2, manager.resume, account, {"msg": "hi", "attempt": 3}
+    )
+    manager.scheduler.reset_mock()
+    message = {"msg": "hi", "attempt": 3, "done": done}
+    manager.retry(account, message, RetryableError("x"))
+    manager.scheduler.assert_called_once_with(0, done.callback, None)
 
 
 @pytest.mark.timeout(10)  # Ensure the thread hackery does not cause trouble
-def test_atworkerthread_run_and_process_message(bot: JabberClient):
-    """Test ATWorkerThread run loop and process_message logic."""
-    q = queue.Queue()
-    cb = partial(bot.log_iembot_social_log, 123)
-    worker = ATWorkerThread(q, "user", "pw", cb)
-    worker.client = FakeATClient()
+def test_atmanager_work_in_order(bot: JabberClient):
+    """Test the workers process an account's messages in order."""
+    manager = _manager()
+    account = manager.at_clients["user"]
+    account.message_callback = partial(bot.log_iembot_social_log, 123)
     # Put a message with media and msg
-    q.put({"twitter_media": "http://fake", "msg": "hello http://link"})
+    manager.submit(
+        "user", {"twitter_media": "http://fake", "msg": "hello http://link"}
+    )
     # Message where the twitter_media request will fail
-    q.put({"twitter_media": "http://r404", "msg": "just text"})
+    manager.submit("user", {"twitter_media": "http://r404", "msg": "text 1"})
     # Message where the twitter_media request will generate +1MB image
-    q.put({"twitter_media": "http://toobig", "msg": "just text"})
+    manager.submit("user", {"twitter_media": "http://toobig", "msg": "text 2"})
     # Message that will raise unaccounted for exception
-    q.put({"msg": "RAISE"})
-    # Signal thread to exit
-    q.put(None)
+    manager.submit("user", {"msg": "RAISE"})
+    manager.submit("user", {"msg": "text 3"})
+    assert manager.backlog() == {"user": 5}
 
     with responses.RequestsMock() as rsps:
         rsps.add(responses.GET, "http://fake", body=b"fakeimage", status=200)
@@ -126,12 +164,60 @@ def test_atworkerthread_run_and_process_message(bot: JabberClient):
         rsps.add(
             responses.GET, "http://toobig", body=b"x" * 1_000_001, status=200
         )
-        worker.start()
-        q.join()  # Wait for all tasks
-        worker.join(timeout=2)
+        _drain(manager)
     # Check that login and send_post/send_image were called
-    assert worker.client.login_calls[0] == ("user", "pw")
-    assert worker.client.send_image_calls or worker.client.send_post_calls
+    assert account.client.login_calls == [("user", "pw"), ("user", "pw")]
+    assert account.client.send_image_calls
+    assert account.client.send_post_calls == ["text 1", "text 2", "text 3"]
+    assert manager.backlog() == {}
+    assert not account.active
+
+
+def test_atmanager_retry_keeps_order():
+    """Test that a retried message goes first and holds the account."""
+    manager = _manager(policy=RetryPolicy(attempts=3, delay=1, jitter=0))
+    account = manager.at_clients["user"]
+    account.process_message = mock.Mock(side_effect=RetryableError("x"))
+    manager.submit("user", {"msg": "1"})
+    manager.submit("user", {"msg": "2"})
+    manager.ready.get()
+    manager.work("user")
+    # Held, so no worker takes the newer message meanwhile
+    assert account.active
+    assert manager.ready.empty()
+    _delay, func, *args = manager.scheduler.call_args.args
+    func(*args)
+    assert [m["msg"] for m in account.backlog] == ["1", "2"]
+    assert manager.ready.get() == "user"
+    # A retry of a removed client is finished
+    manager.reconcile({})
+    done = mock.Mock()
+    manager.resume(account, {"msg": "3", "done": done})
+    manager.scheduler.assert_called_with(0, done.callback, None)
+
+
+def test_atmanager_work_empty_backlog():
+    """Test that a stale ready handle does not fail the worker."""
+    manager = _manager()
+    account = manager.at_clients["user"]
+    account.active = True
+    manager.work("user")
+    assert not account.active
+
+
+def test_atmanager_backlog_bound():
+    """Test the backpressure of a full account backlog."""
+    manager = _manager(max_backlog=1)
+    manager.submit("user", {"msg": "1"})
+    with pytest.raises(ATBacklogFull):
+        manager.submit("user", {"msg": "2"})
+    manager.submit("user", {"msg": "3"}, retry=True)
+    stats = manager.stats()
+    assert stats["atmosphere.backlog"] == 2
+    assert stats["atmosphere.backlog.user"] == 2
+    assert stats["atmosphere.dropped"] == 1
+    # The account is on the ready queue once
+    assert manager.ready.qsize() == 1
 
 
 @pytest.mark.parametrize("database", ["iembot"])
@@ -143,36 +229,32 @@ def test_load_atmosphere_from_db(dbcursor, bot: JabberClient):
 def test_route_no_x_in_message(bot: JabberClient):
     """Test what happens with a message without X."""
     msg = Element(("jabber:client", "message"))
-    msg["body"] = "Test Message"
-    route(bot, "unknown_user", msg)
+    msg.addElement("body", content="Test Message")
+    route(bot, prepare_message(msg, ["unknown_user"]))
 
 
 def test_at_send_message_unknown_user(bot: JabberClient):
     """Test at_send_message with unknown user."""
     # Should not raise an error
     msg = Element(("jabber:client", "message"))
-    msg["body"] = "Test Message"
-    msg.x = Element(("", "x"))
+    msg.addElement("body", content="Test Message")
+    msg.addElement(("", "x"))
     msg.x["twitter"] = "Test message"
-    route(bot, "unknown_user", msg)
+    route(bot, prepare_message(msg, ["unknown_user"]))
 
 
 def test_at_send_message_no_handle(bot: JabberClient):
     """Test at_send_message with user that has no at_handle."""
     bot.at_users = {"123": {"at_handle": None}}
-    bot.at_routingtable = {
-        "XXX": [
-            "123",
-        ]
-    }
+    bot.fanout.update("atmosphere", {"XXX": ["123"]})
     msg = Element(("jabber:client", "message"))
-    msg.x = Element(("", "x"))
+    msg.addElement(("", "x"))
     msg.x["twitter"] = "Test message"
     msg.x["twitter_media"] = (
         "https://mesonet.agron.iastate.edu/data/mesonet.gif"
     )
-    msg["body"] = "Test Message"
-    route(bot, ["XXX"], msg)
+    msg.addElement("body", content="Test Message")
+    route(bot, prepare_message(msg, ["XXX"]))
 
 
 def test_at_send_message_with_handle(bot: JabberClient):
@@ -183,24 +265,23 @@ def test_at_send_message_with_handle(bot: JabberClient):
     bot.at_manager.submit = mock.Mock()
     at_send_message(bot, "123", "test message", extra_key="value")
     bot.at_manager.submit.assert_called_once_with(
-        "test.bsky.social", {"msg": "test message", "extra_key": "value"}
+        "test.bsky.social",
+        {"msg": "test message", "extra_key": "value", "done": mock.ANY},
     )
 
 
 def test_atmanager_add_client(bot: JabberClient):
-    """Test ATManager add_client."""
-    sleeper = mock.Mock()
-    manager = ATManager(retry_sleep_seconds=0, sleeper=sleeper)
+    """Test that the thread count does not grow with the accounts."""
+    manager = ATManager(workers=2)
     cb = partial(bot.log_iembot_social_log, 123)
     with mock.patch("iembot.atmosphere.ATWorkerThread") as mock_thread:
         mock_instance = mock.Mock()
         mock_thread.return_value = mock_instance
-        manager.add_client("test.bsky.social", "password123", cb)
-        mock_thread.assert_called_once()
-        assert mock_thread.call_args.kwargs["retry_sleep_seconds"] == 0
-        assert mock_thread.call_args.kwargs["sleeper"] is sleeper
-        mock_instance.start.assert_called_once()
-        assert "test.bsky.social" in manager.at_clients
+        for i in range(5):
+            manager.add_client(f"test{i}.bsky.social", "password123", cb)
+        assert mock_thread.call_count == 2
+        assert mock_instance.start.call_count == 2
+        assert "test4.bsky.social" in manager.at_clients
 
 
 def test_atmanager_add_client_duplicate(bot: JabberClient):
@@ -215,11 +296,93 @@ def test_atmanager_add_client_duplicate(bot: JabberClient):
 
 def test_atmanager_submit():
     """Test ATManager submit."""
-    manager = ATManager()
-    mock_queue = mock.Mock()
-    mock_thread = mock.Mock()
-    mock_thread.queue = mock_queue
-    manager.at_clients["test.bsky.social"] = mock_thread
+    manager = _manager()
+    manager.submit("user", {"msg": "Hello"})
+    assert list(manager.at_clients["user"].backlog) == [{"msg": "Hello"}]
+    assert manager.ready.get_nowait() == "user"
+
 
-    manager.submit("test.bsky.social", {"msg": "Hello"})
-    mock_queue.put.assert_called_once_with({"msg": "Hello"})
+def test_at_send_message_backlog_full(bot: JabberClient):
+    """Test that a message for a full backlog is dropped."""
+    bot.at_users = {"123": {"at_handle": "test.bsky.social"}}
+    bot.at_manager = mock.Mock()
+    bot.at_manager.submit.side_effect = ATBacklogFull("full")
+    assert at_send_message(bot, "123", "test message") is None
+
+
+def test_session_store(tmp_path):
+    """Test keeping the session strings within a file."""
+    path = tmp_path / "sessions.json"
+    store = ATSessionStore(str(path))
+    store.load()
+    assert store.get("user") is None
+    store.put("user", "session1")
+    store.put("other", "session2")
+    store.discard("other")
+    assert os.stat(path).st_mode & 0o777 == 0o600
+    store = ATSessionStore(str(path))
+    store.load()
+    assert store.sessions == {"user": "session1"}
+    path.write_text("{bad")
+    store.load()
+    assert store.sessions == {}
+
+
+def test_account_resumes_session(tmp_path):
+    """Test that a stored session is resumed instead of a login."""
+    store = ATSessionStore(str(tmp_path / "sessions.json"))
+    store.put("user", "session1")
+    account = ATAccount("user", "pw", mock.Mock(), store)
+    account.client = FakeATClient()
+    account.process_message({"msg": "hi"})
+    assert account.client.session_calls == ["session1"]
+    assert account.client.login_calls == []
+    assert (account.resumes, account.logins) == (1, 0)
+    # A created or refreshed session is kept, an imported one is not
+    session = mock.Mock()
+    session.export.return_value = "session2"
+    account.session_changed(SessionEvent.IMPORT, session)
+    assert store.get("user") == "session1"
+    account.session_changed(SessionEvent.REFRESH, session)
+    assert store.get("user") == "session2"
+
+
+def test_account_session_expired(tmp_path):
+    """Test that an unusable session falls back to the app password."""
+    store = ATSessionStore(str(tmp_path / "sessions.json"))
+    store.put("user", "expired")
+    account = ATAccount("user", "pw", mock.Mock(), store)
+    account.client = FakeATClient()
+    account.login()
+    assert account.client.login_calls == [("user", "pw")]
+    assert store.get("user") is None
+    assert account.logged_in
+
+
+def test_atmanager_reconcile(tmp_path):
+    """Test that the clients follow the accounts of the database."""
+    manager = _manager(workers=0)
+    manager.sessions = ATSessionStore(str(tmp_path / "sessions.json"))
+    manager.sessions.put("user", "session1")
+    account = manager.at_clients["user"]
+    account.logged_in = True
+    cb = mock.Mock()
+    # Changed password
+    manager.reconcile({"user": ("pw2", cb), "new": ("pw", cb)})
+    assert manager.at_clients["user"] is account
+    assert account.at_password == "pw2"
+    assert not account.logged_in
+    assert manager.sessions.get("user") is None
+    assert set(manager.at_clients) == {"user", "new"}
+    # Partial reload of an account only removes its handle
+    done = mock.Mock()
+    manager.submit("new", {"msg": "hi", "done": done})
+    manager.reconcile({}, {"new"})
+    assert set(manager.at_clients) == {"user"}
+    manager.scheduler.assert_called_once_with(0, done.callback, None)
+    # Full reload removes the others
+    manager.reconcile({})
+    assert manager.at_clients == {}
+    # A message for a removed client is finished, not raised
+    manager.submit("new", {"msg": "hi", "done": done})
+    manager.scheduler.assert_called_with(0, done.callback, None)
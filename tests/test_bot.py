@@ -3,16 +3,29 @@
 from unittest.mock import Mock, patch
 
 import pytest_twisted
+from twisted.internet.defer import Deferred, succeed
+from twisted.words.xish.domish import Element
 
-from iembot.bot import JabberClient
+from iembot.bot import (
+    RELOAD_TABLES,
+    SUBSCRIPTION_TABLES,
+    JabberClient,
+    load_transports_from_db,
+)
+from iembot.routing import RoutingSnapshot, RoutingTable
+from iembot.util import load_fingerprints_from_db
 
 
 @pytest_twisted.inlineCallbacks
 def test_gh185_no_str_response(bot: JabberClient):
     """Test that we can persist things."""
-    with patch("iembot.bot.log.err") as mock_err:
-        yield bot.log_iembot_social_log(123, {"not": "a string"})
+    bot.dbpool.runInteraction.return_value = succeed(None)
+    with patch("iembot.sociallog.log.err") as mock_err:
+        bot.log_iembot_social_log(123, {"not": "a string"})
+        yield bot.social_log.flush()
     mock_err.assert_not_called()
+    rows = bot.dbpool.runInteraction.call_args.args[1]
+    assert rows == [(123, "{'not': 'a string'}")]
 
 
 def test_bot_apis(bot: JabberClient):
@@ -26,7 +39,10 @@ def test_authd_api(bot: JabberClient):
     """Call authd."""
     xs = Mock()
     bot.connected(xs)
+    bot.rooms = {"dmxchat": {"joined": True, "occupants": {"a": {}}}}
     bot.authd()
+    # The room is kept, so messages wait for it to be rejoined
+    assert bot.rooms["dmxchat"] == {"joined": False, "occupants": {}}
 
 
 def test_xml(bot):
@@ -38,3 +54,232 @@ def test_xml(bot):
 
     msg = bot.send_groupchat("roomname", "Hello Friend &&amp;")
     assert msg is not None
+
+
+def test_send_groupchat_validated(bot: JabberClient):
+    """Test that the checked bytes are sent and the check is cached."""
+    bot.rooms = {"roomname": {"joined": True}}
+    msg = bot.send_groupchat("roomname", "Hello", "<p>Hello</p>")
+    raw = bot.xmlstream.send.call_args.args[0]
+    assert raw == bot.serialize(msg)
+    bot.send_groupchat("roomname", "Hello", "<p>Hello</p>")
+    assert bot.xml_checks_hits == 1
+    with patch("iembot.bot.email_error") as mock_email:
+        assert bot.send_groupchat("roomname", "Hi", "<p>Hi") is None
+        assert bot.send_groupchat("roomname", "Hi", "<p>Hi") is None
+    assert mock_email.call_count == 2
+    # The error is formatted, as there is no exception being handled
+    assert mock_email.call_args.args[0].startswith("Invalid XML: ")
+    assert bot.xml_checks_hits == 2
+    assert bot.xmlstream.send.call_count == 2
+
+
+def test_pending_until_joined(bot: JabberClient):
+    """Test that groupchats wait for the room's self-presence."""
+    bot.config["bot.mucservice"] = "conference.localhost"
+    bot.rooms = {"dmxchat": {"joined": False, "occupants": {}}}
+    for text in ("one", "two"):
+        bot.send_groupchat("dmxchat", text)
+    bot.xmlstream.send.assert_not_called()
+    presence = Element(("jabber:client", "presence"))
+    presence["from"] = "dmxchat@conference.localhost/iembot"
+    x = presence.addElement(("http://jabber.org/protocol/muc#user", "x"))
+    item = x.addElement("item")
+    item["affiliation"] = "owner"
+    item["role"] = "moderator"
+    x.addElement("status")["code"] = "110"
+    bot.presence_processor(presence)
+    assert bot.rooms["dmxchat"]["joined"]
+    sent = [call.args[0] for call in bot.xmlstream.send.call_args_list]
+    assert len(sent) == 2
+    assert b"one" in sent[0]
+    assert b"two" in sent[1]
+    assert bot.pending.stats()["pending.sent"] == 2
+
+    # Being kicked out drops what was queued meanwhile
+    bot.rooms["dmxchat"]["joined"] = False
+    bot.send_groupchat("dmxchat", "three")
+    item["affiliation"] = "none"
+    item["role"] = "none"
+    bot.presence_processor(presence)
+    assert not bot.rooms["dmxchat"]["joined"]
+    stats = bot.pending.stats()
+    assert stats["pending.dropped"] == 1
+    assert stats["pending.waiting"] == 0
+    assert bot.xmlstream.send.call_count == 2
+
+
+def test_pending_across_reconnect(bot: JabberClient):
+    """Test that what is routed while disconnected is sent once rejoined."""
+    bot.config["bot.mucservice"] = "conference.localhost"
+    bot.rooms = {"dmxchat": {"joined": True, "occupants": {"a": {}}}}
+    bot.disconnected()
+    assert bot.rooms["dmxchat"] == {"joined": False, "occupants": {}}
+    bot.send_groupchat("dmxchat", "one")
+    elem = Element(("jabber:client", "message"))
+    elem["type"] = "groupchat"
+    elem.addElement("body", content="two")
+    assert bot.send_groupchat_fanout(elem, ["dmxchat"]) == 0
+    bot.xmlstream.send.assert_not_called()
+    presence = Element(("jabber:client", "presence"))
+    presence["from"] = "dmxchat@conference.localhost/iembot"
+    x = presence.addElement(("http://jabber.org/protocol/muc#user", "x"))
+    item = x.addElement("item")
+    item["affiliation"] = "owner"
+    item["role"] = "moderator"
+    x.addElement("status")["code"] = "110"
+    bot.presence_processor(presence)
+    sent = [call.args[0] for call in bot.xmlstream.send.call_args_list]
+    assert len(sent) == 2
+    assert b"one" in sent[0]
+    assert b"two" in sent[1]
+
+
+def test_swap_snapshot(bot: JabberClient):
+    """Test swapping in a routing snapshot."""
+    snapshot = RoutingSnapshot(
+        "mastodon",
+        RoutingTable.compile({"ABC": [456]}),
+        {456: {"screen_name": "abc"}},
+    )
+    assert bot.swap_snapshot(snapshot) is snapshot
+    assert bot.md_users == {456: {"screen_name": "abc"}}
+    assert bot.fanout.resolve(["ABC", "XXX"])["mastodon"] == {456}
+
+
+def test_merge_snapshot(bot: JabberClient):
+    """Test merging a single account snapshot."""
+    snapshot = RoutingSnapshot(
+        "mastodon",
+        RoutingTable.compile({"ABC": [456]}),
+        {456: {"screen_name": "abc"}},
+    )
+    bot.merge_snapshot(snapshot, 456)
+    assert set(bot.md_users) == {123, 456}
+    assert bot.fanout.resolve(["ABC", "XXX"])["mastodon"] == {123, 456}
+    # Now remove the account again
+    bot.merge_snapshot(
+        RoutingSnapshot("mastodon", RoutingTable.compile({}), {}), 456
+    )
+    assert set(bot.md_users) == {123}
+    assert bot.fanout.resolve(["ABC", "XXX"])["mastodon"] == {123}
+
+
+def test_atmosphere_snapshot_reconciles(bot: JabberClient):
+    """Test that the Bluesky clients change with the swapped accounts."""
+    bot.at_manager = Mock()
+    users = {456: {"at_handle": "abc.bsky.social", "at_password": "pw"}}
+    bot.swap_snapshot(
+        RoutingSnapshot("atmosphere", RoutingTable.compile({}), users)
+    )
+    accounts, scope = bot.at_manager.reconcile.call_args.args
+    assert accounts["abc.bsky.social"][0] == "pw"
+    assert scope is None
+    # Removing the account only stops its client
+    bot.merge_snapshot(
+        RoutingSnapshot("atmosphere", RoutingTable.compile({}), {}), 456
+    )
+    bot.at_manager.reconcile.assert_called_with({}, {"abc.bsky.social"})
+    assert bot.at_users == {}
+
+
+def test_reload_config_coalesced(bot: JabberClient):
+    """Test that overlapping reloads collapse into one."""
+    pending = Deferred()
+    bot.dbpool.runInteraction = Mock(return_value=pending)
+    bot.reload_config(always_join=False)
+    bot.reload_config(always_join=True)
+    bot.reload_config(always_join=False)
+    assert bot.dbpool.runInteraction.call_count == 1
+    assert bot.reload_coalesced == 2
+    assert bot.reload_pending is True
+
+
+def test_reload_config_unchanged(bot: JabberClient):
+    """Test that unchanged transports are not reloaded."""
+    tables = SUBSCRIPTION_TABLES + sum(RELOAD_TABLES.values(), ())
+    fingerprints = dict.fromkeys(tables, (1, 1))
+    loaded = []
+
+    def _run(func, *args):
+        if func is load_fingerprints_from_db:
+            return succeed(fingerprints)
+        loaded.append(args[1])
+        return succeed([])
+
+    bot.dbpool.runInteraction = Mock(side_effect=_run)
+    bot.reload_config(always_join=False)
+    assert loaded.pop() == tuple(RELOAD_TABLES)
+    # Pretend all were loaded
+    for transport, reload_tables in RELOAD_TABLES.items():
+        bot.fingerprints[transport] = tuple(
+            fingerprints[table]
+            for table in SUBSCRIPTION_TABLES + reload_tables
+        )
+    bot.reload_config(always_join=False)
+    assert not loaded
+    # Rejoining after a reconnect always loads the chatrooms
+    bot.reload_config(always_join=True)
+    assert loaded.pop() == ("xmpp",)
+    assert bot.reload_skipped == 13
+    assert bot.reload_inflight is None
+
+
+def test_apply_snapshots(bot: JabberClient):
+    """Test applying snapshots loaded in bulk."""
+    snapshot = RoutingSnapshot(
+        "mastodon", RoutingTable.compile({"ABC": [456]}), {456: {}}
+    )
+    bot._apply_snapshots([snapshot], False, {"mastodon": ((1, 1),)})
+    assert bot.fingerprints["mastodon"] == ((1, 1),)
+    assert bot.fanout.subscribers("mastodon", "ABC") == {456}
+
+
+def test_load_transports_from_db(bot: JabberClient):
+    """Test that one subscriptions query feeds each loader."""
+    txn = Mock()
+    loader = Mock(return_value="snapshot")
+    with (
+        patch(
+            "iembot.bot.load_subscriptions_from_db",
+            return_value={"twitter": {"ABC": [1]}},
+        ) as subs,
+        patch.dict("iembot.bot.LOADERS", {"twitter": loader}),
+    ):
+        res = load_transports_from_db(txn, bot, ("twitter",))
+    assert res == ["snapshot"]
+    subs.assert_called_once_with(txn, ("twitter",))
+    loader.assert_called_once_with(txn, bot, subs={"ABC": [1]})
+
+
+def test_load_transports_isolated(bot: JabberClient):
+    """Test that a failing loader only skips its transport."""
+    txn = Mock()
+    broken = Mock(side_effect=ValueError("no such column"))
+    loader = Mock(return_value="snapshot")
+    with (
+        patch("iembot.bot.load_subscriptions_from_db", return_value={}),
+        patch.dict("iembot.bot.LOADERS", {"webhooks": broken, "xmpp": loader}),
+        patch("iembot.bot.log.err") as mock_err,
+    ):
+        res = load_transports_from_db(txn, bot, ("webhooks", "xmpp"))
+    assert res == ["snapshot"]
+    mock_err.assert_called_once()
+    statements = [call.args[0] for call in txn.execute.call_args_list]
+    assert statements == [
+        "SAVEPOINT load_transport",
+        "ROLLBACK TO SAVEPOINT load_transport",
+        "SAVEPOINT load_transport",
+        "RELEASE SAVEPOINT load_transport",
+    ]
+
+
+def test_deliver(bot: JabberClient):
+    """Test delivering directly and through the outbox."""
+    deliverer = Mock(return_value=None)
+    with patch.dict("iembot.bot.DELIVERERS", {"slack": deliverer}):
+        bot.deliver("slack", 123, "hi")
+    deliverer.assert_called_once_with(bot, 123, "hi")
+    bot.outbox = Mock(leftover=[])
+    bot.deliver("slack", 123, "hi", extra=1)
+    bot.outbox.put.assert_called_once_with("slack", 123, "hi", extra=1)
@@ -0,0 +1,52 @@
+"""Test iembot.circuit"""
+
+import pytest
+from twisted.internet.task import Clock
+
+from iembot.circuit import (
+    HALF_OPEN,
+    OPEN,
+    CircuitBreakers,
+    CircuitOpen,
+    _digest,
+)
+
+
+def test_open_probe_close():
+    """Test the states of a circuit."""
+    clock = Clock()
+    breakers = CircuitBreakers(failures=2, reset=10, clock=clock)
+    breakers.acquire("u")
+    breakers.failure("u")
+    assert breakers.available("u")
+    breakers.failure("u")
+    assert breakers.circuits["u"].state == OPEN
+    assert not breakers.available("u")
+    with pytest.raises(CircuitOpen):
+        breakers.acquire("u")
+    # One probe once the reset passed
+    clock.advance(10)
+    assert breakers.available("u")
+    breakers.acquire("u")
+    assert breakers.circuits["u"].state == HALF_OPEN
+    assert not breakers.available("u")
+    # A failed probe opens it again
+    breakers.failure("u")
+    assert breakers.circuits["u"].state == OPEN
+    stats = breakers.stats("test")
+    assert stats["test.open"] == 1
+    assert stats["test.opened"] == 2
+    assert stats["test.skipped"] == 3
+    assert stats["test.u"] == OPEN
+    # The key of an endpoint is not published when named
+    stats = breakers.stats("test", {"u": "123"})
+    assert stats["test.123"] == OPEN
+    assert "test.u" not in stats
+    stats = breakers.stats("test", {})
+    assert stats[f"test.{_digest('u')}"] == OPEN
+    assert "test.u" not in stats
+    clock.advance(10)
+    breakers.acquire("u")
+    breakers.success("u")
+    assert breakers.circuits == {}
+    assert breakers.stats("test")["test.open"] == 0
@@ -0,0 +1,64 @@
+"""Test iembot.executors"""
+
+import threading
+
+import pytest
+import pytest_twisted
+
+from iembot.executors import (
+    EXECUTORS,
+    BoundedExecutor,
+    ExecutorFull,
+    configure_executors,
+    defer_to_executor,
+    executor_stats,
+)
+
+
+@pytest_twisted.inlineCallbacks
+def test_submit():
+    """Test running something within an executor."""
+    executor = BoundedExecutor("test", 2, 10)
+    executor.start()
+    res = yield executor.submit(lambda x, y=1: x + y, 1, y=2)
+    assert res == 3
+    stats = executor.stats()
+    assert stats["completed"] == 1
+    assert stats["queued"] == 0
+    executor.stop()
+
+
+@pytest_twisted.inlineCallbacks
+def test_queue_bound():
+    """Test that work is rejected once the queue is full."""
+    executor = BoundedExecutor("test", 1, 1)
+    executor.start()
+    release = threading.Event()
+    running = threading.Event()
+
+    def _block():
+        running.set()
+        release.wait(5)
+
+    first = executor.submit(_block)
+    running.wait(5)
+    second = executor.submit(lambda: None)
+    with pytest.raises(ExecutorFull):
+        yield executor.submit(lambda: None)
+    assert executor.stats()["rejected"] == 1
+    assert executor.stats()["queued"] == 1
+    release.set()
+    yield first
+    yield second
+    assert executor.stats()["completed"] == 2
+    executor.stop()
+
+
+@pytest_twisted.inlineCallbacks
+def test_configure_executors():
+    """Test sizing the executors from the config."""
+    configure_executors({"bot.executor.twitter.threads": "3"})
+    assert EXECUTORS["twitter"].pool.max == 3
+    res = yield defer_to_executor("twitter", lambda: 1)
+    assert res == 1
+    assert executor_stats()["executor.twitter.threads"] == 3
@@ -0,0 +1,155 @@
+"""Test iembot.listener"""
+
+import json
+from unittest import mock
+
+import psycopg
+from twisted.internet import defer
+
+from iembot.bot import JabberClient
+from iembot.listener import (
+    DeltaReloader,
+    NotifyListenerThread,
+    load_account_from_db,
+)
+from iembot.routing import RoutingSnapshot, RoutingTable
+
+
+def _payload(table, iembot_account_id):
+    return json.dumps(
+        {
+            "table": table,
+            "op": "INSERT",
+            "iembot_account_id": iembot_account_id,
+        }
+    )
+
+
+def test_load_account_not_found():
+    """Test that a removed account returns None."""
+    txn = mock.Mock()
+    txn.fetchone.return_value = None
+    assert load_account_from_db(txn, mock.Mock(), 123) is None
+
+
+def test_load_account():
+    """Test that the transport's loader is called."""
+    txn = mock.Mock()
+    txn.fetchone.return_value = {"transport": "mastodon"}
+    with mock.patch.dict(
+        "iembot.bot.LOADERS", {"mastodon": mock.Mock(return_value=1)}
+    ):
+        assert load_account_from_db(txn, mock.Mock(), 123) == 1
+
+
+def test_ignored_before_login(bot: JabberClient):
+    """Test that nothing happens before the first login."""
+    reloader = DeltaReloader(bot)
+    reloader.notify(_payload("iembot_subscriptions", 123))
+    bot.dbpool.runInteraction.assert_not_called()
+
+
+def test_delta_reload(bot: JabberClient):
+    """Test that a single account is merged."""
+    bot.firstlogin = True
+    snapshot = RoutingSnapshot(
+        "mastodon",
+        RoutingTable.compile({"ABC": [123]}),
+        {123: bot.md_users[123]},
+    )
+    bot.dbpool.runInteraction.return_value = defer.succeed(snapshot)
+    reloader = DeltaReloader(bot)
+    reloader.notify(_payload("iembot_subscriptions", 123))
+    assert reloader.deltas == 1
+    assert not reloader.inflight
+    assert bot.fanout.resolve(["ABC"])["mastodon"] == {123}
+    assert bot.fanout.resolve(["XXX"])["mastodon"] == set()
+
+
+def test_delta_removed(bot: JabberClient):
+    """Test that a removed account is dropped from all transports."""
+    bot.firstlogin = True
+    bot.dbpool.runInteraction.return_value = defer.succeed(None)
+    reloader = DeltaReloader(bot)
+    reloader.notify(_payload("iembot_mastodon_oauth", 123))
+    assert 123 not in bot.md_users
+    assert 123 not in bot.tw_users
+    assert bot.fanout.resolve(["XXX"])["slack"] == set()
+
+
+def test_delta_removed_clients(bot: JabberClient):
+    """Test that the clients of a removed account are closed."""
+    bot.firstlogin = True
+    bot.at_users = {123: {"at_handle": "abc.bsky.social"}}
+    bot.at_manager = mock.Mock()
+    bot.dbpool.runInteraction.return_value = defer.succeed(None)
+    reloader = DeltaReloader(bot)
+    with mock.patch("iembot.listener.SESSIONS") as sessions:
+        reloader.notify(_payload("iembot_atmosphere_accounts", 123))
+    sessions.discard.assert_has_calls(
+        [mock.call(("twitter", 123)), mock.call(("mastodon", 123))]
+    )
+    bot.at_manager.reconcile.assert_any_call({}, {"abc.bsky.social"})
+    assert bot.at_users == {}
+
+
+def test_delta_coalesced(bot: JabberClient):
+    """Test that notifications for an inflight account coalesce."""
+    bot.firstlogin = True
+    pending = defer.Deferred()
+    bot.dbpool.runInteraction.return_value = pending
+    reloader = DeltaReloader(bot)
+    for _ in range(5):
+        reloader.notify(_payload("iembot_subscriptions", 123))
+    assert bot.dbpool.runInteraction.call_count == 1
+    assert reloader.dirty == {123}
+    bot.dbpool.runInteraction.return_value = defer.succeed(None)
+    pending.callback(None)
+    assert bot.dbpool.runInteraction.call_count == 2
+    assert not reloader.dirty
+    assert not reloader.inflight
+
+
+def test_full_reloads(bot: JabberClient):
+    """Test the fallbacks to full reloads."""
+    bot.firstlogin = True
+    reloader = DeltaReloader(bot)
+    with (
+        mock.patch.object(bot, "reload_config") as reload_config,
+        mock.patch.object(bot, "load_slack") as load_slack,
+    ):
+        reloader.notify(None)
+        reloader.notify("not json")
+        reloader.notify(_payload("iembot_channel_group_membership", None))
+        reloader.notify(_payload("iembot_slack_teams", None))
+    assert reload_config.call_count == 3
+    load_slack.assert_called_once()
+    assert reloader.full_reloads == 4
+
+
+def test_listener_retries():
+    """Test that the listener thread sleeps after a failure."""
+    sleeper = mock.Mock()
+    thread = NotifyListenerThread({}, mock.Mock(), sleeper=sleeper)
+    sleeper.side_effect = lambda _: thread.stop()
+    with mock.patch(
+        "iembot.listener.psycopg.connect", side_effect=psycopg.Error("x")
+    ):
+        thread.run()
+    sleeper.assert_called_once()
+
+
+def test_listener_survives_unexpected():
+    """Test that an unexpected error is logged and the listener retries."""
+    sleeper = mock.Mock()
+    thread = NotifyListenerThread({}, mock.Mock(), sleeper=sleeper)
+    sleeper.side_effect = lambda _: thread.stop()
+    with (
+        mock.patch(
+            "iembot.listener.psycopg.connect", side_effect=TypeError("x")
+        ),
+        mock.patch("iembot.listener.log.err") as mock_err,
+    ):
+        thread.run()
+    mock_err.assert_called_once()
+    sleeper.assert_called_once()
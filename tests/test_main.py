@@ -7,6 +7,7 @@ import types
 from unittest import mock
 
 from click.testing import CliRunner
+from twisted.internet.defer import Deferred
 
 import iembot.main as main_mod
 
@@ -91,6 +92,17 @@ def test_fatal_stops_reactor(monkeypatch):
     assert called["stopped"]
 
 
+def test_close_dbpool_after_social_log():
+    """Test that the dbpool is closed once the social log is written."""
+    jabber = mock.Mock()
+    jabber.social_log.stop.return_value = Deferred()
+    dbpool = mock.Mock()
+    main_mod._close_dbpool(jabber, dbpool)
+    dbpool.close.assert_not_called()
+    jabber.social_log.stop.return_value.callback(None)
+    dbpool.close.assert_called_once_with()
+
+
 def taest_cli_help():
     runner = CliRunner()
     result = runner.invoke(main_mod.main, ["--help"])
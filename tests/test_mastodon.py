@@ -14,6 +14,8 @@ from iembot.mastodon import (
     route,
     toot,
 )
+from iembot.message import prepare_message
+from iembot.retry import RetryableError
 
 
 def test_disable_unknown_user(bot: JabberClient):
@@ -46,7 +48,8 @@ def test_gh180_mastodon_503(bot: JabberClient):
             body="Service Unavailable",
             status=503,
         )
-        assert really_toot(bot, 123, "test message", sleep=0) is None
+        with pytest.raises(RetryableError):
+            really_toot(bot, 123, "test message", sleep=0)
 
 
 def test_really_toot_without_known_user(bot: JabberClient):
@@ -57,12 +60,11 @@ def test_really_toot_without_known_user(bot: JabberClient):
 def test_route_unknown_user(bot: JabberClient):
     """Test we handle when we have an unknown user."""
     elem = Element(("jabber:client", "message"))
-    elem.x = Element(("", "x"))
+    elem.addElement(("", "x"))
     elem.x["twitter"] = "test message"
-    bot.md_routingtable["YYY"] = [
-        4321,
-    ]
-    route(bot, ["YYY"], elem)
+    elem.addElement("body", content="test message")
+    bot.fanout.add("mastodon", "YYY", 4321)
+    route(bot, prepare_message(elem, ["YYY"]))
 
 
 @pytest_twisted.inlineCallbacks
@@ -198,12 +200,12 @@ def test_gh150_route(bot: JabberClient):
         "https://iem.local/vtec/f/2026-O-CON-KBOX-CW-Y-0005_2026-02-07T23:00Z"
     )
     elem = Element(("jabber:client", "message"))
-    elem.x = Element(("", "x"))
+    elem.addElement(("", "x"))
     elem.x["twitter"] = msgtxt
-    elem["body"] = msgtxt
+    elem.addElement("body", content=msgtxt)
     # Duplicated to check the dedup
     del bot.md_users[123]  # Remove user to prevent actual call to Mastodon
-    route(bot, ["XXX", "XXX"], elem)
+    route(bot, prepare_message(elem, ["XXX", "XXX"]))
 
 
 @pytest.mark.parametrize("database", ["iembot"])
@@ -220,5 +222,5 @@ def test_util_toot(bot: JabberClient):
 def test_route_without_x(bot: JabberClient):
     """Test that we require x."""
     elem = Element(("jabber:client", "message"))
-    elem["body"] = "Test Message"
-    route(bot, ["XXX"], elem)
+    elem.addElement("body", content="Test Message")
+    route(bot, prepare_message(elem, ["XXX"]))
@@ -0,0 +1,170 @@
+"""Test iembot.media"""
+
+import random
+import threading
+import time
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from unittest import mock
+
+import pytest
+import responses
+from PIL import Image
+from requests import HTTPError
+
+from iembot import media
+from iembot.media import (
+    MediaCache,
+    configure_media_cache,
+    fetch_media,
+    media_type,
+    prepare_media,
+    transform,
+)
+
+
+def test_fetch_media_once(media_cache: MediaCache):
+    """Test that a url is fetched once for many gets."""
+    with responses.RequestsMock() as rsps:
+        rsps.add(responses.GET, "http://localhost/a.png", body=b"png")
+        assert fetch_media("http://localhost/a.png") == b"png"
+        assert fetch_media("http://localhost/a.png") == b"png"
+        assert len(rsps.calls) == 1
+    assert media_cache.stats()["media.hits"] >= 1
+
+
+def test_fetch_media_failure_not_cached():
+    """Test that a failed fetch is raised and tried again next time."""
+    with responses.RequestsMock() as rsps:
+        rsps.add(responses.GET, "http://localhost/b.png", status=404)
+        with pytest.raises(HTTPError):
+            fetch_media("http://localhost/b.png")
+        with pytest.raises(HTTPError):
+            fetch_media("http://localhost/b.png")
+        assert len(rsps.calls) == 2
+
+
+def test_singleflight():
+    """Test that concurrent gets wait on the one fetch."""
+    started = threading.Event()
+    release = threading.Event()
+
+    def _fetcher(url):
+        started.set()
+        release.wait(5)
+        return url.encode()
+
+    fetcher = mock.Mock(side_effect=_fetcher)
+    cache = MediaCache(fetcher=fetcher)
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(cache.get("u")))
+        for _ in range(5)
+    ]
+    threads[0].start()
+    started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    while cache.coalesced < 4:
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert results == [b"u"] * 5
+    fetcher.assert_called_once_with("u")
+
+
+def test_lru_and_ttl():
+    """Test the byte bound and the expiry."""
+    cache = MediaCache(max_bytes=10, fetcher=lambda url: url.encode() * 4)
+    cache.get("a")
+    cache.get("b")
+    cache.get("c")
+    assert cache.size == 8
+    assert cache.evictions == 1
+    cache.ttl = -1
+    cache.get("d")
+    cache.get("d")
+    assert cache.misses == 5
+
+
+def test_configure_media_cache(media_cache: MediaCache):
+    """Test sizing the cache from the config."""
+    configure_media_cache({"bot.media.cache_bytes": "100"})
+    assert media_cache.max_bytes == 100
+    configure_media_cache({})
+
+
+def _png(width: int, height: int, noise: bool = False) -> bytes:
+    """Make a PNG image."""
+    img = Image.new("RGB", (width, height), "blue")
+    if noise:
+        img = Image.frombytes(
+            "RGB", (width, height), random.randbytes(width * height * 3)
+        )
+    buf = BytesIO()
+    img.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def test_transform_fits_already():
+    """Test that a fitting image and non-images are passed as is."""
+    content = _png(100, 100)
+    assert transform(content, 1_000_000, 10_000) is content
+    assert transform(b"not an image", 100, 100) == b"not an image"
+    assert transform(b"not an image", 5, 100) == b""
+
+
+def test_transform_downsize():
+    """Test that an image is downsized to the pixel limit."""
+    res = transform(_png(400, 300), 1_000_000, 300 * 200)
+    img = Image.open(BytesIO(res))
+    assert img.width * img.height <= 300 * 200
+    assert media_type(res) == "image/png"
+
+
+def test_transform_recompress():
+    """Test that an image too large as PNG becomes a JPEG."""
+    content = _png(500, 500, noise=True)
+    res = transform(content, 200_000, 500 * 500)
+    assert len(res) <= 200_000
+    assert media_type(res) == "image/jpeg"
+
+
+def test_prepare_media(monkeypatch):
+    """Test that the transform is cached per url and profile."""
+    monkeypatch.setattr(media, "PROCESSES", 0)
+    big = _png(3000, 2000)
+    with responses.RequestsMock() as rsps:
+        rsps.add(responses.GET, "http://localhost/c.png", body=big)
+        res = prepare_media("http://localhost/c.png", "atmosphere")
+        assert Image.open(BytesIO(res)).size == (2449, 1632)
+        assert prepare_media("http://localhost/c.png", "atmosphere") is res
+        assert prepare_media("http://localhost/c.png", "mastodon") == big
+        assert len(rsps.calls) == 1
+
+
+def test_prepared_timeout():
+    """Test that waiting on a transform covers its fetch and encoding."""
+    assert media.PREPARED_CACHE.timeout >= (
+        media.MEDIA_CACHE.timeout + media.TRANSFORM_TIMEOUT
+    )
+
+
+def test_broken_pool_replaced(monkeypatch):
+    """Test that a broken process pool is replaced by the next transform."""
+    broken = mock.Mock()
+    broken.submit.side_effect = BrokenProcessPool("dead")
+    monkeypatch.setattr(media, "PROCESSES", 1)
+    monkeypatch.setattr(media, "_POOL", broken)
+    monkeypatch.setattr(media.MEDIA_CACHE, "get", lambda _url: b"png")
+    with pytest.raises(BrokenProcessPool):
+        media._transform_in_pool(("http://localhost/d.png", "mastodon"))
+    assert media._POOL is None
+    broken.shutdown.assert_called_once_with(wait=False, cancel_futures=True)
+    pool = mock.Mock()
+    pool.submit.return_value.result.return_value = b"fit"
+    with mock.patch.object(media, "ProcessPoolExecutor", return_value=pool):
+        res = media._transform_in_pool(("http://localhost/d.png", "mastodon"))
+    assert res == b"fit"
+    assert media._POOL is pool
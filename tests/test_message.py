@@ -0,0 +1,84 @@
+"""Test iembot.message"""
+
+from unittest import mock
+
+import pytest
+from twisted.words.xish.domish import Element
+
+from iembot import msghandlers
+from iembot.message import IngestMessage, prepare_message
+
+
+def _elem(body: str | None = "DMX: Hello  world", **attrs) -> Element:
+    """Build an ingest stanza."""
+    elem = Element(("jabber:client", "message"))
+    if body is not None:
+        elem.addElement("body", content=body)
+    html = elem.addElement(("http://jabber.org/protocol/xhtml-im", "html"))
+    html.addElement(("http://www.w3.org/1999/xhtml", "body"), content="Hi")
+    if attrs:
+        x = elem.addElement(("nwschat:nwsbot", "x"))
+        for key, value in attrs.items():
+            x[key] = value
+    return elem
+
+
+def test_prepare_message():
+    """Test that the stanza is parsed once into the message."""
+    elem = _elem(
+        channels="DMX,DVN",
+        twitter="Hello &amp;  world",
+        twitter_media="http://localhost/a.png",
+        product_id="XXX",
+        lat="41.0",
+        long="-93.0",
+    )
+    message = prepare_message(elem)
+    assert message.elem is elem
+    assert message.channels == ("DMX", "DVN")
+    assert message.body == "DMX: Hello  world"
+    assert str(message.html) == "Hi"
+    assert message.product_id == "XXX"
+    assert message.twitter == "Hello &amp;  world"
+    assert message.twitter_text == "Hello & world"
+    assert message.twitter_media == "http://localhost/a.png"
+    assert (message.lat, message.long) == ("41.0", "-93.0")
+    assert message.valid is not None
+
+
+def test_prepare_message_defaults():
+    """Test the channel from the body and a message without x."""
+    message = prepare_message(_elem())
+    assert message.channels == ("DMX",)
+    assert message.twitter is None
+    assert message.twitter_text is None
+    assert prepare_message(_elem(None)) is None
+    assert prepare_message(_elem(), ["XXX"]).channels == ("XXX",)
+
+
+def test_immutable():
+    """Test that the message can not be changed."""
+    message = IngestMessage(Element((None, "message")), ["XXX"], "Hi")
+    with pytest.raises(AttributeError):
+        message.body = "Bye"
+    with pytest.raises(AttributeError):
+        del message.channels
+    with pytest.raises(AttributeError):
+        message.extra = 1
+    with pytest.raises(TypeError):
+        IngestMessage(Element((None, "message")), ["XXX"], "Hi", bogus=1)
+
+
+def test_handlers_share_message(bot, monkeypatch):
+    """Test that every handler gets the same prepared message."""
+    handlers = [mock.Mock(), mock.Mock()]
+    monkeypatch.setattr(msghandlers, "REGISTERED_HANDLERS", handlers)
+    bot.send_groupchat_elem = mock.Mock()
+    with mock.patch(
+        "iembot.message.safe_twitter_text", return_value="x"
+    ) as safe:
+        msghandlers.process_message_from_ingest(bot, _elem(twitter="Hi"))
+    safe.assert_called_once_with("Hi")
+    message = handlers[0].call_args.args[1]
+    handlers[1].assert_called_once_with(bot, message)
+    assert message.twitter_text == "x"
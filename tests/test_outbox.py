@@ -0,0 +1,106 @@
+"""Test iembot.outbox"""
+
+import sqlite3
+import time
+from unittest import mock
+
+import pytest_twisted
+from twisted.internet.defer import Deferred
+
+from iembot.outbox import MAX_AGE, Outbox
+
+
+def _rows(path) -> list:
+    """Return what is within the outbox database."""
+    with sqlite3.connect(path) as conn:
+        return conn.execute(
+            "SELECT id, transport, payload FROM outbox ORDER by id"
+        ).fetchall()
+
+
+@pytest_twisted.inlineCallbacks
+def test_put_and_ack(tmp_path):
+    """Test that a delivery is recorded until the transport is done."""
+    path = tmp_path / "outbox.db"
+    done = Deferred()
+    dispatch = mock.Mock(return_value=done)
+    outbox = Outbox(str(path), dispatch)
+    outbox.open()
+    assert outbox.put("twitter", 123, "hi", twitter_media=None) is done
+    dispatch.assert_called_once_with(
+        "twitter", (123, "hi"), {"twitter_media": None}
+    )
+    yield outbox.flush()
+    assert _rows(path) == [
+        (1, "twitter", '[[123, "hi"], {"twitter_media": null}]')
+    ]
+    done.callback("sent")
+    assert outbox.stats()["outbox.inflight"] == 0
+    yield outbox.stop()
+    assert _rows(path) == []
+
+
+@pytest_twisted.inlineCallbacks
+def test_write_failure_kept(tmp_path):
+    """Test that a failed write keeps its changes for the next flush."""
+    path = tmp_path / "outbox.db"
+    dones = [Deferred(), Deferred()]
+    outbox = Outbox(str(path), mock.Mock(side_effect=dones))
+    outbox.open()
+    outbox.put("slack", 1, "hi")
+    yield outbox.flush()
+    dones[0].callback(None)
+    outbox.put("slack", 2, "hi")
+    with mock.patch.object(
+        outbox, "_write", side_effect=sqlite3.OperationalError("locked")
+    ):
+        yield outbox.flush()
+    assert outbox.stats()["outbox.failures"] == 1
+    assert [row[0] for row in outbox.pending] == [2]
+    assert outbox.acks == [1]
+    yield outbox.flush()
+    assert [row[0] for row in _rows(path)] == [2]
+    yield outbox.stop()
+
+
+@pytest_twisted.inlineCallbacks
+def test_done_already(tmp_path):
+    """Test a transport that returns no Deferred, or fails."""
+    path = tmp_path / "outbox.db"
+    outbox = Outbox(str(path), mock.Mock(side_effect=[None, ValueError()]))
+    outbox.open()
+    outbox.put("slack", 1, "hi")
+    outbox.put("slack", 2, "hi")
+    assert outbox.completed == 2
+    yield outbox.stop()
+    assert _rows(path) == []
+
+
+@pytest_twisted.inlineCallbacks
+def test_resume(tmp_path):
+    """Test that the next process resumes the leftover deliveries."""
+    path = tmp_path / "outbox.db"
+    outbox = Outbox(str(path), lambda *_args: Deferred())
+    outbox.open()
+    outbox.put("mastodon", 123, "first")
+    outbox.put("mastodon", 123, "second")
+    yield outbox.stop()
+
+    # Age the first one beyond resuming
+    with sqlite3.connect(path) as conn:
+        conn.execute(
+            "UPDATE outbox SET created = ? WHERE id = 1",
+            (time.time() - MAX_AGE - 1,),
+        )
+    dispatch = mock.Mock(return_value=None)
+    outbox = Outbox(str(path), dispatch)
+    outbox.open()
+    assert len(outbox.leftover) == 2
+    outbox.resume()
+    dispatch.assert_called_once_with("mastodon", [123, "second"], {})
+    assert outbox.resumed == 1
+    assert outbox.expired == 1
+    # New deliveries do not reuse the ids
+    assert outbox.next_id == 3
+    yield outbox.stop()
+    assert _rows(path) == []
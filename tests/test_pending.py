@@ -0,0 +1,41 @@
+"""Test iembot.pending"""
+
+from twisted.internet.task import Clock
+
+from iembot.pending import PendingSends
+
+
+def test_pending_order_and_bounds():
+    """Test that a room's messages are kept in order, within bounds."""
+    pending = PendingSends(size=2, ttl=10, clock=Clock())
+    for raw in (b"a", b"b", b"c"):
+        pending.add("dmxchat", raw)
+    assert pending.flush("dmxchat") == [b"b", b"c"]
+    assert pending.flush("dmxchat") == []
+    stats = pending.stats()
+    assert stats["pending.dropped"] == 1
+    assert stats["pending.sent"] == 2
+    assert stats["pending.rooms"] == 0
+
+
+def test_pending_ttl():
+    """Test that messages waiting too long are dropped."""
+    clock = Clock()
+    pending = PendingSends(ttl=10, clock=clock)
+    pending.add("dmxchat", b"a")
+    clock.advance(5)
+    pending.add("dmxchat", b"b")
+    clock.advance(6)
+    assert pending.flush("dmxchat") == [b"b"]
+    assert pending.stats()["pending.expired"] == 1
+
+
+def test_pending_discard():
+    """Test that the messages of a room left are dropped."""
+    pending = PendingSends(clock=Clock())
+    pending.add("dmxchat", b"a")
+    pending.add("dmxchat", b"b")
+    assert pending.discard("dmxchat") == 2
+    assert pending.discard("dmxchat") == 0
+    assert pending.flush("dmxchat") == []
+    assert pending.stats()["pending.dropped"] == 2
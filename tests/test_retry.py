@@ -0,0 +1,90 @@
+"""Test iembot.retry"""
+
+import pytest
+import pytest_twisted
+
+from iembot.retry import (
+    RETRY_COUNTS,
+    RETRY_POLICIES,
+    RetriesExhausted,
+    RetryableError,
+    RetryPolicy,
+    configure_retry_policies,
+    log_exhausted,
+    retry_call,
+)
+
+FAST = RetryPolicy(attempts=3, delay=0, jitter=0)
+
+
+def test_next_delay():
+    """Test the exponential backoff and its bounds."""
+    policy = RetryPolicy(delay=10, backoff=2, max_delay=30, jitter=0)
+    assert [policy.next_delay(i) for i in range(1, 5)] == [10, 20, 30, 30]
+    policy = policy._replace(jitter=0.5)
+    for _ in range(20):
+        assert 5 <= policy.next_delay(1) <= 15
+
+
+def test_configure_retry_policies():
+    """Test updating the policies from the config."""
+    old = dict(RETRY_POLICIES)
+    try:
+        configure_retry_policies(
+            {"bot.retry.webhooks.attempts": "4", "bot.retry.webhooks.delay": 5}
+        )
+        assert RETRY_POLICIES["webhooks"].attempts == 4
+        assert RETRY_POLICIES["webhooks"].delay == 5
+        assert RETRY_POLICIES["twitter"] == old["twitter"]
+    finally:
+        RETRY_POLICIES.update(old)
+
+
+@pytest_twisted.inlineCallbacks
+def test_retry_call_changes():
+    """Test that a retry applies the changes asked for by the attempt."""
+    calls = []
+
+    def _attempt(media=None):
+        calls.append(media)
+        if media is not None:
+            raise RetryableError("media failed", media=None)
+        return "sent"
+
+    res = yield retry_call("twitter", _attempt, media="x", policy=FAST)
+    assert res == "sent"
+    assert calls == ["x", None]
+
+
+@pytest_twisted.inlineCallbacks
+def test_retry_call_exhausted():
+    """Test giving up after the policy's attempts."""
+    calls = []
+    before = RETRY_COUNTS.get("mastodon.exhausted", 0)
+
+    def _attempt(**_kwargs):
+        calls.append(1)
+        raise RetryableError("still down")
+
+    with pytest.raises(RetriesExhausted):
+        yield retry_call("mastodon", _attempt, policy=FAST)
+    assert len(calls) == 3
+    assert RETRY_COUNTS["mastodon.exhausted"] == before + 1
+    res = yield retry_call("mastodon", _attempt, sleep=0).addErrback(
+        log_exhausted
+    )
+    assert res is None
+
+
+@pytest_twisted.inlineCallbacks
+def test_retry_call_not_retryable():
+    """Test that other exceptions are not retried."""
+    calls = []
+
+    def _attempt():
+        calls.append(1)
+        raise ValueError("bad")
+
+    with pytest.raises(ValueError, match="bad"):
+        yield retry_call("twitter", _attempt, policy=FAST)
+    assert len(calls) == 1
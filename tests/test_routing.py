@@ -0,0 +1,147 @@
+"""Test iembot.routing"""
+
+import pytest
+
+from iembot.routing import GROUPS, TRANSPORTS, FanoutIndex, RoutingTable
+
+
+def test_update_and_targets():
+    """Test that targets are deduped across channels."""
+    index = FanoutIndex()
+    index.update("twitter", {"AAA": [1, 2], "BBB": [2, 3], "CCC": []})
+    assert index.targets("twitter", ["AAA", "BBB"]) == {1, 2, 3}
+    assert index.targets("twitter", ["AAA"]) == {1, 2}
+    assert index.targets("twitter", ["CCC", "ZZZ"]) == frozenset()
+    assert "CCC" not in index.tables["twitter"].channels
+    assert index.targets("mastodon", ["AAA"]) == frozenset()
+
+
+def test_add_discard():
+    """Test single subscription changes."""
+    index = FanoutIndex()
+    index.add("xmpp", "AAA", "dmxchat")
+    index.add("xmpp", "AAA", "dmxchat")
+    assert index.subscribers("xmpp", "AAA") == {"dmxchat"}
+    index.discard("xmpp", "AAA", "dmxchat")
+    assert "AAA" not in index.tables["xmpp"].channels
+    # Should not raise
+    index.discard("xmpp", "AAA", "dmxchat")
+
+
+def test_resolve():
+    """Test resolving all transports at once."""
+    index = FanoutIndex()
+    index.update("xmpp", {"AAA": ["dmxchat"]})
+    index.update("slack", {"AAA": [1], "BBB": [2]})
+    res = index.resolve(["AAA", "BBB"])
+    assert set(res.keys()) == set(TRANSPORTS)
+    assert res["xmpp"] == {"dmxchat"}
+    assert res["slack"] == {1, 2}
+    assert res["twitter"] == frozenset()
+
+
+def test_resolve_cache():
+    """Test that repeated resolves hit the cache until a reload."""
+    index = FanoutIndex(cache_size=2)
+    index.update("twitter", {"AAA": [1], "BBB": [2]})
+    res = index.resolve(["AAA", "BBB"])
+    assert index.resolve(["BBB", "AAA", "AAA"]) is res
+    assert index.cache_hits == 1
+    assert index.cache_misses == 1
+    # A reload bumps the generation and invalidates the entry
+    index.update("twitter", {"AAA": [1, 3], "BBB": [2]})
+    assert index.resolve(["AAA", "BBB"])["twitter"] == {1, 2, 3}
+    assert index.cache_misses == 2
+    index.add("twitter", "BBB", 4)
+    assert 4 in index.resolve(["BBB", "AAA"])["twitter"]
+
+
+def test_resolve_cache_bounded():
+    """Test that the cache does not grow beyond its size."""
+    index = FanoutIndex(cache_size=2)
+    for channel in ["AAA", "BBB", "CCC"]:
+        index.resolve([channel])
+    assert len(index._cache) == 2
+    index.resolve(["AAA"])
+    assert index.cache_misses == 4
+
+
+def test_reverse_index():
+    """Test the target -> channels index stays in sync."""
+    index = FanoutIndex()
+    index.update("xmpp", {"AAA": ["dmxchat", "botstalk"], "BBB": ["dmxchat"]})
+    assert index.channels("xmpp", "dmxchat") == {"AAA", "BBB"}
+    assert index.channels("xmpp", "botstalk") == {"AAA"}
+    index.add("xmpp", "CCC", "botstalk")
+    assert index.channels("xmpp", "botstalk") == {"AAA", "CCC"}
+    index.discard("xmpp", "AAA", "botstalk")
+    index.discard("xmpp", "CCC", "botstalk")
+    assert "botstalk" not in index.tables["xmpp"].targets
+    assert index.channels("xmpp", "unknown") == frozenset()
+
+
+def test_routing_table_copy_on_write():
+    """Test that a RoutingTable is never modified in place."""
+    table = RoutingTable.compile({"AAA": [1]})
+    table2 = table.add("AAA", 2)
+    assert table.channels["AAA"] == {1}
+    assert table2.channels["AAA"] == {1, 2}
+    assert table2.targets[2] == {"AAA"}
+    table3 = table2.discard("AAA", 1)
+    assert table2.channels["AAA"] == {1, 2}
+    assert 1 not in table3.targets
+    with pytest.raises(TypeError):
+        table.channels["BBB"] = frozenset([3])
+
+
+def test_swap_keeps_old_snapshot():
+    """Test that a swap does not disturb a reader of the old tables."""
+    index = FanoutIndex()
+    index.update("slack", {"AAA": [1]})
+    tables = index.tables
+    index.swap("slack", RoutingTable.compile({"AAA": [2]}))
+    assert tables["slack"].channels["AAA"] == {1}
+    assert index.subscribers("slack", "AAA") == {2}
+
+
+def test_replace_target():
+    """Test replacing all subscriptions of a single target."""
+    index = FanoutIndex()
+    index.update("slack", {"AAA": [1, 2], "BBB": [1]})
+    generation = index.generation
+    index.replace_target("slack", 1, ["BBB", "CCC"])
+    assert index.subscribers("slack", "AAA") == {2}
+    assert index.subscribers("slack", "CCC") == {1}
+    assert index.channels("slack", 1) == {"BBB", "CCC"}
+    # No change means no swap
+    index.replace_target("slack", 1, ["CCC", "BBB"])
+    assert index.generation == generation + 1
+    index.replace_target("slack", 1, [])
+    assert index.channels("slack", 1) == frozenset()
+    assert "BBB" not in index.tables["slack"].channels
+
+
+def test_groups():
+    """Test resolving targets through channel groups."""
+    index = FanoutIndex()
+    index.update(GROUPS, {"AAA": [7], "BBB": [7, 8]})
+    index.update("slack", {"CCC": [1]}, {7: [2], 8: [3]})
+    assert index.resolve(["AAA"])["slack"] == {2}
+    assert index.resolve(["BBB", "CCC"])["slack"] == {1, 2, 3}
+    assert index.resolve(["BBB"])["mastodon"] == frozenset()
+    # Changing the group membership invalidates the cache
+    index.update(GROUPS, {"AAA": [8]})
+    assert index.resolve(["AAA"])["slack"] == {3}
+
+
+def test_replace_target_groups():
+    """Test replacing the group subscriptions of a single target."""
+    index = FanoutIndex()
+    index.update(GROUPS, {"AAA": [7], "BBB": [8]})
+    index.update("slack", {}, {7: [1, 2]})
+    assert index.tables["slack"].groups_of(1) == {7}
+    index.replace_target("slack", 1, [], [8])
+    assert index.resolve(["AAA"])["slack"] == {2}
+    assert index.resolve(["BBB"])["slack"] == {1}
+    index.replace_target("slack", 2, [])
+    assert 7 not in index.tables["slack"].groups
@@ -0,0 +1,117 @@
+"""Test iembot.sessions"""
+
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest import mock
+
+import pytest
+import requests
+
+from iembot import sessions
+from iembot.sessions import SessionCache, configure_sessions, http_session
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def log_message(self, *_args):
+        pass
+
+
+@pytest.fixture
+def server():
+    """A keep-alive HTTP server."""
+    httpd = HTTPServer(("127.0.0.1", 0), _Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_port}/"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_get_and_invalidate():
+    """Test that a client is cached until its credentials change."""
+    cache = SessionCache()
+    factory = mock.Mock(side_effect=requests.Session)
+    first = cache.get(("twitter", 1), factory, ("a", "b"))
+    assert cache.get(("twitter", 1), factory, ("a", "b")) is first
+    second = cache.get(("twitter", 1), factory, ("a", "c"))
+    assert second is not first
+    assert factory.call_count == 2
+    stats = cache.stats()
+    assert stats["sessions.hits"] == 1
+    assert stats["sessions.invalidated"] == 1
+    assert stats["sessions.entries"] == 1
+    cache.discard(("twitter", 1))
+    assert cache.stats()["sessions.entries"] == 0
+
+
+def test_factory_outside_lock():
+    """Test that a slow factory blocks no other lookup, losing a race."""
+    cache = SessionCache()
+    started = threading.Event()
+    release = threading.Event()
+    slow = requests.Session()
+    slow.close = mock.Mock()
+
+    def _factory():
+        started.set()
+        release.wait(5)
+        return slow
+
+    results = []
+    thread = threading.Thread(
+        target=lambda: results.append(cache.get("a", _factory))
+    )
+    thread.start()
+    started.wait(5)
+    # Neither waits on the factory still building
+    other = cache.get("b", requests.Session)
+    first = cache.get("a", requests.Session)
+    release.set()
+    thread.join(5)
+    assert results == [first]
+    assert cache.get("a", requests.Session) is first
+    assert cache.get("b", requests.Session) is other
+    slow.close.assert_called_once_with()
+    assert cache.stats()["sessions.raced"] == 1
+
+
+def test_idle_eviction(monkeypatch):
+    """Test that unused clients are closed."""
+    monkeypatch.setattr(sessions, "SWEEP_INTERVAL", 0)
+    cache = SessionCache(idle=-1)
+    cache.get("a", requests.Session)
+    cache.get("b", requests.Session)
+    assert cache.evicted == 1
+    assert cache.stats()["sessions.entries"] == 1
+
+
+def test_reuse_ratio(server):
+    """Test that the connection is kept alive between requests."""
+    cache = SessionCache()
+    for _ in range(4):
+        session = cache.get("local", requests.Session)
+        assert session.get(server, timeout=5).text == "ok"
+    stats = cache.stats()
+    assert stats["sessions.requests"] == 4
+    assert stats["sessions.connections"] == 1
+    assert stats["sessions.reuse_ratio"] == 0.75
+    # The counts survive the session being closed
+    cache.clear()
+    assert cache.stats()["sessions.requests"] == 4
+
+
+def test_http_session():
+    """Test the sessions shared per host."""
+    configure_sessions({"bot.sessions.idle": "10"})
+    assert sessions.SESSIONS.idle == 10
+    assert http_session("example.com") is http_session("example.com")
+    assert http_session("example.com") is not http_session("example.org")
+    configure_sessions({})
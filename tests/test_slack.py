@@ -1,15 +1,17 @@
 """Exercises Slack related tests."""
 
+import json
 from unittest import mock
 
 import pytest
 import pytest_twisted
-import responses
 from twisted.internet import defer
 from twisted.web.server import NOT_DONE_YET
 from twisted.web.test.requesthelper import DummyRequest
 from twisted.words.xish.domish import Element
 
+from iembot import slack
+from iembot.message import prepare_message
 from iembot.slack import (
     SlackInstallChannel,
     SlackListChannel,
@@ -99,36 +101,24 @@ def test_load_from_db(dbcursor, bot: JabberClient):
 def test_route(bot: JabberClient):
     """Quasi test a route."""
     elem = Element(("jabber:client", "message"))
-    elem.x = Element(("", "x"))
+    elem.addElement(("", "x"))
     elem.x["twitter"] = "Hello"
-    elem["body"] = "Hello, Slack!"
+    elem.addElement("body", content="Hello, Slack!")
 
     yield route(
         bot,
-        ["XXX"],
-        elem,
+        prepare_message(elem, ["XXX"]),
     )
 
 
-def test_send_to_slack():
+@pytest_twisted.inlineCallbacks
+def test_send_to_slack(http_server, monkeypatch):
     """Test sending to Slack."""
-    elem = Element(("jabber:client", "message"))
-    elem.x = Element(("", "x"))
-    elem.x["twitter"] = "Hello"
-    elem["body"] = "Hello, Slack!"
-
-    with responses.RequestsMock() as rsps:
-        rsps.add(
-            responses.POST,
-            "https://slack.com/api/chat.postMessage",
-            status=200,
-            body="Hello",
-        )
-        send_to_slack(
-            "Test",
-            "XXX",
-            elem,
-        )
+    url, recorder = http_server
+    monkeypatch.setattr(slack, "POST_MESSAGE_URL", url)
+    res = yield send_to_slack("Test", "XXX", "Hello")
+    assert res == "ok"
+    assert json.loads(recorder.bodies[0])["text"] == "Hello"
 
 
 def test_install(bot):
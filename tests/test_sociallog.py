@@ -0,0 +1,105 @@
+"""Test iembot.sociallog"""
+
+from unittest import mock
+
+import pytest_twisted
+from twisted.internet.defer import Deferred, fail, succeed
+from twisted.internet.task import Clock
+
+from iembot.sociallog import COPY_SQL, SocialLogWriter
+
+
+def _writer(**kwargs) -> SocialLogWriter:
+    """Build a writer with a fake dbpool."""
+    dbpool = mock.Mock()
+    dbpool.runInteraction.side_effect = lambda *_args: succeed(None)
+    return SocialLogWriter(dbpool, clock=Clock(), **kwargs)
+
+
+def test_periodic_flush():
+    """Test that the rows are written together every interval."""
+    writer = _writer(flush_ms=100)
+    writer.start()
+    writer.add(1, "one")
+    writer.add(2, {"two": 2})
+    writer.clock.advance(0.1)
+    writer.dbpool.runInteraction.assert_called_once_with(
+        writer._write, [(1, "one"), (2, "{'two': 2}")]
+    )
+    stats = writer.stats()
+    assert stats["social_log.written"] == 2
+    assert stats["social_log.buffered"] == 0
+    writer.stop()
+
+
+def test_bounded_buffer():
+    """Test that rows beyond the buffer are dropped."""
+    writer = _writer(max_buffer=2)
+    for i in range(3):
+        writer.add(i, "row")
+    assert writer.stats()["social_log.dropped"] == 1
+    assert writer.stats()["social_log.buffered"] == 2
+
+
+@mock.patch("iembot.sociallog.reactor")
+def test_batch_triggers_flush(mock_reactor):
+    """Test that a full batch asks for a write once."""
+    writer = _writer(batch=2)
+    for i in range(3):
+        writer.add(i, "row")
+    mock_reactor.callFromThread.assert_called_once_with(writer.flush)
+
+
+def test_write_copy():
+    """Test the COPY of the rows."""
+    txn = mock.MagicMock()
+    SocialLogWriter._write(txn, [(1, "one"), (2, "two")])
+    txn.copy.assert_called_once_with(COPY_SQL)
+    copy = txn.copy.return_value.__enter__.return_value
+    assert copy.write_row.call_args_list == [
+        mock.call((1, "one")),
+        mock.call((2, "two")),
+    ]
+
+
+@pytest_twisted.inlineCallbacks
+def test_stop_flushes_and_failures():
+    """Test the flush at shutdown, waiting on a running write."""
+    writer = _writer()
+    running = Deferred()
+    writer.dbpool.runInteraction.side_effect = [
+        running,
+        fail(RuntimeError("db down")),
+    ]
+    writer.add(1, "one")
+    writer.flush()
+    writer.add(2, "two")
+    # Only one write at a time
+    assert writer.flush() is running
+    df = writer.stop()
+    with mock.patch("iembot.sociallog.log.err") as mock_err:
+        running.callback(None)
+        yield df
+    mock_err.assert_called_once()
+    stats = writer.stats()
+    assert stats["social_log.written"] == 1
+    assert stats["social_log.failed"] == 1
+    assert stats["social_log.flushes"] == 2
+
+
+@pytest_twisted.inlineCallbacks
+def test_stop_row_during_last_write():
+    """Test that a row added while the last write runs is written too."""
+    writer = _writer()
+    running = [Deferred(), Deferred()]
+    writer.dbpool.runInteraction.side_effect = running
+    writer.add(1, "one")
+    df = writer.stop()
+    # A delivery logs its response meanwhile
+    writer.add(2, "two")
+    running[0].callback(None)
+    assert not df.called
+    running[1].callback(None)
+    yield df
+    assert writer.stats()["social_log.written"] == 2
+    assert writer.dbpool.runInteraction.call_count == 2
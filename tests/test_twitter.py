@@ -7,6 +7,8 @@ import pytest_twisted
 import responses
 from twisted.words.xish.domish import Element
 
+from iembot.message import prepare_message
+from iembot.retry import RetryableError
 from iembot.twitter import (
     disable_twitter_user,
     load_twitter_from_db,
@@ -32,7 +34,9 @@ def test_gh173_non_json_response(bot: JabberClient):
             body=b"<html><body>Some HTML response</body></html>",
             status=520,
         )
-        assert really_tweet(bot, 123, "This is a test", **xtra) is None
+        with pytest.raises(RetryableError) as exc:
+            really_tweet(bot, 123, "This is a test", **xtra)
+    assert exc.value.changes == {"twitter_media": None}
 
 
 def test_media_upload_failure(bot: JabberClient):
@@ -62,7 +66,9 @@ def test_media_upload_failure(bot: JabberClient):
             },
             status=502,
         )
-        assert really_tweet(bot, 123, "This is a test", **xtra) is None
+        with pytest.raises(RetryableError) as exc:
+            really_tweet(bot, 123, "This is a test", **xtra)
+    assert exc.value.changes == {"twitter_media": None}
 
 
 def test_gh163_unhandled_twitter_error(bot: JabberClient):
@@ -76,7 +82,8 @@ def test_gh163_unhandled_twitter_error(bot: JabberClient):
             },
             status=502,
         )
-        assert really_tweet(bot, 123, "This is a test", sleep=0) is None
+        with pytest.raises(RetryableError):
+            really_tweet(bot, 123, "This is a test", sleep=0)
 
 
 def test_gh163_duplicate_content_403(bot: JabberClient):
@@ -102,8 +109,8 @@ def test_gh163_duplicate_content_403(bot: JabberClient):
 def test_route_without_x(bot: JabberClient):
     """Test route with message missing x element."""
     elem = Element(("jabber:client", "message"))
-    elem["body"] = "This is a test"
-    assert route(bot, ["XXX"], elem) is None
+    elem.addElement("body", content="This is a test")
+    assert route(bot, prepare_message(elem, ["XXX"])) is None
 
 
 @pytest.mark.parametrize("database", ["iembot"])
@@ -117,9 +124,9 @@ def test_load_twitter_from_db(dbcursor, bot: JabberClient):
 def test_tweet_gh154_twitter(bot: JabberClient, rescode: int):
     """Test the handling of a 401 or 403 response from twitter."""
     elem = Element(("jabber:client", "message"))
-    elem.x = Element(("", "x"))
+    elem.addElement(("", "x"))
     elem.x["twitter"] = "This is a test"
-    elem["body"] = "This is a test"
+    elem.addElement("body", content="This is a test")
 
     with responses.RequestsMock(assert_all_requests_are_fired=False) as rsps:
         rsps.add(
@@ -136,10 +143,12 @@ def test_tweet_gh154_twitter(bot: JabberClient, rescode: int):
         )
         route(
             bot,
-            [
-                "XXX",
-            ],
-            elem,
+            prepare_message(
+                elem,
+                [
+                    "XXX",
+                ],
+            ),
         )
         yield tweet(bot, 123, "This is a test")
         assert 123 not in bot.tw_users
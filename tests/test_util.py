@@ -3,18 +3,24 @@
 from unittest import mock
 
 import pytest
+from twisted.words.protocols.jabber import jid
 from twisted.words.xish.domish import Element
 
 from iembot.bot import JabberClient
 from iembot.msghandlers import process_groupchat
+from iembot.routing import FanoutIndex, RoutingSnapshot, RoutingTable
 from iembot.util import (
     channels_room_list,
     daily_timestamp,
     htmlentities,
+    join_chatrooms,
     load_chatlog,
     load_chatrooms_from_db,
+    load_subscriptions_from_db,
+    merge_chatroom,
     remove_control_characters,
     safe_twitter_text,
+    xml_error,
 )
 
 
@@ -117,11 +123,15 @@ def test_remove_control_characters():
 def test_channels_room_list():
     """Test channels_room_list."""
     bot = mock.Mock()
-    bot.routingtable = {
-        "ABC": ["room1", "room2"],
-        "DEF": ["room1"],
-        "GHI": ["room3"],
-    }
+    bot.fanout = FanoutIndex()
+    bot.fanout.update(
+        "xmpp",
+        {
+            "ABC": ["room1", "room2"],
+            "DEF": ["room1"],
+            "GHI": ["room3"],
+        },
+    )
     channels_room_list(bot, "room1")
     bot.send_groupchat.assert_called_once()
     call_args = bot.send_groupchat.call_args
@@ -155,10 +165,83 @@ def test_load_chatrooms_fromdb(dbcursor):
     """Can we load up chatroom details?"""
     bot = mock.Mock()
     bot.rooms = {}
-    load_chatrooms_from_db(dbcursor, bot, True)
+    snapshot = load_chatrooms_from_db(dbcursor, bot)
+    join_chatrooms(snapshot, bot, True)
     assert bot
 
 
+def test_join_chatrooms(bot: JabberClient):
+    """Test joining and leaving rooms from a snapshot."""
+    bot.myjid = jid.JID("iembot@localhost/twisted_words")
+    bot.rooms["oldchat"] = {"occupants": {}, "joined": True}
+    snapshot = RoutingSnapshot(
+        "xmpp",
+        RoutingTable.compile({"DMX": ["dmxchat"]}),
+        {"dmxchat": 123},
+    )
+    with mock.patch("iembot.util.reactor.callLater") as callLater:
+        join_chatrooms(snapshot, bot, False)
+    callLater.assert_called_once()
+    assert "oldchat" not in bot.rooms
+    assert bot.rooms["dmxchat"]["iembot_account_id"] == 123
+    assert bot.fanout.subscribers("xmpp", "DMX") == {"dmxchat"}
+
+
+def test_merge_chatroom(bot: JabberClient):
+    """Test merging a single chatroom account."""
+    bot.myjid = jid.JID("iembot@localhost/twisted_words")
+    bot.rooms["oldchat"] = {"iembot_account_id": 1, "occupants": {}}
+    bot.rooms["keepchat"] = {"iembot_account_id": 2, "occupants": {}}
+    bot.fanout.update("xmpp", {"DMX": ["oldchat", "keepchat"]})
+    snapshot = RoutingSnapshot(
+        "xmpp",
+        RoutingTable.compile({"DSM": ["newchat"]}),
+        {"newchat": 1},
+    )
+    merge_chatroom(snapshot, bot, 1)
+    assert "oldchat" not in bot.rooms
+    assert bot.rooms["newchat"]["iembot_account_id"] == 1
+    assert bot.fanout.subscribers("xmpp", "DMX") == {"keepchat"}
+    assert bot.fanout.subscribers("xmpp", "DSM") == {"newchat"}
+
+
+def test_load_subscriptions_from_db():
+    """Test partitioning the bulk subscriptions by transport."""
+    txn = mock.Mock()
+    txn.fetchall.return_value = [
+        {
+            "transport": "xmpp",
+            "iembot_account_id": 1,
+            "target": "dmxchat",
+            "channel_name": "DMX",
+            "group_id": None,
+        },
+        {
+            "transport": "slack",
+            "iembot_account_id": 2,
+            "target": None,
+            "channel_name": "DMX",
+            "group_id": None,
+        },
+        {
+            "transport": "slack",
+            "iembot_account_id": 2,
+            "target": None,
+            "channel_name": None,
+            "group_id": 7,
+        },
+    ]
+    res = load_subscriptions_from_db(txn, ("xmpp", "slack", "twitter"))
+    assert res == {
+        "xmpp": ({"DMX": ["dmxchat"]}, {}),
+        "slack": ({"DMX": [2]}, {7: [2]}),
+        "twitter": ({}, {}),
+    }
+    sql = txn.execute.call_args[0][0]
+    assert "iembot_slack_team_channels" in sql
+    assert "iembot_mastodon_oauth" not in sql
+
+
 def test_daily_timestamp(bot: JabberClient):
     """Does the daily timestamp algo return a deferred."""
     assert daily_timestamp(bot) is not None
@@ -168,3 +251,10 @@ def test_htmlentites():
     """Do replacements work?"""
     assert htmlentities("<") == "&lt;"
     assert htmlentities("<>") == "&lt;&gt;"
+
+
+def test_xml_error():
+    """Test the well-formedness check."""
+    assert xml_error(b"<message><body>Hi</body></message>") is None
+    assert xml_error(b"<message><body>Hi</message>") is not None
+    assert xml_error(b"<html:p>Hi</html:p>") is not None
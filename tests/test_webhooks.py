@@ -1,12 +1,22 @@
 """Test iembot.webhooks"""
 
+import json
+from unittest import mock
+
 import pytest
-import responses
-from requests import HTTPError
+import pytest_twisted
+from twisted.internet import reactor
+from twisted.internet.task import Clock, deferLater
 from twisted.words.xish.domish import Element
 
+from iembot.asynchttp import HTTPStatusError
 from iembot.bot import JabberClient
+from iembot.message import prepare_message
 from iembot.webhooks import (
+    BREAKERS,
+    WebhookBatcher,
+    configure_webhooks,
+    hook,
     load_webhooks_from_db,
     really_hook,
     route,
@@ -19,18 +29,36 @@ def test_load_webhooks_from_db(dbcursor, bot: JabberClient):
     load_webhooks_from_db(dbcursor, bot)
 
 
+def test_load_webhooks_unmigrated(bot: JabberClient):
+    """Test that webhooks load without the batch columns."""
+    txn = mock.Mock()
+    txn.fetchone.return_value = {"n": 0}
+    txn.fetchall.return_value = [
+        {
+            "iembot_account_id": 123,
+            "url": "http://localhost",
+            "batch_ms": None,
+            "batch_size": None,
+        }
+    ]
+    snapshot = load_webhooks_from_db(txn, bot, subs=({}, {}))
+    assert "null as batch_ms" in txn.execute.call_args.args[0]
+    assert snapshot.accounts == {123: {"url": "http://localhost"}}
+
+
 def test_route(bot: JabberClient):
     """Can we route a message?"""
-    bot.webhooks_routingtable["XXX"] = [
-        {"url": "http://localhost", "iembot_account_id": 123},
-        {"url": "http://localhost2", "iembot_account_id": 456},
-    ]
+    bot.webhook_users = {
+        123: {"url": "http://localhost"},
+        456: {"url": "http://localhost2"},
+        789: {"url": "http://localhost2"},
+    }
+    bot.fanout.update("webhooks", {"XXX": [123, 456], "YYY": [456, 789]})
     elem = Element(("jabber:client", "message"))
-    elem["body"] = "Test Message"
+    elem.addElement("body", content="Test Message")
     route(
         bot,
-        ["XXX", "YYY"],
-        elem,
+        prepare_message(elem, ["XXX", "YYY"]),
         sleep=0,
     )
 
@@ -38,35 +66,121 @@ def test_route(bot: JabberClient):
 def test_route_no_subs(bot: JabberClient):
     """Can we route a message without any subscriptions?"""
     elem = Element(("jabber:client", "message"))
-    elem["body"] = "Test Message"
+    elem.addElement("body", content="Test Message")
     route(
         bot,
-        ["QQQ"],
-        elem,
+        prepare_message(elem, ["QQQ"]),
         sleep=0,
     )
 
 
-def test_really_hook():
-    """Can we route a message?"""
-    with responses.RequestsMock() as rsps:
-        rsps.add(responses.POST, "http://localhost", status=200)
-        # Le Sigh
-        really_hook(
-            "http://localhost",
-            b"Test Message",
-            sleep=0,
-        )
+@pytest_twisted.inlineCallbacks
+def test_really_hook(http_server):
+    """Can we post to a webhook without a thread?"""
+    url, recorder = http_server
+    res = yield really_hook(url, b"Test Message", sleep=0)
+    assert res == "ok"
+    assert recorder.bodies == [b"Test Message"]
 
 
-def test_really_hook_failures():
-    """Can we route a message?"""
-    with responses.RequestsMock() as rsps:
-        rsps.add(responses.POST, "http://localhost", status=500)
-        # Le Sigh
-        with pytest.raises(HTTPError):
-            really_hook(
-                "http://localhost",
-                b"Test Message",
-                sleep=0,
-            )
+@pytest_twisted.inlineCallbacks
+def test_really_hook_failures(http_server):
+    """Test that a non-2xx response fails."""
+    url, recorder = http_server
+    recorder.status = 500
+    with pytest.raises(HTTPStatusError) as exc:
+        yield really_hook(url, b"Test Message", sleep=0)
+    assert exc.value.code == 500
+
+
+@pytest_twisted.inlineCallbacks
+def test_hook_retried(http_server, bot: JabberClient):
+    """Test that a failed webhook is tried again."""
+    url, recorder = http_server
+    recorder.status = 503
+    bot.log_iembot_social_log = mock.Mock()
+    df = hook(bot, 123, url, "Test", sleep=0.3)
+    yield deferLater(reactor, 0.1, lambda: None)
+    recorder.status = 200
+    yield df
+    assert len(recorder.bodies) == 2
+    bot.log_iembot_social_log.assert_called_once_with(123, "ok")
+
+
+@pytest_twisted.inlineCallbacks
+def test_circuit_quarantine(http_server, bot: JabberClient):
+    """Test that a failing url is skipped once its circuit opens."""
+    url, recorder = http_server
+    recorder.status = 500
+    configure_webhooks({"bot.webhooks.circuit.failures": "1"})
+    try:
+        yield hook(bot, 123, url, "Test", sleep=0)
+        assert not BREAKERS.available(url)
+        bot.webhook_users = {123: {"url": url}}
+        bot.fanout.update("webhooks", {"XXX": [123]})
+        bot.deliver = mock.Mock()
+        elem = Element(("jabber:client", "message"))
+        elem.addElement("body", content="Test Message")
+        route(bot, prepare_message(elem, ["XXX"]))
+        bot.deliver.assert_not_called()
+        # An attempt already scheduled is skipped too
+        yield hook(bot, 123, url, "Test", sleep=0)
+        assert len(recorder.bodies) == 1
+    finally:
+        BREAKERS.circuits.clear()
+        configure_webhooks({})
+
+
+def test_batcher():
+    """Test that messages are delivered by size or by age."""
+    clock = Clock()
+    batcher = WebhookBatcher(clock)
+    bot = mock.Mock()
+    meta = {"url": "http://localhost", "batch_ms": 500, "batch_size": 3}
+    for i in range(4):
+        batcher.add(bot, 123, meta, f"msg{i}")
+    bot.deliver.assert_called_once_with(
+        "webhooks", 123, "http://localhost", ["msg0", "msg1", "msg2"]
+    )
+    assert batcher.stats()["webhooks.batch.buffered"] == 1
+    clock.advance(0.5)
+    bot.deliver.assert_called_with(
+        "webhooks", 123, "http://localhost", ["msg3"]
+    )
+    assert batcher.stats() == {
+        "webhooks.batch.buffered": 0,
+        "webhooks.batch.batches": 2,
+        "webhooks.batch.messages": 4,
+    }
+    assert not clock.getDelayedCalls()
+
+
+def test_route_batched(bot: JabberClient, monkeypatch):
+    """Test that a batched webhook's messages are buffered."""
+    batcher = WebhookBatcher(Clock())
+    monkeypatch.setattr("iembot.webhooks.BATCHER", batcher)
+    bot.webhook_users = {
+        123: {"url": "http://localhost", "batch_ms": 500, "batch_size": 10}
+    }
+    bot.fanout.update("webhooks", {"XXX": [123]})
+    bot.deliver = mock.Mock()
+    elem = Element(("jabber:client", "message"))
+    elem.addElement("body", content="Test Message")
+    route(bot, prepare_message(elem, ["XXX"]))
+    bot.deliver.assert_not_called()
+    batcher.flush_all()
+    bot.deliver.assert_called_once_with(
+        "webhooks", 123, "http://localhost", ["Test Message"]
+    )
+
+
+@pytest_twisted.inlineCallbacks
+def test_hook_batch(http_server, bot: JabberClient):
+    """Test that a batch is POSTed as a JSON array."""
+    url, recorder = http_server
+    bot.log_iembot_social_log = mock.Mock()
+    yield hook(bot, 123, url, ["one", "two"])
+    assert json.loads(recorder.bodies[0]) == [
+        {"text": "one"},
+        {"text": "two"},
+    ]
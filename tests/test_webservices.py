@@ -1,7 +1,10 @@
 """Try to test the webservices."""
 
+import json
+
 from twisted.web.test.requesthelper import DummyRequest
 
+from iembot.circuit import CircuitBreakers
 from iembot.types import JabberClient
 from iembot.webservices import (
     RoomChannel,
@@ -26,6 +29,18 @@ def test_status(bot: JabberClient):
     assert ss.render(None) is not None
 
 
+def test_status_webhook_circuit(bot: JabberClient, monkeypatch):
+    """Test that a quarantined webhook is listed without its url."""
+    url = "https://hooks.example.com/services/T0/B0/secret"
+    breakers = CircuitBreakers(failures=1)
+    breakers.failure(url)
+    monkeypatch.setattr("iembot.webservices.WEBHOOK_BREAKERS", breakers)
+    bot.webhook_users = {123: {"url": url}}
+    res = json.loads(StatusChannel(bot).render(None))
+    assert res["webhooks.circuit.123"] == "open"
+    assert b"secret" not in StatusChannel(bot).render(None)
+
+
 def test_api(bot: JabberClient):
     """Can we import API?"""
     res = wfo_rss(bot, "dmxchat")
@@ -1,7 +1,12 @@
 """Test iembot.xmpp"""
 
+from unittest import mock
+
+from twisted.internet.testing import StringTransport
+from twisted.words.protocols.jabber import xmlstream
 from twisted.words.xish.domish import Element
 
+from iembot.message import prepare_message
 from iembot.xmpp import route
 
 
@@ -11,4 +16,42 @@ def test_route(bot):
     msg["from"] = "test@example.com"
     msg["to"] = "dmxchat@localhost"
     msg.addElement("body", content="Hello, world!")
-    route(bot, ["DMX"], msg)
+    route(bot, prepare_message(msg, ["DMX"]))
+
+
+def _stream():
+    """A stream writing to a string transport."""
+    xs = xmlstream.XmlStream(xmlstream.Authenticator())
+    xs.transport = StringTransport()
+    return xs
+
+
+def test_send_groupchat_fanout(bot):
+    """Test that the bytes match sending the element to each room."""
+    bot.config["bot.mucservice"] = "conference.localhost"
+    bot.rooms = {
+        "dmxchat": {"joined": True},
+        "o'chat": {"joined": True},
+        "later": {"joined": False},
+    }
+    msg = Element(("jabber:client", "message"))
+    msg["type"] = "groupchat"
+    msg.addElement("body", content="Hello & <world>")
+    html = msg.addElement(("http://jabber.org/protocol/xhtml-im", "html"))
+    html.addElement(("http://www.w3.org/1999/xhtml", "body")).addRawXml(
+        "<p>Hello</p>"
+    )
+    expected = _stream()
+    for room in ["dmxchat", "o'chat"]:
+        msg["to"] = f"{room}@conference.localhost"
+        expected.send(msg)
+    msg["to"] = "botstalk@conference.localhost"
+    bot.xmlstream = _stream()
+    bot.send_groupchat_elem = mock.Mock()
+    assert bot.send_groupchat_fanout(msg, ["dmxchat", "o'chat", "later"]) == 2
+    assert bot.xmlstream.transport.value() == expected.transport.value()
+    assert msg["to"] == "botstalk@conference.localhost"
+    assert bot.room_jids["o'chat"] == b"o&apos;chat@conference.localhost"
+    bot.send_groupchat_elem.assert_called_once_with(
+        msg, "later@conference.localhost"
+    )